@@ -0,0 +1,70 @@
+import argparse
+import random
+import re
+import time
+from lambda_loader import load_lambda
+
+cdx = load_lambda("lambda-cdx")
+
+PATH_WORDS = ["about", "news", "products", "blog", "2019", "contact", "team",
+              "img", "static", "nodejs", "access", "feed", "wp-json", "en"]
+PATH_ENDINGS = ["", "/", ".html", ".php", "?p=12", ".css", ".js", ".png",
+                ".JPG", ".woff2", "/feed", "/robots.txt", ".pdf?dl=1"]
+
+
+def make_cdx_dump(n_rows, seed=1):
+    """Synthetic CDX rows [urlkey, timestamp, digest, original]"""
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        path = "/".join(rnd.choices(PATH_WORDS, k=rnd.randint(1, 4))) + \
+            rnd.choice(PATH_ENDINGS)
+        original = f"{rnd.choice(['http', 'https'])}://" + \
+            f"{rnd.choice(['', 'www.'])}example.com/{path}"
+        rows.append([f"com,example)/{path}",
+                     f"20{rnd.randint(10, 22)}0101000000",
+                     f"D{rnd.randint(0, n_rows // 2)}",
+                     original])
+    return rows
+
+
+def old_matcher():
+    blacklist = [re.compile(ext + r"(\/|\?|$)", re.IGNORECASE) for ext
+                 in cdx.BLACKLIST_EXTENSIONS]
+
+    def is_blacklisted(original):
+        url = re.sub(r'http(s)?:\/\/(www\.)?', '', original,
+                     flags=re.IGNORECASE)
+        return any([bool(r.search(url)) for r in blacklist])
+
+    return is_blacklisted
+
+
+def new_matcher():
+    def is_blacklisted(original):
+        return cdx.blacklist.search(cdx.re_scheme.sub('', original)) \
+            is not None
+
+    return is_blacklisted
+
+
+def run(rows):
+    results = {}
+    for name, matcher in [("old", old_matcher()), ("new", new_matcher())]:
+        start = time.perf_counter()
+        results[name] = [matcher(row[3]) for row in rows]
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.2f}s ({len(rows) / elapsed:,.0f} rows/s), " +
+              f"{sum(results[name]):,d} blacklisted")
+
+    assert results["old"] == results["new"], "matchers disagree"
+    print("old and new matcher agree on all rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the old (regex per extension) and new (single pattern) URL blacklist matcher")
+    parser.add_argument("--rows", "-n", type=int, default=1_000_000, help="Number of synthetic CDX rows (default: 1,000,000)")
+    args = parser.parse_args()
+
+    print(f"Generating {args.rows:,d} CDX rows")
+    run(make_cdx_dump(args.rows))
@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+import time
+from urllib.parse import quote_plus
+from aiohttp import web
+from lambda_loader import load_lambda
+from stubs import StubArchive
+
+
+class PagingCdx:
+    """CDX server that pages its rows with a resume key, percent-encoded
+    like the Internet Archive's (e.g. 'com%2Cexample%29%2F1+2019...%21')
+
+    A key it doesn't know starts the query over, from the first row.
+    """
+
+    def __init__(self, rows, limit):
+        self.rows = rows
+        self.limit = limit
+        self.keys = {f"{row[0]} {row[1]}!": i
+                     for i, row in enumerate(rows)}
+        self.unknown_keys = 0
+
+    async def serve_cdx(self, request):
+        start = 0
+        key = request.query.get("resumeKey")
+        if key is not None:
+            if key in self.keys:
+                start = self.keys[key]
+            else:
+                self.unknown_keys += 1
+
+        page = self.rows[start:start + self.limit]
+        lines = [" ".join(row) for row in page]
+        if start + self.limit < len(self.rows):
+            next_row = self.rows[start + self.limit]
+            lines += ["", quote_plus(f"{next_row[0]} {next_row[1]}!")]
+
+        return web.Response(text="\n".join(lines) + "\n",
+                            content_type="text/plain")
+
+
+def check(module, server, max_pages):
+    """Follow the resume keys of the stub; True if all rows came in and
+    paging ended"""
+    payload = {"url": "example.com", "matchType": "domain",
+               "limit": str(server.limit), "showResumeKey": "true"}
+
+    async def page_through():
+        rows = []
+        n_pages = 0
+        async for page, _ in module.iter_cdx_pages(
+                module.runtime.http_session(), payload):
+            rows += page
+            n_pages += 1
+            if n_pages == max_pages:
+                break
+        await module.runtime.http_session().close()
+        return rows, n_pages
+
+    rows, n_pages = module.runtime.loop.run_until_complete(page_through())
+    ended = n_pages < max_pages
+    print(f"{len(rows)}/{len(server.rows)} rows in {n_pages} pages, " +
+          f"{server.unknown_keys} resume keys not recognised; paging " +
+          ("ended" if ended else f"stopped after {max_pages} pages"))
+    return ended and rows == server.rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the CDX function follows the percent-encoded resume keys of the CDX server to the last page")
+    parser.add_argument("--rows", type=int, default=1000, help="Number of CDX rows (default: 1000)")
+    parser.add_argument("--limit", type=int, default=100, help="Rows per page (default: 100)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("rate_limit_store", "off")
+
+    # url keys with the characters the CDX server encodes in resume keys
+    rows = [[f"com,example)/{i:05d}?q=a+b", f"2019010100{i % 10000:04d}",
+             f"D{i}", "text/html", "2000", f"https://example.com/{i:05d}"]
+            for i in range(args.rows)]
+    server = PagingCdx(rows, args.limit)
+    archive = StubArchive(cdx_handler=server.serve_cdx).start()
+
+    module = load_lambda("lambda-cdx")
+    module.CDX_API_URL = archive.url("/cdx/search/cdx")
+
+    start = time.perf_counter()
+    result = check(module, server, max_pages=2 * (args.rows // args.limit + 1))
+    print(f"{time.perf_counter() - start:.2f}s")
+
+    archive.stop()
+    sys.exit(0 if result else 1)
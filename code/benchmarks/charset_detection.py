@@ -0,0 +1,74 @@
+import argparse
+import sys
+import time
+from lambda_loader import CODE_DIR
+
+sys.path.insert(0, str(CODE_DIR / "lambda-scrape"))
+from charset import decode_body, detect  # noqa: E402
+
+# pages without a declared charset that aren't valid UTF-8: the charset is
+# detected, with windows-1252 as the fallback for Western European pages
+SAMPLES = [
+    ("latin-1", "fr", "<p>Café crème à la carte, très léger. Où êtes-vous?</p>"),
+    ("latin-1", "nl", "<p>Wij leveren ook in België. Privé-adres: Groenstraat 5</p>"),
+    ("latin-1", "de", "<p>Öffnungszeiten für Grüße aus Köln: Mo-Fr geschlossen.</p>"),
+    ("latin-1", "es", "<p>Mañana, señor: ¿cuántos años tiene? ¡Olé!</p>"),
+    ("latin-1", "pt", "<p>Informações e promoções, não perca. Olá, São Paulo!</p>"),
+    ("latin-1", "da", "<p>Ærø og Ålborg, smørrebrød til frokost.</p>"),
+    ("cp1252", "en", "<p>“Quoted” – price €12 … that’s all</p>"),
+    ("cp1252", "fr", "<p>L’été à Paris – œuvres d’art, “chefs-d’œuvre”.</p>"),
+    ("cp1252", "de", "<p>Preis: 9,95 € – „Angebot“ für Käse und Würstchen.</p>"),
+    ("cp1252", "nl", "<p>Cadeaubon t.w.v. €25 – ’s avonds geopend, café “De Zon”.</p>"),
+    ("cp1250", "pl", "<p>Zażółć gęślą jaźń. Sklep internetowy z książkami, " +
+                     "dostawa w ciągu dwóch dni roboczych na terenie Polski.</p>"),
+    ("cp1251", "ru", "<p>Добро пожаловать на наш сайт. Мы предлагаем лучшие " +
+                     "товары по низким ценам, доставка по всей России.</p>"),
+    ("shift_jis", "ja", "<p>当社のウェブサイトへようこそ。製品情報とお問い合わせは" +
+                        "こちらのページをご覧ください。</p>"),
+    ("gbk", "zh", "<p>欢迎访问我们的网站。我们提供优质的产品和服务，" +
+                  "请联系我们了解更多信息。</p>"),
+    ("euc-kr", "ko", "<p>저희 웹사이트에 오신 것을 환영합니다. 제품 정보와 " +
+                     "문의는 이 페이지를 참조하십시오.</p>"),
+]
+
+
+def page(text, repeat):
+    return "<html><head><title>Page</title></head><body>" + \
+        text * repeat + "</body></html>"
+
+
+def check(repeat):
+    """Decode each sample page; True if all come out as they went in"""
+    correct = 0
+    for encoding, language, text in SAMPLES:
+        html = page(text, repeat)
+        decoded = decode_body(html.encode(encoding))
+        if decoded == html:
+            correct += 1
+            continue
+
+        first = next(i for i, (a, b) in enumerate(zip(html, decoded))
+                     if a != b)
+        print(f"{encoding} ({language}, {len(html)} characters): " +
+              f"'{html[first:first + 30]}' decoded as " +
+              f"'{decoded[first:first + 30]}'")
+
+    print(f"{correct}/{len(SAMPLES)} pages of {repeat} paragraph(s) " +
+          "decoded correctly")
+    return correct == len(SAMPLES)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the charset detection of the scrape function on short and long pages in several languages and charsets, without a declared charset")
+    parser.add_argument("--repeats", "-r", type=int, nargs="*", default=[1, 20], help="Paragraphs per page (default: 1 20)")
+    args = parser.parse_args()
+
+    if detect is None:
+        print("no charset detector installed (charset_normalizer or " +
+              "chardet); every page falls back to windows-1252")
+
+    start = time.perf_counter()
+    results = [check(repeat) for repeat in args.repeats]
+    print(f"{time.perf_counter() - start:.2f}s")
+
+    sys.exit(0 if all(results) else 1)
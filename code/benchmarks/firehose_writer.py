@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from lambda_loader import CODE_DIR
+from stubs import ThrottlingFirehose
+
+sys.path.insert(0, str(CODE_DIR / "lambda-scrape"))
+from firehose_writer import FirehoseWriter  # noqa: E402
+
+
+def make_records(n, mean_size, large_every):
+    """Records of pages of roughly mean_size bytes; some near the limit"""
+    records = []
+    for i in range(n):
+        if large_every and i % large_every == 0:
+            size = 900000
+        else:
+            size = int(random.expovariate(1 / mean_size))
+        records.append({'Data': json.dumps({"url": f"page {i}",
+                                            "page_text": "x" * size}) + '\n'})
+    return records
+
+
+def chunks(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+
+def old_send(client, output_buffer):
+    """Former handler: serial chunks of 400 records, one retry"""
+    for output_chunk in chunks(output_buffer, 400):
+        response = client.put_record_batch(
+            DeliveryStreamName="stream",
+            Records=output_chunk
+        )
+
+        retries = []
+        for index, item in enumerate(response['RequestResponses']):
+            if 'ErrorCode' not in item and 'ErrorMessage' not in item:
+                continue
+            if item['ErrorCode'] == 'ServiceUnavailableException' and \
+                    item['ErrorMessage'] == 'Slow down.':
+                retries.append(index)
+
+        if len(retries) > 0:
+            time.sleep(random.randint(1, 5))
+            response = client.put_record_batch(
+                DeliveryStreamName="stream",
+                Records=[output_chunk[x] for x in retries]
+            )
+
+
+async def produce(records, produce_time, put):
+    """Hand out records spread over produce_time, like finishing fetches"""
+    for record in records:
+        await put(record)
+        await asyncio.sleep(produce_time / len(records))
+
+
+def run_old(records, args):
+    firehose = ThrottlingFirehose(args.records_per_second, args.latency)
+    output_buffer = []
+
+    async def append(record):
+        output_buffer.append(record)
+
+    start = time.perf_counter()
+    asyncio.run(produce(records, args.produce_time, append))
+    try:
+        old_send(firehose, output_buffer)
+        error = ""
+    except ValueError as e:
+        error = f" (stopped: {str(e)})"
+    return time.perf_counter() - start, firehose, len(records) - \
+        len(firehose.delivered), error
+
+
+def run_new(records, args):
+    firehose = ThrottlingFirehose(args.records_per_second, args.latency)
+
+    async def send_all():
+        writer = FirehoseWriter(firehose, "stream",
+                                deadline=time.time() + args.deadline,
+                                concurrency=args.concurrency)
+        message_ids = iter(range(len(records)))
+        await produce(records, args.produce_time,
+                      lambda record: writer.put(record, next(message_ids)))
+        return await writer.close()
+
+    start = time.perf_counter()
+    undelivered = asyncio.run(send_all())
+    return time.perf_counter() - start, firehose, len(undelivered), ""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the former serial Firehose sending of the " +
+                    "scrape function with FirehoseWriter, against a stub " +
+                    "Firehose that throttles")
+    parser.add_argument("--records", type=int, default=2000, help="Number of records (default: 2000)")
+    parser.add_argument("--mean-size", type=int, default=20000, help="Mean record size in bytes (default: 20000)")
+    parser.add_argument("--large-every", type=int, default=50, help="Make every nth record 900 kB; 0 for none (default: 50)")
+    parser.add_argument("--records-per-second", type=int, default=1000, help="Records per second the stub accepts (default: 1000)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per stub call (default: 0.05)")
+    parser.add_argument("--produce-time", type=float, default=2, help="Seconds over which records are produced (default: 2)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Batches FirehoseWriter sends at a time (default: 4)")
+    parser.add_argument("--deadline", type=float, default=30, help="Seconds FirehoseWriter keeps retrying (default: 30)")
+    args = parser.parse_args()
+
+    random.seed(1)
+    records = make_records(args.records, args.mean_size, args.large_every)
+    n_bytes = sum(len(x['Data']) for x in records)
+    print(f"{len(records)} records, {n_bytes / 1e6:.0f} MB; stub accepts " +
+          f"{args.records_per_second} records/s")
+
+    for name, run in [("old", run_old), ("new", run_new)]:
+        seconds, firehose, lost, error = run(records, args)
+        print(f"{name}: {seconds:.2f}s, {firehose.n_calls} calls, " +
+              f"{len(firehose.delivered)} delivered, {lost} not " +
+              f"delivered{error}")
+
+
+if __name__ == "__main__":
+    main()
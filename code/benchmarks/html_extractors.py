@@ -0,0 +1,112 @@
+import argparse
+import difflib
+import sys
+import time
+import urllib.request
+from pathlib import Path
+from lambda_loader import load_lambda
+
+scrape = load_lambda("lambda-scrape")
+
+# small set of saved pages the extractors are checked on by default
+SAMPLE_PAGES = Path(__file__).parent / "pages"
+
+
+def download_corpus(urls_file, corpus):
+    """Save the Wayback pages listed in urls_file (one URL per line)"""
+    corpus.mkdir(parents=True, exist_ok=True)
+    with open(urls_file, "r") as f:
+        urls = [x.strip() for x in f.readlines() if len(x.strip()) > 0]
+
+    for index, url in enumerate(urls):
+        with urllib.request.urlopen(url) as response:
+            body = response.read()
+        path = corpus / f"page-{index:05d}.html"
+        path.write_bytes(body)
+        print(f"saved {url} to {path}")
+        time.sleep(1)
+
+
+def load_corpus(corpus):
+    pages = []
+    for path in sorted(corpus.glob("*.html")):
+        body = path.read_bytes()
+        try:
+            pages.append((path.name, body.decode("utf-8", "strict")))
+        except UnicodeDecodeError:
+            pages.append((path.name, body.decode("utf-8", "ignore")))
+    return pages
+
+
+def first_difference(expected, actual):
+    diff = difflib.unified_diff(expected.splitlines(), actual.splitlines(),
+                                "soup", "candidate", n=1, lineterm="")
+    return "\n".join(list(diff)[2:8])
+
+
+def compare(pages, name):
+    """Compare the output of an extractor with the current (soup) output"""
+    reference = scrape.HTML_EXTRACTORS["soup"]
+    candidate = scrape.HTML_EXTRACTORS[name]
+    identical = 0
+
+    for file_name, html in pages:
+        ref_text, ref_hrefs = reference(html)
+        text, hrefs = candidate(html)
+
+        if text == ref_text and hrefs == ref_hrefs:
+            identical += 1
+            continue
+
+        print(f"{file_name}: output of '{name}' differs")
+        if text != ref_text:
+            print(first_difference(ref_text, text))
+        if hrefs != ref_hrefs:
+            print(f"  hrefs: {len(ref_hrefs)} (soup) vs {len(hrefs)} ({name})")
+
+    print(f"'{name}' output identical for {identical}/{len(pages)} pages")
+    return identical == len(pages)
+
+
+def benchmark(pages, name, repeat):
+    extract = scrape.HTML_EXTRACTORS[name]
+    size = sum(len(html) for _, html in pages) * repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, html in pages:
+            extract(html)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name}: {elapsed:.2f}s, {len(pages) * repeat / elapsed:,.1f} " +
+          f"pages/s, {size / elapsed / 1e6:,.1f} MB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the html extractors of the scrape function on a corpus of saved Wayback pages, and check their output is identical")
+    parser.add_argument("--corpus", "-c", default=str(SAMPLE_PAGES), help="Folder with saved pages (*.html) (default: the sample pages in pages/)")
+    parser.add_argument("--download", "-d", help="Text file with Wayback URLs (one per line) to save to the corpus folder first")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="Number of passes over the corpus (default: 3)")
+    args = parser.parse_args()
+
+    corpus = Path(args.corpus)
+
+    if args.download:
+        download_corpus(args.download, corpus)
+
+    pages = load_corpus(corpus)
+    print(f"{len(pages)} pages, {sum(len(x) for _, x in pages):,d} characters")
+
+    if scrape.etree is None:
+        print("lxml is not installed; only benchmarking 'soup'")
+        names = ["soup"]
+    else:
+        names = list(scrape.HTML_EXTRACTORS.keys())
+
+    for name in names:
+        benchmark(pages, name, args.repeat)
+
+    equivalent = all([compare(pages, name) for name in names
+                      if name != "soup"])
+
+    sys.exit(0 if equivalent else 1)
@@ -0,0 +1,87 @@
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+from lambda_loader import load_lambda
+
+scrape = load_lambda("lambda-scrape")
+
+WORDS = ["company", "products", "über", "naïve", "\"quoted\"", "team",
+         "contact", "日本語", "news", "2019", "path\\to", "a", "résumé"]
+
+
+def make_text(size, seed=1):
+    """Synthetic page text of about `size` characters"""
+    rnd = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(WORDS) + rnd.choice([" ", " ", " ", "\n"])
+        words.append(word)
+        length += len(word)
+    return "".join(words)
+
+
+def old_make_kinesis_record(job_tag, domain, url, text=False, links=False):
+    """make_kinesis_record as it was: drops one token per iteration"""
+    record = {
+        "domain": domain,
+        "url": url,
+        "job_tag": job_tag,
+        "timestamp": datetime.now().isoformat()
+    }
+    record["page_text"] = text if text else ""
+    record["page_links"] = links if links else ""
+
+    while True:
+        size = len(json.dumps(record))
+        if size <= 1e6:
+            break
+        pre_size = len(str(record["page_text"]) + str(record["page_links"]))
+        if record["page_text"] and record["page_links"]:
+            if len(record["page_text"]) > len(record["page_links"]):
+                record["page_text"] = "\n".join(record["page_text"].split()[:-1])
+            else:
+                record["page_links"] = "\n".join(record["page_links"].split()[:-1])
+        elif record["page_text"]:
+            record["page_text"] = "\n".join(record["page_text"].split()[:-1])
+        elif record["page_links"]:
+            record["page_links"] = "\n".join(record["page_links"].split()[:-1])
+        if pre_size <= len(str(record["page_text"]) + str(record["page_links"])):
+            break
+
+    return {'Data': json.dumps(record) + '\n'}
+
+
+def run(name, make_record, text_size):
+    text = make_text(text_size)
+    links = "\n".join(f"https://example.com/{i}"
+                      for i in range(text_size // 400))
+
+    start = time.perf_counter()
+    record = make_record(job_tag="benchmark", domain="example.com",
+                         url="https://example.com/", text=text, links=links)
+    elapsed = time.perf_counter() - start
+
+    size = len(record["Data"].encode("utf-8"))
+    page_text = json.loads(record["Data"])["page_text"]
+    print(f"{name}, {text_size / 1e6:g}M characters: {elapsed:.3f}s, " +
+          f"record {size:,d} bytes, text kept {len(page_text):,d} chars")
+
+    assert size <= scrape.kinesis_max_record_size + 1, "record too large"
+    return page_text, text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time fitting oversized pages into a Firehose record")
+    parser.add_argument("--sizes", "-s", type=float, nargs="+", default=[5e6, 50e6], help="Page text sizes in characters (default: 5e6 50e6)")
+    parser.add_argument("--old-sizes", type=float, nargs="*", default=[0.67e6], help="Sizes to run the former, quadratic version on; it takes minutes once the record is more than a few percent over the limit (default: 0.67e6)")
+    args = parser.parse_args()
+
+    for size in args.old_sizes:
+        run("old", old_make_kinesis_record, int(size))
+
+    for size in args.old_sizes + args.sizes:
+        page_text, text = run("new", scrape.make_kinesis_record, int(size))
+        assert text.startswith(page_text), "whitespace was altered"
@@ -0,0 +1,34 @@
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+CODE_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_lambda(name):
+    """Import the main.py of a Lambda function (e.g. 'lambda-cdx')
+
+    Both functions create their AWS clients and queues on import, so dummy
+    settings are provided; no AWS calls are made when loading. The function's
+    folder is put on the path, as on Lambda, for its other modules.
+    """
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("sqs_cdx_id", "https://sqs.eu-central-1." +
+                          "amazonaws.com/000000000000/benchmark-cdx-queue")
+    os.environ.setdefault("sqs_fetch_id", "https://sqs.eu-central-1." +
+                          "amazonaws.com/000000000000/benchmark-scrape-queue")
+
+    # as in the zip, code shared by both functions is next to main.py
+    for folder in ("lambda-shared", name):
+        path = str(CODE_DIR / folder)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    spec = importlib.util.spec_from_file_location(
+        name.replace("-", "_"), CODE_DIR / name / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,70 @@
+import argparse
+import random
+import re
+import time
+from urllib.parse import urlparse
+from lambda_loader import load_lambda
+
+scrape = load_lambda("lambda-scrape")
+
+HREFS = [
+    "http://web.archive.org/web/20190101000000/https://example.com/{i}",
+    "https://web.archive.org/web/20190101000000/http://other{j}.org/p?{i}",
+    "/web/20190101000000/https://example.com/about#{i}",
+    "//cdn{j}.example.com/page/{i}",
+    "#section-{i}",
+    "mailto:info{j}@example.com",
+    "javascript:void(0)",
+    " https://example.com/{i} ",
+]
+
+
+def make_link_dense_page(n_links, seed=1):
+    rnd = random.Random(seed)
+    anchors = []
+    for i in range(n_links):
+        href = rnd.choice(HREFS).format(i=rnd.randint(0, n_links // 4),
+                                        j=rnd.randint(0, 20))
+        anchors.append(f'<li><a href="{href}">link {i}</a></li>')
+    anchors.append("<a>anchor without href</a>")
+    return "<html><body><ul>" + "\n".join(anchors) + "</ul></body></html>"
+
+
+def old_extract_links(hrefs):
+    """Link extraction as done per <a>-element before"""
+    doc_links = []
+    for doc_link in hrefs:
+        doc_link = re.sub(r'^http(s?):\/\/web.archive.org\/web\/(\d)+\/', '',
+                          str(doc_link))
+        parse_link = urlparse(doc_link)
+        if len(parse_link.netloc) > 0:
+            doc_links.append(doc_link)
+    return doc_links
+
+
+def timed(name, function, hrefs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        links = function(hrefs)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name}: {elapsed * 1000:.1f} ms per page, {len(links):,d} links")
+    return links
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the former per-link and the new link extraction of the scrape function on a link-dense page")
+    parser.add_argument("--links", "-n", type=int, default=20_000, help="Number of <a>-elements on the page (default: 20,000)")
+    parser.add_argument("--repeat", "-r", type=int, default=10, help="Number of runs (default: 10)")
+    args = parser.parse_args()
+
+    _, hrefs = scrape.extract_with_soup(make_link_dense_page(args.links),
+                                        get_text=False)
+    print(f"{len(hrefs):,d} hrefs")
+
+    old = timed("old", old_extract_links, hrefs, args.repeat)
+    new = timed("new", scrape.extract_links, hrefs, args.repeat)
+    timed("new, deduplicated",
+          lambda x: scrape.extract_links(x, dedup=True), hrefs, args.repeat)
+
+    assert old == new, "old and new link extraction differ"
+    print("old and new link extraction give the same links")
@@ -0,0 +1,111 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import uuid
+from aiohttp import web
+from lambda_loader import load_lambda
+from stubs import SAMPLE_PAGE, StubArchive, StubBoto3
+
+
+class CountingArchive(StubArchive):
+    """Stand-in for the archive that counts the pages it serves"""
+
+    def __init__(self):
+        super().__init__(page_handler=self.count_page)
+        self.downloads = 0
+
+    async def count_page(self, request):
+        self.downloads += 1
+        return web.Response(text=SAMPLE_PAGE, content_type="text/html")
+
+
+class Context:
+    """Lambda context with plenty of time left"""
+
+    def get_remaining_time_in_millis(self):
+        return 300 * 1000
+
+
+def scrape_event(archive, path, digest, job_tag):
+    return {"Records": [{
+        "messageId": uuid.uuid4().hex,
+        "receiptHandle": uuid.uuid4().hex,
+        "body": json.dumps({"url": archive.url(path),
+                            "domain": "example.com", "digest": digest}),
+        "messageAttributes": {"JobTag": {"stringValue": job_tag}}
+    }]}
+
+
+def scrape(module, archive, path, digest, job_tag):
+    """Scrape a page; returns whether it was downloaded, and the record"""
+    downloads = archive.downloads
+    module.boto3.calls.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.handler(scrape_event(archive, path, digest, job_tag),
+                       Context())
+
+    records = [json.loads(record["Data"])
+               for name, operation, kwargs in module.boto3.calls
+               if operation == "put_record_batch"
+               for record in kwargs["Records"]]
+    return archive.downloads > downloads, records[0] if records else None
+
+
+# (description, path, job tag, downloaded, duplicate_of)
+STEPS = [
+    ("first scrape", "/web/20190101000000/example.com/a", "job-1", True,
+     None),
+    ("same URL, same job tag (a redelivery)",
+     "/web/20190101000000/example.com/a", "job-1", True, None),
+    ("same contents at another URL", "/web/20200101000000/example.com/a",
+     "job-1", False, "/web/20190101000000/example.com/a"),
+    ("same URL under another job tag", "/web/20190101000000/example.com/a",
+     "job-2", False, "/web/20190101000000/example.com/a"),
+]
+
+
+def check(module, archive):
+    """Scrape the STEPS in order; True if each one hit or missed the cache
+    as expected"""
+    correct = 0
+    for description, path, job_tag, downloaded, duplicate_of in STEPS:
+        was_downloaded, record = scrape(module, archive, path, "D1", job_tag)
+        reference = record and record.get("duplicate_of")
+        expected = duplicate_of and archive.url(duplicate_of)
+
+        ok = was_downloaded == downloaded and reference == expected and \
+            record is not None and record["job_tag"] == job_tag
+        correct += ok
+        print(f"{description}: " +
+              ("downloaded" if was_downloaded else "cache hit") +
+              (f", reference to {reference}" if reference else "") +
+              ("" if ok else " (unexpected)"))
+
+    print(f"{correct}/{len(STEPS)} scrapes as expected")
+    return correct == len(STEPS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check which pages the scrape function downloads again with the page cache on: a redelivered message (same URL and job tag) is scraped again, the same contents at another URL or under another job tag are saved as a reference")
+    parser.add_argument("--cache", default="memory", help="page_cache setting (default: memory; e.g. sqlite:/tmp/pages.db)")
+    args = parser.parse_args()
+
+    os.environ["page_cache"] = args.cache
+    os.environ.setdefault("rate_limit_store", "off")
+
+    archive = CountingArchive().start()
+
+    module = load_lambda("lambda-scrape")
+    module.boto3 = StubBoto3(create_real_clients=False)
+    module.runtime = module.RuntimeContext()
+
+    result = check(module, archive)
+
+    # sessions are kept open between invocations; close when done
+    module.runtime.loop.run_until_complete(
+        module.runtime.http_session().close())
+    archive.stop()
+    sys.exit(0 if result else 1)
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import time
+import uuid
+from aiohttp import web
+from lambda_loader import load_lambda
+from stubs import StubArchive, StubBoto3
+
+
+def heavy_page(n_paragraphs):
+    """Wayback page with lots of text, links, scripts and styles"""
+    parts = ["<html><head><title>Heavy page</title>",
+             "<style>p { margin: 0; }</style></head><body>"]
+    for i in range(n_paragraphs):
+        parts.append(f"<div class='c{i % 7}'><p>Paragraph {i} with some " +
+                     "text about the company and its products, " +
+                     "<b>bold</b> and <i>italic</i> words.</p>" +
+                     "<a href='http://web.archive.org/web/20190101000000/" +
+                     f"https://example.com/page/{i}'>link {i}</a>" +
+                     f"<script>var x{i} = {i};</script></div>")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def scrape_event(archive, n_records):
+    return {"Records": [{
+        "messageId": uuid.uuid4().hex,
+        "receiptHandle": uuid.uuid4().hex,
+        "body": json.dumps({
+            "url": archive.url(f"/web/20190101000000/example.com/{i}"),
+            "domain": "example.com"
+        }),
+        "messageAttributes": {"JobTag": {"stringValue": "benchmark"}}
+    } for i in range(n_records)]}
+
+
+def run(archive, pool, extractor, args):
+    os.environ["parse_pool"] = pool
+    os.environ["html_extractor"] = extractor
+    module = load_lambda("lambda-scrape")
+    module.boto3 = StubBoto3()
+
+    times = []
+    for _ in range(args.repeat):
+        event = scrape_event(archive, args.records)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            module.handler(event, None)
+        times.append(time.perf_counter() - start)
+
+    module.runtime.loop.run_until_complete(
+        module.runtime.http_session().close())
+
+    best = min(times)
+    print(f"{extractor:>4}, pool {pool:>7}: {best:.2f}s per invocation, " +
+          f"{args.records / best:.1f} pages/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Throughput of the scrape function per invocation, " +
+                    "with parsing inline, in a thread pool and in a process " +
+                    "pool, against a stub archive with heavy pages")
+    parser.add_argument("--records", type=int, default=60, help="Messages per invocation (default: 60)")
+    parser.add_argument("--paragraphs", type=int, default=3000, help="Size of the page, in paragraphs (default: 3000, ~600 kB)")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the stub takes per page (default: 0.2)")
+    parser.add_argument("--workers", type=int, default=0, help="Parse pool workers; 0 for the number of vCPUs (default: 0)")
+    parser.add_argument("--repeat", type=int, default=3, help="Invocations per setting; the fastest counts (default: 3)")
+    parser.add_argument("--extractors", nargs="*", default=["soup", "lxml"], help="Html extractors to run with (default: soup lxml)")
+    args = parser.parse_args()
+
+    page = heavy_page(args.paragraphs)
+
+    async def serve_page(request):
+        await asyncio.sleep(args.latency)
+        return web.Response(text=page, content_type="text/html")
+
+    archive = StubArchive(page_handler=serve_page).start()
+
+    os.environ["rate_limit_store"] = "off"
+    os.environ["parse_workers"] = str(args.workers)
+    os.environ["pipeline_queue_size"] = "20"
+    os.environ["scrape_concurrency"] = "20"
+    os.environ["scrape_limit_per_host"] = "20"
+
+    print(f"{os.cpu_count()} vCPUs; {args.records} pages of " +
+          f"{len(page) / 1e3:.0f} kB, {args.latency}s latency")
+
+    for extractor in args.extractors:
+        for pool in ["off", "thread", "process"]:
+            run(archive, pool, extractor, args)
+
+    archive.stop()
+
+
+if __name__ == "__main__":
+    main()
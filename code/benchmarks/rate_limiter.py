@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import collections
+import sys
+import time
+from aiohttp import ClientSession, web
+from lambda_loader import CODE_DIR
+from stubs import StubArchive
+
+sys.path.insert(0, str(CODE_DIR / "lambda-shared"))
+from rate_limiter import MemoryRateStore, RateLimiter  # noqa: E402
+
+
+class ThrottlingPages:
+    """Page handler that returns 429 when over `qps` requests per second"""
+
+    def __init__(self, qps, latency, retry_after):
+        self.qps = qps
+        self.latency = latency
+        self.retry_after = retry_after
+        self.recent = collections.deque()
+
+    async def __call__(self, request):
+        now = time.monotonic()
+        while self.recent and self.recent[0] < now - 1:
+            self.recent.popleft()
+
+        if len(self.recent) >= self.qps:
+            headers = {}
+            if self.retry_after:
+                headers["Retry-After"] = str(self.retry_after)
+            return web.Response(status=429, headers=headers)
+
+        self.recent.append(now)
+        await asyncio.sleep(self.latency)
+        return web.Response(text="<html><body>page</body></html>",
+                            content_type="text/html")
+
+
+async def run_instance(archive, limiter, concurrency, deadline, results):
+    """One simulated scrape Lambda: `concurrency` downloads at a time"""
+    async def worker():
+        while time.monotonic() < deadline:
+            if limiter is not None:
+                await limiter.acquire()
+            async with session.get(archive.url("/web/2019/example.com/")) \
+                    as response:
+                await response.read()
+                if limiter is not None:
+                    await limiter.on_response(
+                        response.status, response.headers.get("Retry-After"))
+                results.append((time.monotonic(), response.status))
+
+    async with ClientSession() as session:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+async def simulate(archive, mode, args):
+    results = []
+    deadline = time.monotonic() + args.duration
+    shared_store = MemoryRateStore()
+
+    instances = []
+    for _ in range(args.instances):
+        if mode == "none":
+            limiter = None
+        else:
+            # 'separate' limiters each have their own store, like Lambda
+            # instances using the 'memory' store; 'shared' stands in for
+            # the 'dynamodb' store
+            store = shared_store if mode == "shared" else MemoryRateStore()
+            limiter = RateLimiter(store, key="web.archive.org/web",
+                                  rate=args.initial_rate)
+        instances.append(run_instance(archive, limiter, args.concurrency,
+                                      deadline, results))
+
+    start = time.monotonic()
+    await asyncio.gather(*instances)
+    return start, results
+
+
+def report(mode, start, results, duration):
+    # leave out the first half, while the rate converges
+    steady = [status for at, status in results if at >= start + duration / 2]
+    ok = sum(1 for status in steady if status == 200)
+    throttled = sum(1 for status in steady if status == 429)
+    seconds = duration / 2
+    total = max(1, ok + throttled)
+    print(f"{mode:>8}: {len(results):>6} requests; second half: " +
+          f"{(ok + throttled) / seconds:7.1f} req/s, " +
+          f"{ok / seconds:6.1f} ok/s, {100 * throttled / total:5.1f}% 429")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulates scrape Lambda instances downloading from a " +
+                    "stub archive that returns 429 above a set rate, with " +
+                    "and without the adaptive rate limiter")
+    parser.add_argument("--qps", type=int, default=50, help="Requests per second the stub accepts (default: 50)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the stub takes per page (default: 0.05)")
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After (seconds) sent with 429s; 0 for none (default: 0)")
+    parser.add_argument("--instances", type=int, default=4, help="Number of simulated Lambda instances (default: 4)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Downloads at a time per instance (default: 10)")
+    parser.add_argument("--initial-rate", type=float, default=20, help="Initial rate per instance (default: 20)")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per simulation (default: 20)")
+    parser.add_argument("--modes", nargs="*", default=["none", "separate", "shared"], help="Limiter modes to simulate (default: none separate shared)")
+    args = parser.parse_args()
+
+    pages = ThrottlingPages(args.qps, args.latency, args.retry_after)
+    archive = StubArchive(page_handler=pages).start()
+
+    print(f"stub accepts {args.qps} req/s; {args.instances} instances, " +
+          f"{args.concurrency} downloads at a time each")
+
+    for mode in args.modes:
+        start, results = asyncio.run(simulate(archive, mode, args))
+        report(mode, start, results, args.duration)
+
+    archive.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+import boto3
+from botocore.config import Config
+from lambda_loader import CODE_DIR
+
+sys.path.insert(0, str(CODE_DIR))
+from fill_sqs_queue import BatchSender  # noqa: E402
+
+
+def start_moto(port):
+    """moto's SQS server in its own process, so it doesn't share our GIL"""
+    server = subprocess.Popen([sys.executable, "-m", "moto.server", "-p",
+                               str(port)], stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/moto-api/")
+            return server
+        except OSError:
+            if server.poll() is not None:
+                sys.exit("moto server did not start; install it with " +
+                         "pip3 install 'moto[server]'")
+            time.sleep(0.1)
+    server.kill()
+    sys.exit("moto server did not start")
+
+
+def make_batches(n_messages):
+    """Batches of 10 messages, as fill_sqs_queue.py makes them (without the
+    delay, so they can be counted straight after)"""
+    batch = []
+    for i in range(n_messages):
+        batch.append({
+            'Id': str(i),
+            'MessageBody': json.dumps({"url": f"company{i}.com"}),
+        })
+        if len(batch) == 10:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def add_latency(client, latency):
+    """Make each call to the local server take as long as one to SQS"""
+    if latency > 0:
+        client.meta.events.register("before-send.sqs.*",
+                                    lambda **_: time.sleep(latency))
+
+
+def old_send(endpoint, queue_name, latency, batches):
+    """Former queue_messages: a new resource and queue lookup per batch"""
+    for message_batch in batches:
+        sqs = boto3.resource('sqs', endpoint_url=endpoint)
+        add_latency(sqs.meta.client, latency)
+        queue = sqs.get_queue_by_name(QueueName=queue_name)
+        response = queue.send_messages(Entries=message_batch)
+
+        if response.get('Failed'):
+            print(f"Failed to send messages to queue: {str(response['Failed'])}")
+
+
+def new_send(endpoint, queue_name, latency, batches, n_threads):
+    client = boto3.client('sqs', endpoint_url=endpoint,
+                          config=Config(max_pool_connections=n_threads))
+    add_latency(client, latency)
+    sender = BatchSender(client, queue_name, n_threads=n_threads,
+                         report_every=10 ** 9)
+    for batch in batches:
+        sender.send(batch)
+    sender.close()
+
+
+def count_messages(client, queue_url):
+    attributes = client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages'])['Attributes']
+    return int(attributes['ApproximateNumberOfMessages'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the former per-batch queue lookup of " +
+                    "fill_sqs_queue.py with BatchSender, against a local " +
+                    "moto SQS server (pip3 install 'moto[server]')")
+    parser.add_argument("--messages", type=int, default=1000, help="Number of messages (default: 1000)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to each call, as a round trip to SQS (default: 0.05)")
+    parser.add_argument("--threads", type=int, nargs="*", default=[4, 16], help="Thread counts to run BatchSender with (default: 4 16)")
+    parser.add_argument("--port", type=int, default=5055, help="Port of the moto server (default: 5055)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+    server = start_moto(args.port)
+    endpoint = f"http://127.0.0.1:{args.port}"
+    client = boto3.client('sqs', endpoint_url=endpoint)
+
+    print(f"{args.messages} messages, {args.latency}s per call")
+
+    runs = [("old", lambda name, batches:
+             old_send(endpoint, name, args.latency, batches))]
+    for n_threads in args.threads:
+        runs.append((f"new, {n_threads} threads",
+                     lambda name, batches, n=n_threads:
+                     new_send(endpoint, name, args.latency, batches, n)))
+
+    try:
+        for i, (name, run) in enumerate(runs):
+            queue_name = f"benchmark-{i}"
+            queue_url = client.create_queue(QueueName=queue_name)['QueueUrl']
+
+            start = time.perf_counter()
+            run(queue_name, make_batches(args.messages))
+            seconds = time.perf_counter() - start
+
+            print(f"{name}: {seconds:.2f}s, {args.messages / seconds:,.0f} " +
+                  f"messages/s, {count_messages(client, queue_url)} in queue")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
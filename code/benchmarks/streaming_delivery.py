@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from aiohttp import web
+from lambda_loader import load_lambda
+from stubs import SAMPLE_PAGE, StubArchive, StubBoto3
+
+
+class SlowArchive(StubArchive):
+    """Stand-in for the archive that takes `delay` seconds to serve pages
+    with 'slow' in their URL, and notes when it served them"""
+
+    def __init__(self, delay):
+        super().__init__(page_handler=self.serve_slowly)
+        self.delay = delay
+        self.served = {}
+
+    async def serve_slowly(self, request):
+        if "slow" in request.path:
+            await asyncio.sleep(self.delay)
+        self.served[request.path] = time.monotonic()
+        return web.Response(text=SAMPLE_PAGE, content_type="text/html")
+
+
+class Context:
+    """Lambda context with plenty of time left"""
+
+    def get_remaining_time_in_millis(self):
+        return 300 * 1000
+
+
+def scrape_event(archive, paths):
+    return {"Records": [{
+        "messageId": path,
+        "receiptHandle": uuid.uuid4().hex,
+        "body": json.dumps({"url": archive.url(path),
+                            "domain": "example.com"}),
+        "messageAttributes": {"JobTag": {"stringValue": "benchmark"}}
+    } for path in paths]}
+
+
+def check(module, archive):
+    """Scrape a fast and a slow page; True if the fast page's record is
+    sent, and its message deleted, before the slow page is downloaded"""
+    sent = {}
+    deleted = {}
+
+    def put_record_batch(DeliveryStreamName, Records):
+        for record in Records:
+            sent[json.loads(record["Data"])["url"]] = time.monotonic()
+        return {"FailedPutCount": 0,
+                "RequestResponses": [{"RecordId": uuid.uuid4().hex}
+                                     for _ in Records]}
+
+    def delete_messages(Entries):
+        for entry in Entries:
+            # message ids are the pages' paths
+            deleted[entry["Id"]] = time.monotonic()
+        return {"Successful": [{"Id": x["Id"]} for x in Entries],
+                "Failed": []}
+
+    module.boto3.handlers[("firehose", "put_record_batch")] = \
+        put_record_batch
+    module.boto3.handlers[("queue", "delete_messages")] = delete_messages
+
+    fast, slow = "/web/20190101000000/example.com/fast", \
+        "/web/20190101000000/example.com/slow"
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.handler(scrape_event(archive, [fast, slow]), Context())
+
+    def at(events, path):
+        moment = events.get(archive.url(path), events.get(path))
+        return "never" if moment is None else f"{moment - start:.2f}s"
+
+    for name, path in (("fast", fast), ("slow", slow)):
+        print(f"{name} page: downloaded at {at(archive.served, path)}, " +
+              f"record sent at {at(sent, path)}, message deleted at " +
+              f"{at(deleted, path)}")
+
+    streamed = archive.url(fast) in sent and \
+        sent[archive.url(fast)] < archive.served[slow]
+    acked = fast in deleted and deleted[fast] < archive.served[slow]
+    print("fast page's record sent " +
+          ("before" if streamed else "after") + " and its message " +
+          "deleted " + ("before" if acked else "after") +
+          " the slow page came in")
+    return streamed and acked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the scrape function sends the record of a fast page to Firehose, and deletes its message, while a slow page is still downloading")
+    parser.add_argument("--delay", type=float, default=3, help="Seconds the slow page takes (default: 3)")
+    parser.add_argument("--linger", help="firehose_linger setting (default: the function's default)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("rate_limit_store", "off")
+    if args.linger is not None:
+        os.environ["firehose_linger"] = args.linger
+
+    archive = SlowArchive(args.delay).start()
+
+    module = load_lambda("lambda-scrape")
+    module.boto3 = StubBoto3(create_real_clients=False)
+    module.runtime = module.RuntimeContext()
+
+    result = check(module, archive)
+
+    # sessions are kept open between invocations; close when done
+    module.runtime.loop.run_until_complete(
+        module.runtime.http_session().close())
+    archive.stop()
+    sys.exit(0 if result else 1)
@@ -0,0 +1,209 @@
+import asyncio
+import threading
+import time
+import uuid
+import boto3
+from aiohttp import web
+
+SAMPLE_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<title>Example page</title>
+<style>body { font-family: sans-serif; }</style>
+<script>var tracker = {"id": 1};</script>
+</head>
+<body>
+<h1>Example page</h1>
+<p>Some text about the company, its products and its team.</p>
+<a href="http://web.archive.org/web/20190101000000/https://example.com/about">About</a>
+<a href="http://web.archive.org/web/20190101000000/https://example.com/news">News</a>
+<a href="/web/20190101000000/https://example.com/contact">Contact</a>
+<svg><path d="M0 0h24v24H0z"/></svg>
+</body>
+</html>
+"""
+
+
+def success_response(kwargs):
+    """Response of a successful AWS call with the given arguments"""
+    if "Records" in kwargs:
+        return {
+            "FailedPutCount": 0,
+            "RequestResponses": [{"RecordId": uuid.uuid4().hex}
+                                 for _ in kwargs["Records"]]
+        }
+
+    if "Entries" in kwargs:
+        return {
+            "Successful": [{"Id": x["Id"]} for x in kwargs["Entries"]],
+            "Failed": []
+        }
+
+    return {"MessageId": uuid.uuid4().hex}
+
+
+class StubMessage:
+    """SQS message as returned by Queue.receive_messages"""
+
+    def __init__(self, body, message_attributes=None):
+        self.body = body
+        self.message_id = uuid.uuid4().hex
+        self.receipt_handle = uuid.uuid4().hex
+        self.message_attributes = message_attributes or {}
+
+
+class StubAwsObject:
+    """Client or queue on which every call succeeds and is recorded"""
+
+    def __init__(self, stub, name):
+        self.stub = stub
+        self.name = name
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            self.stub.calls.append((self.name, operation, kwargs))
+            handler = self.stub.handlers.get((self.name, operation))
+            if handler:
+                return handler(**kwargs)
+            return success_response(kwargs)
+
+        return call
+
+
+class StubResource:
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def Queue(self, url):
+        return StubAwsObject(self.stub, "queue")
+
+
+class StubBoto3:
+    """Stand-in for the boto3 module of a loaded Lambda function
+
+    Real clients are still created (without calling AWS), so the setup
+    cost of a cold start is included in timings. Calls are recorded in
+    `calls`; `handlers` maps (name, operation) to a function replacing
+    the default successful response, for instance
+    ("queue", "receive_messages") or ("firehose", "put_record_batch").
+    """
+
+    def __init__(self, create_real_clients=True):
+        self.create_real_clients = create_real_clients
+        self.calls = []
+        self.handlers = {}
+
+    def client(self, service, **kwargs):
+        if self.create_real_clients:
+            boto3.client(service, **kwargs)
+        return StubAwsObject(self, service)
+
+    def resource(self, service, **kwargs):
+        if self.create_real_clients:
+            boto3.resource(service, **kwargs)
+        return StubResource(self)
+
+
+class StubArchive:
+    """Local stand-in for web.archive.org, running in a background thread
+
+    Serves `page` for every /web/<timestamp>/<url> request, and
+    `cdx_rows` (lists of CDX fields) for /cdx/search/cdx. Either can be
+    replaced by passing an aiohttp handler.
+    """
+
+    def __init__(self, page=SAMPLE_PAGE, cdx_rows=None, page_handler=None,
+                 cdx_handler=None):
+        self.page = page
+        self.cdx_rows = cdx_rows or []
+        self.page_handler = page_handler or self.serve_page
+        self.cdx_handler = cdx_handler or self.serve_cdx
+        self.port = None
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    async def serve_page(self, request):
+        return web.Response(text=self.page, content_type="text/html")
+
+    async def serve_cdx(self, request):
+        lines = [" ".join(row) for row in self.cdx_rows]
+        return web.Response(text="\n".join(lines) + "\n",
+                            content_type="text/plain")
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_get("/web/{timestamp}/{url:.*}", self.page_handler)
+        app.router.add_get("/cdx/search/cdx", self.cdx_handler)
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.port = runner.addresses[0][1]
+        self.started.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+
+class ThrottlingFirehose:
+    """Firehose client that accepts `records_per_second` records per second
+
+    Records over that rate get a 'Slow down.' error, like Firehose's
+    throttling. Calls take `latency` seconds, and fail like Firehose's when
+    over the limits of a single batch. Accepted records are kept in
+    `delivered`. Use put_record_batch as a StubBoto3 handler, or the
+    object as a client.
+    """
+
+    def __init__(self, records_per_second, latency=0.05):
+        self.records_per_second = records_per_second
+        self.latency = latency
+        self.delivered = []
+        self.n_calls = 0
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_records = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        n_bytes = sum(len(record["Data"]) for record in Records)
+        if len(Records) > 500 or n_bytes > 4 * 1024 * 1024:
+            raise ValueError("InvalidArgumentException: batch of " +
+                             f"{len(Records)} records, {n_bytes} bytes")
+
+        time.sleep(self.latency)
+
+        responses = []
+        with self.lock:
+            self.n_calls += 1
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_records = 0
+
+            for record in Records:
+                if self.window_records < self.records_per_second:
+                    self.window_records += 1
+                    self.delivered.append(record)
+                    responses.append({"RecordId": uuid.uuid4().hex})
+                else:
+                    responses.append({
+                        "ErrorCode": "ServiceUnavailableException",
+                        "ErrorMessage": "Slow down."
+                    })
+
+        return {
+            "FailedPutCount": sum(1 for x in responses if "ErrorCode" in x),
+            "RequestResponses": responses
+        }
@@ -0,0 +1,68 @@
+import argparse
+import random
+import sys
+import time
+from lambda_loader import CODE_DIR, load_lambda
+
+# the copy of select_shortest_urls of the local scripts
+sys.path.insert(0, str(CODE_DIR.parent / "local_implementation"))
+import ia_harvest_urls  # noqa: E402
+
+
+def baseline_selection(urls, url_cap):
+    """Former selection: sort all records by URL length, slice off url_cap"""
+    return dict(sorted(urls.items(), key=lambda x: len(x[1][0]))[:url_cap])
+
+
+def cdx_rows(n_rows, seed):
+    """Synthetic CDX rows of a domain, with many URLs of the same length
+    and captures of varying size"""
+    rng = random.Random(seed)
+    paths = ["", "about", "news", "contact", "products", "team", "blog"]
+    for i in range(n_rows):
+        path = rng.choice(paths) + "/" * rng.randint(0, 1) + \
+            str(rng.randint(0, n_rows // 10))
+        yield [f"com,example)/{path}", f"2019{rng.randint(0, 10 ** 10):010d}",
+               f"D{rng.randint(0, n_rows)}", "text/html",
+               str(rng.choice([0, 300, 2000, 50000])),
+               f"https://www.example.com/{path}"]
+
+
+def check(module, urls, url_cap):
+    """True if the selections of the CDX function and of the local scripts
+    are the former one"""
+    start = time.perf_counter()
+    selected = module.select_shortest_urls(urls, url_cap)
+    duration = time.perf_counter() - start
+    expected = baseline_selection(urls, url_cap)
+
+    # the local scripts' records have no length: [url, timestamp]
+    local = ia_harvest_urls.select_shortest_urls(
+        {dgst: record[:2] for dgst, record in urls.items()}, url_cap)
+
+    same = list(selected.items()) == list(expected.items())
+    same_local = list(local) == list(expected)
+    print(f"url_cap {url_cap}: {len(selected)} of {len(urls)} URLs in " +
+          f"{duration * 1000:.1f} ms, " +
+          ("same as" if same else "differs from") + " the former " +
+          "selection; local scripts' selection " +
+          ("the same" if same_local else "differs"))
+    return same and same_local
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the URLs the CDX function and the local scripts keep under a url_cap are the ones they kept before (shortest first, ties in their order), with cdx_min_length off")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of CDX rows (default: 100000)")
+    parser.add_argument("--caps", type=int, nargs="*", default=[1, 100, 5000], help="url_cap values (default: 1 100 5000)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    args = parser.parse_args()
+
+    module = load_lambda("lambda-cdx")
+    if module.cdx_min_length > 0:
+        print("unset cdx_min_length to compare with the former selection")
+        sys.exit(1)
+
+    urls = module.filter_urls(cdx_rows(args.rows, args.seed))
+    results = [check(module, urls, url_cap) for url_cap in args.caps]
+
+    sys.exit(0 if all(results) else 1)
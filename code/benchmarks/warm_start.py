@@ -0,0 +1,93 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import time
+import uuid
+from lambda_loader import load_lambda
+from stubs import StubArchive, StubBoto3, StubMessage
+
+
+def load_stubbed_lambda(name, stub):
+    """Load a fresh copy of a Lambda function, like a cold start would"""
+    start = time.perf_counter()
+    module = load_lambda(name)
+    module.boto3 = stub
+    return module, time.perf_counter() - start
+
+
+def scrape_event(archive, n_records):
+    records = []
+    for i in range(n_records):
+        records.append({
+            "messageId": uuid.uuid4().hex,
+            "receiptHandle": uuid.uuid4().hex,
+            "body": json.dumps({
+                "url": archive.url(f"/web/20190101000000/example.com/{i}"),
+                "domain": "example.com"
+            }),
+            "messageAttributes": {"JobTag": {"stringValue": "benchmark"}}
+        })
+    return {"Records": records}
+
+
+def time_handler(handler, *args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        handler(*args)
+    return time.perf_counter() - start
+
+
+def run(name, n_cold, n_warm, make_args, configure=None):
+    imports, colds, warms = [], [], []
+
+    for _ in range(n_cold):
+        module, import_time = load_stubbed_lambda(name, StubBoto3())
+        if configure:
+            configure(module)
+        imports.append(import_time)
+        colds.append(time_handler(module.handler, *make_args()))
+        for _ in range(n_warm):
+            warms.append(time_handler(module.handler, *make_args()))
+
+        # sessions are kept open between invocations; close when done
+        module.runtime.loop.run_until_complete(
+            module.runtime.http_session().close())
+
+    print(f"{name}: import {statistics.median(imports) * 1000:.1f} ms, " +
+          f"cold invocation {statistics.median(colds) * 1000:.1f} ms, " +
+          f"warm invocation {statistics.median(warms) * 1000:.1f} ms " +
+          "(medians)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time cold and warm invocations of both Lambda handlers against local stubs")
+    parser.add_argument("--cold", type=int, default=5, help="Number of cold starts (default: 5)")
+    parser.add_argument("--warm", type=int, default=10, help="Number of warm invocations after each cold start (default: 10)")
+    parser.add_argument("--records", type=int, default=10, help="Number of SQS records per invocation (default: 10)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("cdx_lambda_n_iterations", "1")
+    # measure the overhead of the handlers, not the pacing of requests
+    os.environ.setdefault("rate_limit_store", "off")
+
+    cdx_rows = [[f"com,example)/{i}", "20190101000000", f"D{i}",
+                 "text/html", "2000", f"https://example.com/{i}"]
+                for i in range(100)]
+    archive = StubArchive(cdx_rows=cdx_rows).start()
+
+    run("lambda-scrape", args.cold, args.warm,
+        make_args=lambda: (scrape_event(archive, args.records), None))
+
+    def configure_cdx(module):
+        module.CDX_API_URL = archive.url("/cdx/search/cdx")
+        module.boto3.handlers[("queue", "receive_messages")] = \
+            lambda **kwargs: [StubMessage("example.com")
+                              for _ in range(args.records)]
+
+    run("lambda-cdx", args.cold, args.warm, make_args=lambda: (None, None),
+        configure=configure_cdx)
+
+    archive.stop()
@@ -1,11 +1,217 @@
 import argparse
 import boto3
+import csv
+import random
 import re
-import pandas as pd
+import threading
+import time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
 
+class BatchSender:
+    """Sends messages to an SQS queue in batches, many batches at the same time
+
+    The queue's URL is looked up once, and the client is shared by all
+    threads. Entries SQS doesn't accept are retried with backoff, up to
+    max_attempts times, except those it rejects as invalid; entries that
+    could not be sent end up in `failed`. on_done (if given) is called, from
+    the sending thread, with the entries sent and the (entry, error) pairs
+    given up on after each call. At most twice n_threads batches wait to be
+    sent; send() blocks when there are more.
+    """
+
+    def __init__(self, client, queue_name, n_threads=16, max_attempts=5,
+                 base_delay=0.2, report_every=10000, on_done=None):
+        self.client = client
+        self.queue_url = client.get_queue_url(QueueName=queue_name)['QueueUrl']
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.report_every = report_every
+        self.on_done = on_done
+        self.executor = ThreadPoolExecutor(n_threads)
+        self.slots = threading.BoundedSemaphore(2 * n_threads)
+        self.lock = threading.Lock()
+        self.n_sent = 0
+        self.n_calls = 0
+        self.failed = []
+        self.started = time.perf_counter()
+
+    def send(self, entries):
+        """Send a batch of (up to 10) entries from one of the threads"""
+        self.slots.acquire()
+        future = self.executor.submit(self.send_batch, entries)
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def send_message_batch(self, entries):
+        """Entries SQS did not accept, with the reason, as (entry, error, retry)"""
+        try:
+            response = self.client.send_message_batch(QueueUrl=self.queue_url,
+                                                      Entries=entries)
+        except Exception as e:
+            return [(entry, str(e), True) for entry in entries]
+
+        errors = {x['Id']: x for x in response.get('Failed', [])}
+        return [(entry, errors[entry['Id']].get('Message', errors[entry['Id']]['Code']),
+                 not errors[entry['Id']].get('SenderFault', False))
+                for entry in entries if entry['Id'] in errors]
+
+    def send_batch(self, entries):
+        attempt = 0
+        while True:
+            failed = self.send_message_batch(entries)
+            attempt += 1
+
+            retries = [entry for entry, _, retry in failed if retry]
+            if attempt >= self.max_attempts:
+                retries = []
+
+            given_up = [(entry, error) for entry, error, retry in failed
+                        if not retry or len(retries) == 0]
+
+            with self.lock:
+                self.n_calls += 1
+                n_sent_before = self.n_sent
+                self.n_sent += len(entries) - len(failed)
+                self.failed.extend(given_up)
+
+                if self.n_sent // self.report_every > n_sent_before // self.report_every:
+                    print(f"{self.n_sent:>10,d} sent ({self.rate():,.0f} messages/s)")
+
+            if self.on_done is not None:
+                failed_ids = set(entry['Id'] for entry, _, _ in failed)
+                self.on_done([entry for entry in entries if entry['Id'] not in failed_ids], given_up)
+
+            if len(retries) == 0:
+                return
+
+            time.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
+            entries = retries
+
+    def rate(self):
+        return self.n_sent / max(time.perf_counter() - self.started, 1e-9)
+
+    def close(self):
+        """Wait until all batches are sent; returns the entries that failed"""
+        self.executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - self.started
+        print(f"Sent {self.n_sent:,d} messages in {elapsed:,.1f}s ({self.rate():,.0f} " +
+              f"messages/s, {self.n_calls:,d} calls); {len(self.failed):,d} failed")
+
+        for entry, error in self.failed[:10]:
+            print(f"Failed to send {entry['MessageBody']}: {error}")
+
+        return self.failed
+
+
+class Checkpoint:
+    """Progress of queueing an infile, kept in a manifest, to resume from
+
+    The manifest is only appended to, with tab separated lines:
+    'start <job tag>' for each new run; 'acked <index>' once SQS accepted (or
+    gave up on) all rows up to that index; 'failed <index> <error>' for a row
+    that could not be sent, and 'sent <index>' once it is, on a later run.
+    Sending threads only update the progress in memory; lines are written by
+    the thread reading the infile, at most every `interval` seconds.
+    """
+
+    def __init__(self, path, interval=2):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.job_tag = None
+        self.acked = -1
+        self.resumed_from = -1
+        self.done = set()
+        self.failed = {}
+        self.lines = []
+        self.acked_written = -1
+        self.written = time.monotonic()
+        self.file = None
+
+    def load(self):
+        """Progress of the last run in the manifest"""
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                kind, *values = line.rstrip('\n').split('\t')
+                if kind == 'start':
+                    self.job_tag = values[0]
+                    self.acked = -1
+                    self.failed = {}
+                elif kind == 'acked':
+                    self.acked = max(self.acked, int(values[0]))
+                elif kind == 'failed':
+                    self.failed[int(values[0])] = values[1]
+                elif kind == 'sent':
+                    self.failed.pop(int(values[0]), None)
+
+        self.resumed_from = self.acked
+        self.acked_written = self.acked
+
+    def start(self, job_tag):
+        self.lines.append(f"start\t{job_tag}\n")
+        self.flush(force=True)
+
+    def queued_before(self, index):
+        return index <= self.resumed_from and index not in self.failed
+
+    def on_done(self, sent, failed):
+        """Entries SQS accepted, and (entry, error) pairs it did not"""
+        with self.lock:
+            for entry in sent:
+                index = int(entry['Id'])
+                if index in self.failed:
+                    del self.failed[index]
+                    self.lines.append(f"sent\t{index}\n")
+                self.acknowledge(index)
+
+            for entry, error in failed:
+                index = int(entry['Id'])
+                self.failed[index] = " ".join(str(error).split())
+                self.lines.append(f"failed\t{index}\t{self.failed[index]}\n")
+                self.acknowledge(index)
+
+    def skipped(self, index):
+        """A row that isn't sent (e.g. without a URL)"""
+        with self.lock:
+            self.acknowledge(index)
+
+    def acknowledge(self, index):
+        # rows resent from a previous run were acknowledged then
+        if index <= self.resumed_from:
+            return
+
+        self.done.add(index)
+        while self.acked + 1 in self.done:
+            self.acked += 1
+            self.done.remove(self.acked)
+
+    def flush(self, force=False):
+        """Append the progress since the last flush, if it's time"""
+        if not force and time.monotonic() - self.written < self.interval:
+            return
+
+        with self.lock:
+            lines, self.lines = self.lines, []
+            if self.acked > self.acked_written:
+                lines.append(f"acked\t{self.acked}\n")
+                self.acked_written = self.acked
+
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+        self.file.write("".join(lines))
+        self.file.flush()
+        self.written = time.monotonic()
+
+    def close(self):
+        self.flush(force=True)
+        self.file.close()
+        self.file = None
+
+
 class MessageQueuer:
 
     infile = None
@@ -13,6 +219,12 @@ class MessageQueuer:
     csv_header_years = 'Year'
     batch_size = 10
     message_batch = []
+    chunk_size = 10000
+    # 'csv' doesn't import pandas, which takes a while; 'pandas' parses large
+    # files faster
+    readers = ['csv', 'pandas']
+    reader = 'csv'
+    n_threads = 16
     delay_seconds = 5
     aws_profile = None
     sqs_queue = None
@@ -20,32 +232,57 @@ class MessageQueuer:
     job_tag = None
     first_stage_only = False
     year_window = None
+    n_windows = 1
+    resume = False
+    checkpoint = None
+    collapse = None
+    # CDX field, optionally with the number of characters to compare
+    re_collapse_field = r'(urlkey|timestamp|digest|original|mimetype|statuscode|length)(:\d+)?'
 
     def __init__(self, sqs_queue, infile, aws_profile,
                  message_author, job_tag, first_stage_only,
-                 year_window):
+                 year_window, collapse=None, n_windows=None, n_threads=None,
+                 reader=None, resume=False, manifest=None):
 
-        if job_tag is None:
+        if job_tag is not None:
+            self.job_tag = self.clean_job_tag(job_tag)
+        elif not resume:
+            # a resumed run keeps its job tag (below)
             self.job_tag = self.clean_job_tag(self.get_generated_job_tag())
             print(f"Generated job tag: {self.job_tag}")
-        else:
-            self.job_tag = self.clean_job_tag(job_tag)
 
         if year_window is not None:
             assert year_window.isdigit(), f"{year_window} is not an integer value"
             self.year_window = int(year_window)
 
+        if n_windows is not None:
+            assert year_window is not None, "--n-windows requires --year-window"
+            assert n_windows.isdigit() and int(n_windows) > 0, f"{n_windows} is not a positive integer value"
+            self.n_windows = int(n_windows)
+
         assert infile is not None, "Need an input file (--infile <filename>)"
         path = Path(infile)
         assert path.is_file(), f"{infile} is not a file"
 
-        cols = [self.csv_header_urls]
+        self.infile = path
 
-        if self.year_window is not None:
-            cols.append(self.csv_header_years)
+        if reader is not None:
+            assert reader in self.readers, f"{reader} is not a valid reader ({', '.join(self.readers)})"
+            self.reader = reader
+
+        # progress is kept next to the infile, unless specified otherwise
+        manifest = Path(manifest) if manifest is not None else path.with_name(f"{path.stem}--progress.tsv")
+        self.checkpoint = Checkpoint(manifest)
 
-        self.urls = pd.read_csv(path, usecols=cols)
-        print(f"Got {len(self.urls):,d} URLs")
+        if resume:
+            assert manifest.is_file(), f"Can't resume: {manifest} does not exist"
+            self.checkpoint.load()
+            assert job_tag is None or self.job_tag == self.checkpoint.job_tag, \
+                f"Can't resume: {manifest} is of job '{self.checkpoint.job_tag}'"
+            self.job_tag = self.checkpoint.job_tag
+            self.resume = True
+            print(f"Resuming job {self.job_tag} after row {self.checkpoint.acked:,d}, " +
+                  f"with {len(self.checkpoint.failed):,d} failed rows")
 
         assert sqs_queue is not None, "Need an SQS Queue"
         self.sqs_queue = sqs_queue
@@ -59,6 +296,15 @@ class MessageQueuer:
         assert type(first_stage_only) == bool, f"{first_stage_only} is not a bool value"
         self.first_stage_only = first_stage_only
 
+        if n_threads is not None:
+            assert n_threads.isdigit() and int(n_threads) > 0, f"{n_threads} is not a positive integer value"
+            self.n_threads = int(n_threads)
+
+        if collapse is not None:
+            assert collapse == 'none' or all(re.fullmatch(self.re_collapse_field, x) for x in collapse.split(',')), \
+                f"{collapse} is not a valid collapse policy (comma separated CDX fields, or 'none')"
+            self.collapse = collapse
+
     @staticmethod
     def clean_job_tag(job_tag):
         return re.sub(r'[^a-zA-Z0-9!\.\-\_\.\*\'\(\)\#]', '-', job_tag)[:32]
@@ -68,39 +314,130 @@ class MessageQueuer:
         now = datetime.now()
         return f'{now.year}.{now.month:0>2d}.{now.day:0>2d}-{now.hour:0>2d}.{now.minute:0>2d}'
 
-    def queue_messages(self, message_batch):
-        boto3.setup_default_session(profile_name=self.aws_profile)
-        sqs = boto3.resource('sqs')
-        queue = sqs.get_queue_by_name(QueueName=self.sqs_queue)
-        response = queue.send_messages(Entries=message_batch)
+    @staticmethod
+    def parse_year(value):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+    def read_chunks(self):
+        """The infile's (index, url, year) rows, chunk_size at a time, so memory
+        use doesn't grow with the size of the file; year is None without a year
+        window, or if it's missing. Indexes number the non-empty rows."""
+        cols = [self.csv_header_urls]
+
+        if self.year_window is not None:
+            cols.append(self.csv_header_years)
+
+        if self.reader == 'pandas':
+            chunks = self.read_chunks_pandas(cols)
+        else:
+            chunks = self.read_chunks_csv(cols)
+
+        for index, urls, years in chunks:
+            if years is None:
+                years = [None] * len(urls)
+            else:
+                years = [self.parse_year(x) for x in years]
+
+            yield zip(index, urls, years)
+
+    def read_chunks_csv(self, cols):
+        with open(self.infile, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            missing = [x for x in cols if x not in header]
+            assert len(missing) == 0, f"Column(s) {', '.join(missing)} missing from {self.infile}"
+            positions = [header.index(x) for x in cols]
+
+            index = 0
+            rows = []
+            for row in reader:
+                if len(row) == 0:
+                    # like pandas, skip blank lines
+                    continue
+
+                rows.append([row[x] if x < len(row) else '' for x in positions])
+                if len(rows) == self.chunk_size:
+                    yield self.columns(index, rows, cols)
+                    index += len(rows)
+                    rows = []
+
+            if len(rows) > 0:
+                yield self.columns(index, rows, cols)
+
+    @staticmethod
+    def columns(index, rows, cols):
+        columns = list(zip(*rows))
+        return range(index, index + len(rows)), columns[0], columns[1] if len(cols) > 1 else None
+
+    def read_chunks_pandas(self, cols):
+        import pandas as pd
+
+        for chunk in pd.read_csv(self.infile, usecols=cols, dtype=str, keep_default_na=False,
+                                 chunksize=self.chunk_size):
+            years = chunk[self.csv_header_years].tolist() if len(cols) > 1 else None
+            yield chunk.index, chunk[self.csv_header_urls].tolist(), years
 
-        if response.get('Failed'):
-            print(f"Failed to send messages to queue: {str(response['Failed'])}")
+    def get_sender(self):
+        session = boto3.Session(profile_name=self.aws_profile)
+        # a connection per thread
+        client = session.client('sqs', config=Config(max_pool_connections=self.n_threads))
+        return BatchSender(client, self.sqs_queue, n_threads=self.n_threads,
+                           on_done=self.checkpoint.on_done)
 
     def send_urls_to_queue(self):
         print("Sending messages to SQS Queue")
-        messages_sent = 0
-
-        for index, row in self.urls.iterrows():
-            url = row[self.csv_header_urls]
+        sender = self.get_sender()
+
+        if not self.resume:
+            self.checkpoint.start(self.job_tag)
+
+        try:
+            self.send_rows(sender)
+        finally:
+            # after an error too, so the rows sent so far are in the manifest
+            failed = sender.close()
+            self.checkpoint.close()
+            print(f"Progress written to {self.checkpoint.path}")
+
+        print(f"Sent {sender.n_sent:,d} messages to {self.sqs_queue}")
+        if len(failed) > 0:
+            print(f"Use --resume to send the {len(failed):,d} failed messages again")
+        return failed
+
+    def send_rows(self, sender):
+        n_urls = 0
+        n_queued_before = 0
+        self.message_batch = []
+
+        for index, url, year in (row for chunk in self.read_chunks() for row in chunk):
+            n_urls += 1
+            self.checkpoint.flush()
+
+            if self.checkpoint.queued_before(index):
+                n_queued_before += 1
+                continue
+
+            if len(url.strip()) == 0:
+                print(f"Missing URL in row {index}")
+                self.checkpoint.skipped(index)
+                continue
 
             year_start = None
             year_end = None
 
             if self.year_window is not None:
-                try:
-                    year_start = int(row[self.csv_header_years])
-                    year_end = year_start + self.year_window
-                except Exception:
+                if year is None:
                     print(f"Missing year value: {url.strip()}")
-                    pass
+                else:
+                    year_start = year
+                    year_end = year_start + self.year_window
 
             if len(self.message_batch) == self.batch_size:
-                self.queue_messages(self.message_batch)
-                messages_sent += len(self.message_batch)
+                sender.send(self.message_batch)
                 self.message_batch = []
-                if messages_sent % 1000 == 0:
-                    print(f"{messages_sent:>8,d} / {len(self.urls):,d}")
 
             message = {
                     'Id': str(index),
@@ -123,18 +460,30 @@ class MessageQueuer:
                 }
 
             if year_start and year_end:
+                # consecutive windows, retrieved with a single CDX query
+                windows = []
+                for window in range(self.n_windows):
+                    offset = window * (self.year_window + 1)
+                    windows.append(f"{year_start + offset}:{year_end + offset}")
+
                 message['MessageAttributes']['YearWindow'] = {
                     'DataType': 'String',
-                    'StringValue': f"{year_start}:{year_end}"
+                    'StringValue': ",".join(windows)
+                }
+
+            if self.collapse is not None:
+                message['MessageAttributes']['Collapse'] = {
+                    'DataType': 'String',
+                    'StringValue': self.collapse
                 }
 
             self.message_batch.append(message)
 
         if len(self.message_batch) > 0:
-            self.queue_messages(self.message_batch)
-            messages_sent += len(self.message_batch)
+            sender.send(self.message_batch)
+            self.message_batch = []
 
-        print(f"Sent {messages_sent:,d} messages to {self.sqs_queue}")
+        print(f"Got {n_urls:,d} URLs" + (f", {n_queued_before:,d} of which were queued before" if self.resume else ""))
 
     @classmethod
     def from_arguments(cls):
@@ -145,7 +494,13 @@ class MessageQueuer:
         parser.add_argument("--message-author", "-a", help="Message author name (current default: crunchbase)", default="crunchbase")
         parser.add_argument("--job-tag", "-t", help="Tag to help identify and keep together results from one job (max. 32 characters)")
         parser.add_argument("--year-window", "-y", help=f"Number of years to scrape from start year (requires column '{cls.csv_header_years}' with start year)")
+        parser.add_argument("--n-windows", "-w", help="Number of consecutive year windows of --year-window years to scrape (default: 1)")
         parser.add_argument("--first-stage-only", action='store_true')
+        parser.add_argument("--reader", choices=cls.readers, help=f"Read the infile with the csv module, or in chunks with pandas, which is faster for large files but slow to import (default: {cls.reader})")
+        parser.add_argument("--resume", action='store_true', help="Send the rows that weren't sent by an earlier, interrupted run (and its failed rows), under the same job tag")
+        parser.add_argument("--manifest", help="File the progress is kept in, to resume from (default: the infile's name, ending in '--progress.tsv')")
+        parser.add_argument("--threads", help=f"Number of batches of messages sent at the same time (default: {cls.n_threads})")
+        parser.add_argument("--collapse", "-c", help="Captures the Internet Archive collapses into one, e.g. 'timestamp:6' (one per month), 'digest' or 'none' (default: the CDX function's setting)")
         # always includes start year, so y=4 will give 5 years
         args = parser.parse_args()
 
@@ -157,6 +512,12 @@ class MessageQueuer:
             job_tag=args.job_tag,
             first_stage_only=args.first_stage_only,
             year_window=args.year_window,
+            collapse=args.collapse,
+            n_windows=args.n_windows,
+            n_threads=args.threads,
+            reader=args.reader,
+            resume=args.resume,
+            manifest=args.manifest,
         )
 
 
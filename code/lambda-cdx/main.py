@@ -6,9 +6,13 @@ import aiohttp
 import asyncio
 import logging
 import datetime
-import itertools
-from urllib.parse import urlparse
+import heapq
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from urllib.parse import unquote_plus, urlparse
 from urllib.error import URLError
+from rate_limiter import RateLimiter, make_rate_store
 
 logger = logging.getLogger()
 
@@ -49,8 +53,12 @@ BLACKLIST_EXTENSIONS = [
     "/feed$",
 ]
 
-blacklist = [re.compile(ext + r"(\/|\?|$)", re.IGNORECASE) for ext
-             in BLACKLIST_EXTENSIONS]
+# all extensions in a single pattern, so each url is searched only once
+# (same matches as searching for every extension separately)
+blacklist = re.compile("(?:" + "|".join(BLACKLIST_EXTENSIONS) +
+                       r")(\/|\?|$)", re.IGNORECASE)
+
+re_scheme = re.compile(r'http(s)?:\/\/(www\.)?', re.IGNORECASE)
 
 sqs_message_author = os.environ.get("sqs_message_author", "author")
 sqs_cdx_max_messages = int(os.environ.get("sqs_cdx_max_messages", 10))
@@ -58,23 +66,230 @@ cdx_lambda_n_iterations = int(os.environ.get("cdx_lambda_n_iterations", 2))
 match_exact_url = int(os.environ.get("match_exact_url", 0)) == 1
 payload_from_year = os.environ.get("payload_from_year", "2018")
 payload_to_year = os.environ.get("payload_to_year", "2019")
+payload_collapse = os.environ.get("payload_collapse", "timestamp:4")
 url_limit_per_domain = int(os.environ.get("url_limit_per_domain", 1000))
+cdx_page_size = int(os.environ.get("cdx_page_size", 5000))
+cdx_max_attempts = int(os.environ.get("cdx_max_attempts", 3))
+rate_limit_store = os.environ.get("rate_limit_store", "memory")
+rate_limit_initial = float(os.environ.get("rate_limit_initial", 20))
+rate_limit_min = float(os.environ.get("rate_limit_min", 0.5))
+rate_limit_max = float(os.environ.get("rate_limit_max", 100))
+rate_limit_max_wait = float(os.environ.get("rate_limit_max_wait", 10))
+cdx_mimetypes = [x.strip() for x in os.environ.get(
+    "cdx_mimetypes", "").split(",") if x.strip()]
+cdx_min_length = int(os.environ.get("cdx_min_length", 0))
+cdx_shard_min_pages = int(os.environ.get("cdx_shard_min_pages", 0))
+cdx_pages_per_shard = int(os.environ.get("cdx_pages_per_shard", 1))
+cdx_merge_delay = int(os.environ.get("cdx_merge_delay", 60))
+cdx_merge_max_waits = int(os.environ.get("cdx_merge_max_waits", 30))
+result_bucket = os.environ.get("result_bucket", None)
+cdx_visibility_timeout = int(os.environ.get("cdx_visibility_timeout", 180))
+cdx_deadline_margin = int(os.environ.get("cdx_deadline_margin", 60))
+
+# a CDX field, optionally with the number of leading characters to compare
+re_collapse_field = re.compile(r'^(urlkey|timestamp|digest|original|' +
+                               r'mimetype|statuscode|length)(:\d+)?$')
+
+CDX_API_URL = "http://web.archive.org/cdx/search/cdx"
+# folder of the result bucket with the results of shards of large domains
+SHARDS_PREFIX = "cdx-shards"
+# folder of the result bucket with what was retrieved of domains that
+# continue on a next invocation
+PARTIAL_PREFIX = "cdx-partial"
+# the original url must be last: it may contain spaces
+CDX_FIELDS = ["urlkey", "timestamp", "digest", "mimetype", "length",
+              "original"]
+
+
+class RuntimeContext:
+    """Resources kept between invocations of a warm Lambda
+
+    The SQS queues, the S3 client, the event loop, the http session (with
+    its open connections to the Internet Archive) and the rate limiter are
+    created on first use, and reused by later batches and invocations of
+    the same Lambda instance.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._http_session = None
+        self._sqs = None
+        self._s3 = None
+        self._fetch_sqs_queue = None
+        self._cdx_sqs_queue = None
+        self._rate_limiter = None
+
+    @property
+    def loop(self):
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
+
+    @property
+    def sqs(self):
+        if self._sqs is None:
+            self._sqs = boto3.resource("sqs")
+        return self._sqs
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = boto3.client("s3")
+        return self._s3
+
+    @property
+    def fetch_sqs_queue(self):
+        if self._fetch_sqs_queue is None:
+            self._fetch_sqs_queue = \
+                self.sqs.Queue(os.environ.get("sqs_fetch_id", None))
+        return self._fetch_sqs_queue
+
+    @property
+    def cdx_sqs_queue(self):
+        if self._cdx_sqs_queue is None:
+            self._cdx_sqs_queue = \
+                self.sqs.Queue(os.environ.get("sqs_cdx_id", None))
+        return self._cdx_sqs_queue
+
+    @property
+    def rate_limiter(self):
+        """Limiter of requests to the CDX API, or None if switched off"""
+        if self._rate_limiter is None:
+            store = make_rate_store(rate_limit_store)
+            if store is not None:
+                self._rate_limiter = RateLimiter(store,
+                                                 key="web.archive.org/cdx",
+                                                 rate=rate_limit_initial,
+                                                 min_rate=rate_limit_min,
+                                                 max_rate=rate_limit_max)
+        return self._rate_limiter
+
+    def http_session(self):
+        """Return the http session; must be called from within self.loop"""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession()
+        return self._http_session
+
+
+runtime = RuntimeContext()
+
+
+def parse_collapse(spec):
+    """CDX collapse fields of a policy, e.g. 'timestamp:6' or 'urlkey,digest'
+
+    Adjacent captures with the same value of a field (or of its first N
+    characters) are collapsed into one by the CDX server. 'none' for no
+    collapsing; raises ValueError for an invalid field.
+    """
+    if spec.strip() == "none":
+        return []
+
+    fields = [x.strip() for x in spec.split(",") if x.strip()]
+    for field in fields:
+        if not re_collapse_field.match(field):
+            raise ValueError(f"invalid collapse field '{field}'")
+
+    return fields
+
+
+def format_collapse(collapse):
+    return ",".join(collapse) if len(collapse) > 0 else "none"
+
+
+default_collapse = parse_collapse(payload_collapse)
+
+
+def collapses_within_years(collapse):
+    """Whether a collapse policy only combines captures of the same year
+
+    True for no collapsing, or collapsing by (at least) the year of the
+    timestamp: only then can the rows of one query for several year windows
+    be divided over the windows.
+    """
+    for field in collapse:
+        name, _, length = field.partition(":")
+        if name != "timestamp" or (length and int(length) < 4):
+            return False
+
+    return True
+
+
+def parse_year_windows(value):
+    """Year windows of a CDX message: 'from:to', or several, comma separated"""
+    return [window.strip().split(":") for window in value.split(",")]
+
+
+def format_year_windows(windows):
+    return ",".join(":".join(window["year_window"]) for window in windows)
+
+
+def parse_url_caps(value):
+    """URL caps of a CDX message: one for all year windows, or one per window
+    (comma separated); 0 for the global setting"""
+    return [int(x) for x in value.split(",")]
+
+
+def format_url_caps(url_caps):
+    """UrlCap attribute value, or None if no window has its own cap"""
+    if not any(url_caps):
+        return None
+
+    return ",".join(str(x or 0) for x in url_caps)
+
+
+def parse_shard(value):
+    """Shard of a CDX message: 'group:index:n_shards:first_page:last_page'"""
+    group, index, n_shards, first_page, last_page = value.split(":")
+    return {
+        "group": group,
+        "index": int(index),
+        "n_shards": int(n_shards),
+        "first_page": int(first_page),
+        "last_page": int(last_page)
+    }
+
+
+def format_shard(shard):
+    return ":".join(str(shard[x]) for x in ["group", "index", "n_shards",
+                                            "first_page", "last_page"])
+
 
-sqs = boto3.resource("sqs")
-fetch_sqs_queue = sqs.Queue(os.environ.get("sqs_fetch_id", None))
-cdx_sqs_queue = sqs.Queue(os.environ.get("sqs_cdx_id", None))
+def parse_merge(value):
+    """Shards to merge, of a CDX message: 'group:n_shards'"""
+    group, n_shards = value.split(":")
+    return {"group": group, "n_shards": int(n_shards)}
 
 
 def get_cdx_sqs_messages():
-    return cdx_sqs_queue.receive_messages(
+    return runtime.cdx_sqs_queue.receive_messages(
         AttributeNames=["SentTimestamp"],
         MaxNumberOfMessages=sqs_cdx_max_messages,
         MessageAttributeNames=["All"],
-        VisibilityTimeout=3,
+        VisibilityTimeout=cdx_visibility_timeout,
         WaitTimeSeconds=3,
     )
 
 
+async def keep_visible(messages):
+    """Extend the visibility timeout of messages while they're processed,
+    so no other invocation receives them in the meantime"""
+    entries = [{
+        "Id": str(index),
+        "ReceiptHandle": message.receipt_handle,
+        "VisibilityTimeout": cdx_visibility_timeout
+    } for index, message in enumerate(messages)]
+
+    while True:
+        await asyncio.sleep(cdx_visibility_timeout / 2)
+        try:
+            await runtime.loop.run_in_executor(None, partial(
+                runtime.sqs.meta.client.change_message_visibility_batch,
+                QueueUrl=runtime.cdx_sqs_queue.url, Entries=entries))
+        except Exception as e:
+            logger.warning(f"extending visibility of messages failed: {str(e)}")
+
+
 def get_domain(url):
     try:
         parsed = urlparse(url)
@@ -89,129 +304,509 @@ def get_domain(url):
         pass
 
 
-async def get_urls_async(messages):
+async def get_urls_async(messages, deadline=None):
     tasks = []
-    async with aiohttp.ClientSession() as session:
-        for message in messages:
-            domain = get_domain(message.body)
-            first_stage_only = False
-            job_tag = ""
-            year_window = None
-            url_cap = None
-
-            if 'FirstStageOnly' in message.message_attributes:
-                first_stage_only = message.message_attributes['FirstStageOnly']['StringValue'] == 'y'
-
-            if 'JobTag' in message.message_attributes:
-                job_tag = message.message_attributes['JobTag']['StringValue']
-
-            if 'YearWindow' in message.message_attributes:
-                year_window = message.message_attributes['YearWindow']['StringValue'].split(':')
-
-            if 'UrlCap' in message.message_attributes:
-                url_cap = int(message.message_attributes['UrlCap']['StringValue'])
-
-            tasks.append(asyncio.ensure_future(get_urls(
-                sqs_message_id=message.message_id,
-                sqs_receipt_handle=message.receipt_handle,
-                domain=domain,
-                session=session,
-                job_tag=job_tag,
-                first_stage_only=first_stage_only,
-                year_window=year_window,
-                url_cap=url_cap)))
-
+    session = runtime.http_session()
+    for message in messages:
+        domain = get_domain(message.body)
+        first_stage_only = False
+        job_tag = ""
+        year_windows = None
+        collapse = default_collapse
+        url_caps = None
+        resume_key = None
+        attempt = 0
+        shard = None
+        merge = None
+        state_key = None
+
+        if 'FirstStageOnly' in message.message_attributes:
+            first_stage_only = message.message_attributes['FirstStageOnly']['StringValue'] == 'y'
+
+        if 'JobTag' in message.message_attributes:
+            job_tag = message.message_attributes['JobTag']['StringValue']
+
+        if 'YearWindow' in message.message_attributes:
+            year_windows = parse_year_windows(message.message_attributes['YearWindow']['StringValue'])
+
+        if 'Collapse' in message.message_attributes:
+            try:
+                collapse = parse_collapse(
+                    message.message_attributes['Collapse']['StringValue'])
+            except ValueError as e:
+                logger.warning(f"{str(e)} for {domain}; using " +
+                               f"'{format_collapse(default_collapse)}'")
+
+        if 'UrlCap' in message.message_attributes:
+            url_caps = parse_url_caps(message.message_attributes['UrlCap']['StringValue'])
+
+        if 'ResumeKey' in message.message_attributes:
+            resume_key = message.message_attributes['ResumeKey']['StringValue']
+
+        if 'CdxAttempt' in message.message_attributes:
+            attempt = int(message.message_attributes['CdxAttempt']['StringValue'])
+
+        if 'CdxShard' in message.message_attributes:
+            shard = parse_shard(message.message_attributes['CdxShard']['StringValue'])
+
+        if 'CdxMerge' in message.message_attributes:
+            merge = parse_merge(message.message_attributes['CdxMerge']['StringValue'])
+
+        if 'CdxState' in message.message_attributes:
+            state_key = message.message_attributes['CdxState']['StringValue']
+
+        tasks.append(asyncio.ensure_future(get_urls(
+            sqs_message_id=message.message_id,
+            sqs_receipt_handle=message.receipt_handle,
+            domain=domain,
+            session=session,
+            job_tag=job_tag,
+            first_stage_only=first_stage_only,
+            year_windows=year_windows,
+            collapse=collapse,
+            url_caps=url_caps,
+            resume_key=resume_key,
+            attempt=attempt,
+            shard=shard,
+            merge=merge,
+            state_key=state_key,
+            deadline=deadline)))
+
+    keeper = asyncio.ensure_future(keep_visible(messages))
+    try:
         task_results = await asyncio.gather(*tasks)
+    finally:
+        keeper.cancel()
 
     return task_results
 
 
+def cdx_params(payload, resume_key=None):
+    """Query parameters of a CDX request, as (name, value) tuples
+
+    A list in the payload becomes a parameter per value (e.g. more than one
+    filter).
+    """
+    params = []
+    for name, value in payload.items():
+        for item in value if isinstance(value, list) else [value]:
+            params.append((name, item))
+
+    if resume_key:
+        # the CDX server hands out the key percent-encoded
+        params.append(("resumeKey", unquote_plus(resume_key)))
+
+    return params
+
+
+def mimetype_filter(mimetypes):
+    """CDX filter that keeps captures of the given mimetypes only"""
+    return "mimetype:(" + "|".join(re.escape(x) for x in mimetypes) + ")"
+
+
+@asynccontextmanager
+async def cdx_get(session, params):
+    """Response to a CDX request, paced by the rate limiter"""
+    rate_limiter = runtime.rate_limiter
+    if rate_limiter is not None:
+        await rate_limiter.acquire(max_wait=rate_limit_max_wait)
+
+    async with session.get(CDX_API_URL, params=params) as response:
+        if rate_limiter is not None:
+            await rate_limiter.on_response(
+                response.status, response.headers.get("Retry-After"))
+
+        if response.status != 200:
+            raise RuntimeError("API returned http-status " +
+                               f"{response.status}")
+
+        yield response
+
+
+async def read_cdx_rows(session, params, rows):
+    """Add the rows of a CDX response to a list, parsed while the response
+    streams in; returns the resume key, if any"""
+    n_fields = len(CDX_FIELDS)
+    resume_key = None
+    past_rows = False
+
+    async with cdx_get(session, params) as response:
+        async for line in response.content:
+            line = line.decode("utf-8", "replace").strip()
+            if len(line) == 0:
+                # an empty line separates the rows from the resume key
+                past_rows = True
+            elif past_rows:
+                resume_key = line
+            else:
+                # the original url is the last field and may contain
+                # spaces, so split off the other fields only
+                row = line.split(" ", n_fields - 1)
+                if len(row) == n_fields:
+                    rows.append(row)
+
+    return resume_key
+
+
+async def count_cdx_pages(session, payload):
+    """Number of pages of the CDX index a query covers (showNumPages)"""
+    params = cdx_params(index_payload(payload)) + [("showNumPages", "true")]
+
+    async with cdx_get(session, params) as response:
+        return int((await response.text()).strip())
+
+
+def index_payload(payload):
+    """Payload for requests by page of the index (no limit or resume key)"""
+    return {name: value for name, value in payload.items()
+            if name not in ("limit", "showResumeKey")}
+
+
+async def iter_cdx_index_pages(session, payload, first_page, last_page):
+    """Yield the rows of pages of the CDX index, one page at a time
+
+    A page of the index covers a range of url keys; large domains are
+    split into ranges of pages (see queue_shards). Yields (rows, page)
+    tuples.
+    """
+    payload = index_payload(payload)
+
+    for page in range(first_page, last_page + 1):
+        rows = []
+        await read_cdx_rows(session,
+                            cdx_params(payload) + [("page", str(page))],
+                            rows)
+        yield rows, page
+
+
+async def iter_cdx_pages(session, payload, resume_key=None):
+    """Yield the rows of a CDX query one page at a time
+
+    Pages are requested with `limit` and followed through the resume key
+    the CDX server appends to every page, so no more than `limit` rows are
+    held in memory at once. Rows are parsed while the response streams in.
+    Yields (rows, resume_key) tuples; resume_key is the key of the next
+    page, or None after the last one.
+    """
+    while True:
+        rows = []
+        next_resume_key = await read_cdx_rows(
+            session, cdx_params(payload, resume_key), rows)
+
+        yield rows, next_resume_key
+
+        if not next_resume_key:
+            break
+
+        resume_key = next_resume_key
+
+
+def add_rows(windows, reducers, rows):
+    """Add CDX rows to the reducers of the year windows they are in
+
+    Rows of a capture in more than one (overlapping) window are added to
+    each of them, so every window gets the same URLs as a query of its own.
+    """
+    if len(windows) == 1:
+        # the CDX server only returns rows of the window
+        windows[0]["n_captures"] += len(rows)
+        reducers[0].add(rows)
+        return
+
+    for window, reducer in zip(windows, reducers):
+        year_from, year_to = window["year_window"]
+        # timestamps start with the year
+        in_window = [row for row in rows if year_from <= row[1][:4] <= year_to]
+        window["n_captures"] += len(in_window)
+        reducer.add(in_window)
+
+
 async def get_urls(sqs_message_id, sqs_receipt_handle, domain, session,
-                   job_tag, first_stage_only, year_window, url_cap):
+                   job_tag, first_stage_only, year_windows, url_caps,
+                   resume_key=None, attempt=0, collapse=None, shard=None,
+                   merge=None, state_key=None, deadline=None):
     # https://github.com/internetarchive/wayback/blob/master/wayback-cdx-server/README.md
 
-    if year_window:
-        # if specific time window is present, use that
-        year_from = year_window[0]
-        year_to = year_window[1]
-    else:
-        # else use the global settings
-        year_from = payload_from_year
-        year_to = payload_to_year
+    if not year_windows:
+        # use the global settings, unless specific time windows are present
+        year_windows = [[payload_from_year, payload_to_year]]
+
+    if not url_caps:
+        url_caps = [None]
+
+    if len(url_caps) == 1:
+        # the same cap for all windows
+        url_caps = url_caps * len(year_windows)
+
+    windows = [{
+        "year_window": year_window,
+        "url_cap": url_cap or None,
+        "n_captures": 0,
+        "urls": {},
+        "captures": None
+    } for year_window, url_cap in zip(year_windows, url_caps)]
+
+    # one query for all windows; rows are divided over the windows
+    # afterwards (see add_rows)
+    year_from = min(window[0] for window in year_windows)
+    year_to = max(window[1] for window in year_windows)
+
+    if collapse is None:
+        collapse = default_collapse
 
     payload = {
         "url": domain,
         "matchType": "prefix",
-        "fl": "urlkey,timestamp,digest,original",
-        "collapse": "timestamp:4",
+        "fl": ",".join(CDX_FIELDS),
+        "collapse": collapse,
         "from": year_from,
         "to": year_to,
-        "filter": "statuscode:200",
-        "output": "json",
+        "filter": ["statuscode:200"],
+        "limit": cdx_page_size,
         "showResumeKey": "true",
     }
 
     if match_exact_url:
         payload["matchType"] = "exact"
 
+    if len(cdx_mimetypes) > 0:
+        # leave out images, scripts and such on the server side; the
+        # blacklist only catches them by their extension
+        payload["filter"].append(mimetype_filter(cdx_mimetypes))
+
     ret = {
         "sqs_message_id": sqs_message_id,
         "sqs_receipt_handle": sqs_receipt_handle,
         "domain": domain,
         "job_tag": job_tag,
-        "year_window": [year_from, year_to],
+        "windows": windows,
+        "collapse": collapse,
         "first_stage_only": first_stage_only,
-        "url_cap": url_cap,
-        "urls": None,
-        "error": None
+        "resume_key": None,
+        "attempt": attempt,
+        "error": None,
+        "shard": shard,
+        "n_pages": None,
+        "merge": merge,
+        "n_shards_found": None,
+        "state_key": state_key,
+        "timed_out": False,
+        "reducers": None,
+        "split": False
     }
 
+    if len(windows) > 1 and not collapses_within_years(collapse) and \
+            shard is None and merge is None and resume_key is None and \
+            state_key is None:
+        # captures of different windows could be collapsed into one: each
+        # window gets a query of its own (see split_windows)
+        ret["split"] = True
+        return ret
+
+    if merge is not None:
+        # all shards of a large domain are (or should be) done
+        try:
+            await runtime.loop.run_in_executor(None, merge_shards, ret)
+        except Exception as e:
+            logger.warning(f"error while merging shards of {domain}: " +
+                           f"{str(e)}")
+            # try again later
+            ret["n_shards_found"] = 0
+            for window in windows:
+                window["n_captures"] = 0
+                window["urls"] = {}
+        return ret
+
+    reducers = [DigestReducer() for _ in windows]
+
+    if state_key is not None:
+        # what earlier invocations retrieved of the domain
+        try:
+            state = await runtime.loop.run_in_executor(None, load_state,
+                                                       state_key)
+            loaded = [DigestReducer() for _ in windows]
+            for reducer, saved in zip(loaded, state["windows"]):
+                reducer.load_state(saved)
+            for window, saved in zip(windows, state["windows"]):
+                window["n_captures"] = saved["n_captures"]
+            reducers = loaded
+        except Exception as e:
+            logger.warning(f"loading what was retrieved of {domain} " +
+                           f"failed: {str(e)}; starting over")
+            resume_key = None
+
+    ret["reducers"] = reducers
+
+    async def page_through():
+        nonlocal resume_key
+
+        if shard is not None:
+            # one shard of a large domain
+            async for rows, _ in iter_cdx_index_pages(session, payload,
+                                                      shard["first_page"],
+                                                      shard["last_page"]):
+                add_rows(windows, reducers, rows)
+            return
+
+        # filter page by page, so memory use doesn't grow with the
+        # number of captures of a domain
+        async for rows, next_resume_key in iter_cdx_pages(session, payload,
+                                                          resume_key):
+            add_rows(windows, reducers, rows)
+            resume_key = next_resume_key
+
     try:
-        async with session.get("http://web.archive.org/cdx/search/cdx",
-                               params=payload) as response:
-            if response.status != 200:
-                ret["error"] = f"API returned http-status {response.status} " + \
-                               f"for {domain}"
+        if shard is None and cdx_shard_min_pages > 0 and \
+                resume_key is None and state_key is None:
+            n_pages = await count_cdx_pages(session, payload)
+            if n_pages > cdx_shard_min_pages:
+                # too large for one query: split up (see queue_shards)
+                ret["n_pages"] = n_pages
                 return ret
 
-            response_list = await response.json()
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        try:
+            await asyncio.wait_for(page_through(), timeout)
+        except asyncio.TimeoutError:
+            if deadline is None or time.time() < deadline:
+                # a timeout of a request
+                raise
+            # stop before the Lambda times out; the next invocation
+            # continues from the page that was cut off
+            logger.info(f"ran out of time while getting {domain}")
+            ret["timed_out"] = True
+            ret["resume_key"] = resume_key
     except Exception as e:
         logger.warning(f"error while getting {domain}: {str(e)}")
-        response_list = None
+        ret["error"] = f"{str(e)} for {domain}"
+        # key of the page that failed; the next attempt starts from there
+        ret["resume_key"] = resume_key
 
-    if response_list:
-        # remove empty elements and first header row
-        ret["urls"] = [x for x in response_list if len(x) > 0][1:]
+    for window, reducer in zip(windows, reducers):
+        if shard is not None:
+            window["captures"] = reducer.captures
+        else:
+            window["urls"] = reducer.result()
 
     return ret
 
 
-def filter_urls(records):
-    # Restore original domain in CDX url
-    rec_list = [[re.sub(r'http(s)?:\/\/(www\.)?', '', original,
-                flags=re.IGNORECASE), time, dgst] for url, time, dgst,
-                original in records]
+class DigestReducer:
+    """Keeps one capture per digest while CDX rows stream in
+
+    Gives the same result as sorting all rows by timestamp (newest first)
+    and keeping the first capture of each digest that isn't blacklisted:
+    the newest capture wins, and of captures with the same timestamp the
+    one that came in first. Needs no sort of the rows, and memory grows
+    with the number of unique digests only.
+
+    What the CDX server already did isn't done again: the server returns
+    the captures of a URL one after the other, so the URL is cleaned and
+    checked against the blacklist once for all of them, and captures it
+    collapsed (see parse_collapse) never get here.
+    """
+
+    def __init__(self):
+        # digest => (sequence number, timestamp, url, length)
+        self.captures = {}
+        self.n_rows = 0
+        # last original url seen, and its cleaned url (None if blacklisted)
+        self.last_original = None
+        self.last_url = None
+
+    def add(self, records):
+        captures = self.captures
+        seq = self.n_rows
+
+        for _, timestamp, dgst, _, length, original in records:
+            seq += 1
+            kept = captures.get(dgst)
 
-    # sort on timestamp in reversed order => make sure the oldest pages
-    # are to be found in the end. With identical digests, the oldest
-    # version will be picked in the rec_filtered dictionary
-    rec_list = sorted(rec_list, key=lambda item: item[1], reverse=True)
+            # only a newer capture replaces the one kept for a digest
+            if kept is not None and timestamp <= kept[1]:
+                continue
 
+            if original != self.last_original:
+                # Restore original domain in CDX url
+                url = re_scheme.sub('', original)
+                self.last_original = original
+                self.last_url = None if blacklist.search(url) else url
+
+            if self.last_url is not None:
+                captures[dgst] = (seq, timestamp, self.last_url,
+                                  int(length) if length.isdigit() else 0)
+
+        self.n_rows = seq
+
+    def state(self):
+        """What was kept so far, to continue with on a next invocation"""
+        return {"n_rows": self.n_rows, "captures": self.captures}
+
+    def load_state(self, state):
+        self.n_rows = state["n_rows"]
+        self.captures = {dgst: tuple(capture)
+                         for dgst, capture in state["captures"].items()}
+
+    def add_captures(self, captures, shard_index):
+        """Add the captures of the reducer of a shard
+
+        Shards must be added in order (of their index), so the result is
+        the same as that of a single reducer getting all rows.
+        """
+        for dgst, (seq, timestamp, url, length) in captures.items():
+            kept = self.captures.get(dgst)
+            if kept is not None and timestamp <= kept[1]:
+                continue
+
+            # captures of earlier shards came in first
+            self.captures[dgst] = ((shard_index, seq), timestamp, url, length)
+
+    def result(self):
+        # newest first; identical timestamps in the order they came in
+        ordered = sorted(self.captures.items(), key=lambda x: x[1][0])
+        ordered.sort(key=lambda x: x[1][1], reverse=True)
+
+        return {dgst: [url, timestamp, length]
+                for dgst, (_, timestamp, url, length) in ordered}
+
+
+def filter_urls(records):
     # filter out unwanted urls and identical pages
-    rec_filtered = {}
-    for [url, time, dgst] in rec_list:
-        if dgst not in rec_filtered.keys() and \
-           not any([bool(r.search(url)) for r in blacklist]):
-            rec_filtered[dgst] = [url, time]
+    reducer = DigestReducer()
+    reducer.add(records)
+    return reducer.result()
+
+
+def url_cap_key(record):
+    """Sort key of a record ([url, timestamp, length]) for url_cap
+
+    Shorter URLs first. With cdx_min_length set, captures smaller than it
+    (likely error or placeholder pages) come last, and of URLs of the same
+    length the largest captures first (length is the size of the archived
+    record); otherwise URLs of the same length keep their order.
+    """
+    url, _, length = record
+    if cdx_min_length > 0:
+        return (length < cdx_min_length, len(url), -length)
+    return len(url)
 
-    return rec_filtered
+
+def select_shortest_urls(urls, url_cap):
+    """Keep the url_cap records with the shortest URLs (see url_cap_key)
+
+    Same selection and order as sorting all records by url_cap_key and
+    slicing off the first url_cap (ties keep their original order), but
+    uses a bounded heap: O(n log k) time and O(k) extra memory.
+    """
+    return dict(heapq.nsmallest(url_cap, urls.items(),
+                                key=lambda x: url_cap_key(x[1])))
 
 
 def send_urls_to_fetch_sqs_queue(job_tag, domain, urls, dry_run):
     messages_sent = 0
     batch_messages = []
-    for index, (_, rec) in enumerate(urls.items()):
-        [url, timestamp] = rec
+    for index, (digest, rec) in enumerate(urls.items()):
+        url, timestamp, _ = rec
 
         # send messages to scraper queue 10 at a time,
         # unless they're part of a dry run
@@ -227,7 +822,8 @@ def send_urls_to_fetch_sqs_queue(job_tag, domain, urls, dry_run):
                 "MessageBody": json.dumps(
                     {
                         "url": f"http://web.archive.org/web/{timestamp}/{url}",
-                        "domain": domain
+                        "domain": domain,
+                        "digest": digest
                     }
                 ),
                 "DelaySeconds": 0,
@@ -260,7 +856,7 @@ def send_urls_to_fetch_sqs_queue(job_tag, domain, urls, dry_run):
 
 
 def sqs_send_message_batch(messages):
-    response = fetch_sqs_queue.send_messages(Entries=messages)
+    response = runtime.fetch_sqs_queue.send_messages(Entries=messages)
     if response.get("Failed"):
         logger.warning('Failed to send the following messages to SQS: ' +
                      f'{str(response["Failed"])}')
@@ -274,10 +870,10 @@ def chunks(L, n):
 
 def delete_processed_messages(processed_messages):
     for batch in chunks(processed_messages, 10):
-        cdx_sqs_queue.delete_messages(Entries=batch)
+        runtime.cdx_sqs_queue.delete_messages(Entries=batch)
 
 
-def process_batch(run_id, batch_number):
+def process_batch(run_id, batch_number, deadline=None):
     # get messages from CDX Queue (one message = one domain)
     messages = get_cdx_sqs_messages()
 
@@ -290,7 +886,8 @@ def process_batch(run_id, batch_number):
     processed_messages = []
 
     # get URLs from internet archive (async)
-    task_results = asyncio.run(get_urls_async(messages))
+    task_results = runtime.loop.run_until_complete(
+        get_urls_async(messages, deadline))
 
     # process results
     for result in task_results:
@@ -301,64 +898,376 @@ def process_batch(run_id, batch_number):
 
 
 def process_result(result):
+    processed = {
+        "Id": result["sqs_message_id"],
+        "ReceiptHandle": result["sqs_receipt_handle"]
+    }
+
+    if result["error"] is not None and len(result["error"]) > 0:
+        logger.warning(f'{result["error"]} ({result["job_tag"]})')
+
+    if result["n_pages"] is not None:
+        queue_shards(result)
+        return processed
+
+    if result["split"]:
+        split_windows(result)
+        return processed
+
+    if result["shard"] is not None:
+        # retry the shard, or, if it's done or given up on, save what it
+        # got, for the merge
+        if (result["error"] is None and not result["timed_out"]) or \
+                not requeue_cdx_message(result):
+            save_shard(result)
+        return processed
+
+    if result["merge"] is not None:
+        n_shards = result["merge"]["n_shards"]
+        if result["n_shards_found"] < n_shards:
+            if requeue_merge_message(result):
+                return processed
+            logger.warning(f'merging {result["n_shards_found"]} of ' +
+                           f'{n_shards} shards of {result["domain"]} ' +
+                           f'({result["job_tag"]})')
+
+    # a CDX page failed, or time ran out: put the domain back on the queue,
+    # to continue from that page on a next invocation. Its URLs are only
+    # sent once it's complete (or given up on), so its digests are
+    # deduplicated and its caps applied over all of its captures.
+    if (result["error"] is not None or result["timed_out"]) and \
+            result["merge"] is None and requeue_cdx_message(result):
+        return processed
+
+    for window in result["windows"]:
+        process_window(result, window)
+
+    if result["state_key"] is not None:
+        delete_state(result["state_key"])
+
+    if result["merge"] is not None:
+        delete_shards(result["merge"]["group"])
+
+    return processed
+
+
+def process_window(result, window):
+    """Cap the URLs of a year window and send them to the fetch queue
+
+    Returns the cap (0 for none) and the number of URLs sent.
+    """
     preTruncLen = 0
-    filteredUrls = []
-
-    if result["urls"] is None:
-        result["urls"] = []
-        if "error" in result and result["error"] is not None and len(result["error"]) > 0:
-            logger.warning(f'{result["error"]} ({result["job_tag"]})')
-        # else:
-        #     print(f'[CDX_INFO] {result["job_tag"]},{result["domain"]},' +
-        #           'returned 0 URLs')
+
+    if window["url_cap"]:
+        # cap from CDX message
+        url_cap = window["url_cap"]
+    elif url_limit_per_domain > 0:
+        # cap from general setting
+        url_cap = url_limit_per_domain
     else:
-        # filter out URLs with blacklisted extensions
-        filteredUrls = filter_urls(result["urls"])
-
-        # if len(filteredUrls) == 0:
-        #     print(f'[CDX_INFO] {result["job_tag"]},{result["domain"]},' +
-        #           'retained 0 URLs after filtering')
-        # else:
-        if len(filteredUrls) > 0:
-            preTruncLen = len(filteredUrls)
-
-            if result["url_cap"]:
-                # cap from CDX message
-                url_cap = result["url_cap"]
-            elif url_limit_per_domain > 0:
-                # cap from general setting
-                url_cap = url_limit_per_domain
-            else:
-                url_cap = 0
-
-            # if more URLs are returned than the limit, sort the URLs by their
-            # length ascendingly, so we retain the shortest ones, then slice it
-            if url_cap > 0 and preTruncLen > url_cap:
-                sortedBySize = \
-                    dict(sorted(filteredUrls.items(),
-                         key=lambda x: len(x[1][0])))
-                filteredUrls = \
-                    dict(itertools.islice(sortedBySize.items(),
-                         url_cap))
-                # print(f'[CDX_INFO] {result["job_tag"]},' +
-                #       f'{result["domain"]},truncated {preTruncLen} ' +
-                #       f'URLs to {url_cap}')
-
-            # send what's left after filtering/limiting to the queue
-            send_urls_to_fetch_sqs_queue(job_tag=result["job_tag"],
-                                         domain=result["domain"],
-                                         urls=filteredUrls,
-                                         dry_run=result['first_stage_only'])
+        url_cap = 0
+
+    # URLs were filtered for blacklisted extensions while paging through
+    # the CDX results
+    filteredUrls = window["urls"]
+
+    # if len(filteredUrls) == 0:
+    #     print(f'[CDX_INFO] {result["job_tag"]},{result["domain"]},' +
+    #           'retained 0 URLs after filtering')
+    # else:
+    if len(filteredUrls) > 0:
+        preTruncLen = len(filteredUrls)
+
+        # if more URLs are returned than the limit, retain the shortest ones
+        if url_cap > 0 and preTruncLen > url_cap:
+            filteredUrls = select_shortest_urls(filteredUrls, url_cap)
+            # print(f'[CDX_INFO] {result["job_tag"]},' +
+            #       f'{result["domain"]},truncated {preTruncLen} ' +
+            #       f'URLs to {url_cap}')
+
+        # send what's left after filtering/limiting to the queue
+        send_urls_to_fetch_sqs_queue(job_tag=result["job_tag"],
+                                     domain=result["domain"],
+                                     urls=filteredUrls,
+                                     dry_run=result['first_stage_only'])
 
     print(f'[CDX_METRIC] {result["job_tag"]},{result["domain"]},' +
-          f'{result["year_window"][0]},{result["year_window"][1]},' +
-          f'{len(result["urls"])},{preTruncLen},' +
+          f'{window["year_window"][0]},{window["year_window"][1]},' +
+          f'{window["n_captures"]},{preTruncLen},' +
           f'{len(filteredUrls)}')
 
-    return ({
-        "Id": result["sqs_message_id"],
-        "ReceiptHandle": result["sqs_receipt_handle"]
-    })
+    return url_cap, len(filteredUrls)
+
+
+def shard_key(group, index):
+    return f"{SHARDS_PREFIX}/{group}/{index:05d}.json"
+
+
+def queue_shards(result):
+    """Split a large domain into shards: ranges of pages of the CDX index
+
+    Each shard is a message on the CDX queue, so shards are retrieved by
+    many Lambda instances at the same time. A shard saves the captures it
+    keeps (one per digest) in the result bucket; a merge message, delayed
+    by cdx_merge_delay seconds, combines them once all shards are done (see
+    merge_shards).
+    """
+    n_pages = result["n_pages"]
+    n_shards = (n_pages + cdx_pages_per_shard - 1) // cdx_pages_per_shard
+    # the id of the domain's message keeps its shards together
+    group = result["sqs_message_id"]
+
+    attributes = message_attributes(result)
+
+    entries = []
+    for index in range(n_shards):
+        shard = {
+            "group": group,
+            "index": index,
+            "n_shards": n_shards,
+            "first_page": index * cdx_pages_per_shard,
+            "last_page": min(n_pages, (index + 1) * cdx_pages_per_shard) - 1
+        }
+        entries.append({
+            "Id": str(index),
+            "MessageBody": result["domain"],
+            "MessageAttributes": dict(
+                attributes, CdxShard=string_attribute(format_shard(shard)))
+        })
+
+    for batch in chunks(entries, 10):
+        response = runtime.cdx_sqs_queue.send_messages(Entries=batch)
+        if response.get("Failed"):
+            logger.warning('Failed to send the following shards to SQS: ' +
+                           f'{str(response["Failed"])}')
+
+    runtime.cdx_sqs_queue.send_message(
+        MessageBody=result["domain"],
+        DelaySeconds=cdx_merge_delay,
+        MessageAttributes=dict(attributes, CdxMerge=string_attribute(
+            f"{group}:{n_shards}")))
+
+    logger.info(f'[{result["job_tag"]}]: split {result["domain"]} ' +
+                f'({n_pages} pages) into {n_shards} shards')
+
+
+def split_windows(result):
+    """Put each year window of a domain on the CDX queue as a message of its
+    own (with its own cap)
+
+    For a collapse policy that can combine captures of different years (see
+    collapses_within_years), as the rows of one query for all windows
+    can't be divided over them.
+    """
+    entries = []
+    for index, window in enumerate(result["windows"]):
+        entries.append({
+            "Id": str(index),
+            "MessageBody": result["domain"],
+            "MessageAttributes": message_attributes(
+                dict(result, windows=[window]))
+        })
+
+    for batch in chunks(entries, 10):
+        response = runtime.cdx_sqs_queue.send_messages(Entries=batch)
+        if response.get("Failed"):
+            logger.warning('Failed to send the following windows to SQS: ' +
+                           f'{str(response["Failed"])}')
+
+    logger.info(f'[{result["job_tag"]}]: split {result["domain"]} into ' +
+                f'{len(entries)} year windows (collapse ' +
+                f'{format_collapse(result["collapse"])})')
+
+
+def save_shard(result):
+    """Save the captures a shard kept in the result bucket"""
+    shard = result["shard"]
+    runtime.s3.put_object(
+        Bucket=result_bucket,
+        Key=shard_key(shard["group"], shard["index"]),
+        Body=json.dumps({"windows": [{
+            "n_captures": window["n_captures"],
+            "captures": window["captures"]
+        } for window in result["windows"]]}))
+
+
+def state_key(result):
+    # the same for all attempts at a domain
+    return result["state_key"] or \
+        f'{PARTIAL_PREFIX}/{result["sqs_message_id"]}.json'
+
+
+def save_state(result):
+    """Save what was retrieved of a domain so far in the result bucket"""
+    key = state_key(result)
+    runtime.s3.put_object(
+        Bucket=result_bucket,
+        Key=key,
+        Body=json.dumps({"windows": [dict(
+            reducer.state(), n_captures=window["n_captures"])
+            for window, reducer in zip(result["windows"],
+                                       result["reducers"])]}))
+    return key
+
+
+def load_state(key):
+    return json.loads(runtime.s3.get_object(
+        Bucket=result_bucket, Key=key)["Body"].read())
+
+
+def delete_state(key):
+    try:
+        runtime.s3.delete_object(Bucket=result_bucket, Key=key)
+    except Exception as e:
+        logger.warning(f"deleting {key} failed: {str(e)}")
+
+
+def list_shards(group):
+    paginator = runtime.s3.get_paginator("list_objects_v2")
+    keys = []
+    for page in paginator.paginate(Bucket=result_bucket,
+                                   Prefix=f"{SHARDS_PREFIX}/{group}/"):
+        keys.extend(x["Key"] for x in page.get("Contents", []))
+    return sorted(keys)
+
+
+def merge_shards(result):
+    """Combine the captures of the shards of a domain into its URLs
+
+    Shards are added in order, so the URLs (one per digest) are the same as
+    if the domain were retrieved in one go. Does nothing but count them if
+    shards are missing and the merge can wait for them.
+    """
+    merge = result["merge"]
+
+    try:
+        keys = list_shards(merge["group"])
+    except Exception as e:
+        logger.warning(f'listing shards of {result["domain"]} failed: ' +
+                       f'{str(e)}')
+        keys = []
+
+    result["n_shards_found"] = len(keys)
+    if len(keys) < merge["n_shards"] and \
+            result["attempt"] + 1 < cdx_merge_max_waits:
+        return
+
+    windows = result["windows"]
+    reducers = [DigestReducer() for _ in windows]
+    for key in keys:
+        index = int(key.rsplit("/", 1)[1].split(".")[0])
+        shard = json.loads(runtime.s3.get_object(
+            Bucket=result_bucket, Key=key)["Body"].read())
+        for window, reducer, shard_window in zip(windows, reducers,
+                                                 shard["windows"]):
+            window["n_captures"] += shard_window["n_captures"]
+            reducer.add_captures(shard_window["captures"], index)
+
+    for window, reducer in zip(windows, reducers):
+        window["urls"] = reducer.result()
+
+
+def delete_shards(group):
+    try:
+        keys = list_shards(group)
+        for batch in chunks(keys, 1000):
+            runtime.s3.delete_objects(Bucket=result_bucket, Delete={
+                "Objects": [{"Key": key} for key in batch]})
+    except Exception as e:
+        logger.warning(f"deleting shards {group} failed: {str(e)}")
+
+
+def requeue_merge_message(result):
+    """Check for missing shards again later; False if it's been too long"""
+    attempt = result["attempt"] + 1
+
+    if attempt >= cdx_merge_max_waits:
+        return False
+
+    attributes = message_attributes(result)
+    attributes["CdxMerge"] = string_attribute(
+        f'{result["merge"]["group"]}:{result["merge"]["n_shards"]}')
+    attributes["CdxAttempt"] = string_attribute(str(attempt))
+
+    runtime.cdx_sqs_queue.send_message(MessageBody=result["domain"],
+                                       DelaySeconds=cdx_merge_delay,
+                                       MessageAttributes=attributes)
+    return True
+
+
+def string_attribute(value):
+    return {
+        "DataType": "String",
+        "StringValue": value
+    }
+
+
+def message_attributes(result):
+    """Attributes of a new CDX message for the domain of a result, with all
+    its year windows (and their caps)"""
+    windows = [(x, x["url_cap"]) for x in result["windows"]]
+
+    attributes = {
+        "Author": string_attribute(sqs_message_author),
+        "JobTag": string_attribute(result["job_tag"]),
+        "FirstStageOnly": string_attribute(
+            "y" if result["first_stage_only"] else "n"),
+        "YearWindow": string_attribute(
+            format_year_windows([window for window, _ in windows])),
+        "Collapse": string_attribute(format_collapse(result["collapse"]))
+    }
+
+    url_caps = format_url_caps([url_cap for _, url_cap in windows])
+    if url_caps is not None:
+        attributes["UrlCap"] = string_attribute(url_caps)
+
+    return attributes
+
+
+def requeue_cdx_message(result):
+    """Put a domain back on the CDX queue after one of its pages failed, or
+    time ran out
+
+    The new message carries the resume key of that page, so the next
+    invocation doesn't start over, and the key of what was retrieved so far
+    (saved in the result bucket), so it continues with it. A shard starts
+    over. Returns False if the domain has been tried cdx_max_attempts times
+    (running out of time doesn't count, except for shards), or what was
+    retrieved could not be saved.
+    """
+    attempt = result["attempt"]
+    if result["error"] is not None or result["shard"] is not None:
+        attempt += 1
+
+    if attempt >= cdx_max_attempts:
+        logger.warning(f'giving up on {result["domain"]} after {attempt} ' +
+                       f'attempts ({result["job_tag"]})')
+        return False
+
+    attributes = message_attributes(result)
+    attributes["CdxAttempt"] = string_attribute(str(attempt))
+
+    if result["shard"] is not None:
+        attributes["CdxShard"] = string_attribute(
+            format_shard(result["shard"]))
+    else:
+        try:
+            attributes["CdxState"] = string_attribute(save_state(result))
+        except Exception as e:
+            logger.warning(f'saving what was retrieved of {result["domain"]} ' +
+                           f'failed: {str(e)}')
+            return False
+
+        if result["resume_key"]:
+            attributes["ResumeKey"] = string_attribute(result["resume_key"])
+
+    runtime.cdx_sqs_queue.send_message(MessageBody=result["domain"],
+                                       MessageAttributes=attributes)
+
+    logger.info(f'[{result["job_tag"]}]: requeued {result["domain"]} ' +
+                f'(attempt {attempt + 1})')
+
+    return True
 
 
 def handler(event, context):
@@ -366,8 +1275,18 @@ def handler(event, context):
     logger.info(f"Started CDX Lambda ({run_id})")
     total_proccessed_messages = 0
 
+    # leave time to send the URLs retrieved, or to requeue domains that
+    # aren't complete
+    deadline = None
+    if context is not None:
+        deadline = time.time() + \
+            context.get_remaining_time_in_millis() / 1000 - cdx_deadline_margin
+
     for batch_number in range(cdx_lambda_n_iterations):
-        total_proccessed_messages += process_batch(run_id, batch_number)
+        if deadline is not None and time.time() > deadline:
+            break
+        total_proccessed_messages += process_batch(run_id, batch_number,
+                                                   deadline)
 
     logger.info(f"Messages processed: {total_proccessed_messages}")
     logger.info(f"End CDX Lambda ({run_id})")
@@ -397,7 +1316,7 @@ def main():
         batch_messages.append(
             {"Id": str(message_id), "MessageBody": url, "DelaySeconds": 0}
         )
-    cdx_sqs_queue.send_messages(Entries=batch_messages)
+    runtime.cdx_sqs_queue.send_messages(Entries=batch_messages)
 
     handler(None, None)
 
@@ -0,0 +1,147 @@
+import codecs
+import re
+
+try:
+    # optional: guess the charset of pages that don't declare one; chardet
+    # comes with aiohttp
+    from charset_normalizer import detect
+except ImportError:
+    try:
+        from chardet import detect
+    except ImportError:
+        detect = None
+
+# byte order marks, longest first (the UTF-32 LE mark starts with UTF-16's)
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+
+# browsers decode these as windows-1252, a superset; so do pages that
+# declare them
+WINDOWS_1252_ALIASES = {"ascii", "latin-1", "iso8859-1"}
+
+# <meta charset="..."> or <meta http-equiv="Content-Type"
+# content="text/html; charset=...">, in the first bytes of a page
+re_meta_charset = re.compile(rb'<meta[^>]+?charset\s*=\s*["\']?\s*' +
+                             rb'([A-Za-z0-9_.:+-]+)', re.IGNORECASE)
+META_SNIFF_SIZE = 4096
+
+# bytes of the page a detector looks at; enough for a reliable guess
+DETECT_SAMPLE_SIZE = 65536
+
+# single-byte charsets for Latin script; detectors easily take a Western
+# European (windows-1252) page for one of these
+LATIN_SINGLE_BYTE = {
+    "cp1250", "cp1254", "cp1257", "cp1258", "cp437", "cp850", "cp852",
+    "iso8859-2", "iso8859-3", "iso8859-4", "iso8859-9", "iso8859-10",
+    "iso8859-13", "iso8859-14", "iso8859-15", "iso8859-16", "mac-latin2",
+    "mac-roman",
+}
+
+# signs of decoding with the wrong charset: replacement characters, C1
+# control characters, and symbols of the Latin-1 range between two letters
+# (such as 'gê¶l¹' for 'gęślą')
+re_decode_errors = re.compile(r'[\ufffd\x80-\x9f]|(?<=[^\W\d_])' +
+                              r'[\xa0-\xa9\xab-\xb4\xb6-\xb9\xbb-\xbf]' +
+                              r'(?=[^\W\d_])')
+
+
+def normalise_charset(charset):
+    """Python codec name of a charset label, or None if it's unknown"""
+    if not charset:
+        return None
+
+    try:
+        codec = codecs.lookup(charset.strip().strip('"\''))
+    except LookupError:
+        return None
+
+    if not codec._is_text_encoding:
+        # e.g. 'base64', which decodes to bytes
+        return None
+
+    name = codec.name
+    if name in WINDOWS_1252_ALIASES:
+        return "cp1252"
+
+    return name
+
+
+def sniff_bom(body):
+    for bom, charset in BOMS:
+        if body.startswith(bom):
+            return charset
+    return None
+
+
+def sniff_meta_charset(body):
+    match = re_meta_charset.search(body, 0, META_SNIFF_SIZE)
+    if match is None:
+        return None
+
+    charset = normalise_charset(match.group(1).decode("ascii"))
+    if charset is not None and charset.startswith("utf-16"):
+        # a page that can be read as ASCII isn't UTF-16, whatever it says
+        return "utf-8"
+
+    return charset
+
+
+def detect_charset(body):
+    if detect is None:
+        return None
+
+    return normalise_charset(detect(bytes(body[:DETECT_SAMPLE_SIZE]))
+                             .get("encoding"))
+
+
+def decode_errors(sample, charset):
+    return len(re_decode_errors.findall(sample.decode(charset, "replace")))
+
+
+def fallback_charset(body):
+    """Charset of a page that isn't valid UTF-8 and doesn't declare one
+
+    The detected charset if it's a multibyte or non-Latin one; otherwise
+    windows-1252, unless the detected charset decodes the page with clearly
+    fewer errors. Detectors often take short Western European pages for
+    another Latin charset (such as windows-1250).
+    """
+    charset = detect_charset(body)
+    if charset is None or charset == "cp1252":
+        return "cp1252"
+
+    if charset not in LATIN_SINGLE_BYTE:
+        return charset
+
+    sample = bytes(body[:DETECT_SAMPLE_SIZE])
+    if 2 * decode_errors(sample, charset) < decode_errors(sample, "cp1252"):
+        return charset
+
+    return "cp1252"
+
+
+def decode_body(body, charset=None):
+    """Text of a page's contents (bytes), decoded once
+
+    The charset is taken from, in order: a byte order mark, the
+    Content-Type header (charset), a <meta> tag, or, if the contents
+    aren't valid UTF-8, a detector (on the first bytes only), with
+    windows-1252 as the fallback (see fallback_charset). Bytes that aren't
+    valid in the charset are replaced.
+    """
+    charset = sniff_bom(body) or normalise_charset(charset) or \
+        sniff_meta_charset(body)
+
+    if charset is None:
+        try:
+            # most pages are UTF-8 (or ASCII); this is the only decode then
+            return body.decode("utf-8", "strict")
+        except UnicodeDecodeError:
+            charset = fallback_charset(body)
+
+    return body.decode(charset, "replace")
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import random
+import time
+from functools import partial
+
+logger = logging.getLogger()
+
+# limits of a single put_record_batch call
+FIREHOSE_MAX_BATCH_RECORDS = 500
+FIREHOSE_MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+# errors (of a call or of a record) worth retrying: throttling and
+# passing failures on Firehose's side
+RETRYABLE_ERRORS = {"ServiceUnavailableException", "ThrottlingException",
+                    "InternalFailure"}
+
+
+def error_code(exception):
+    """AWS error code of a failed call (a botocore ClientError), or None"""
+    response = getattr(exception, "response", None)
+    if not isinstance(response, dict):
+        return None
+
+    return response.get("Error", {}).get("Code")
+
+
+class FirehoseWriter:
+    """Sends records to Firehose in batches, while they are being produced
+
+    Records are packed into batches of at most max_records records and
+    max_bytes bytes; a batch is sent as soon as it's full, or, with
+    `linger` set, once its first record has waited `linger` seconds, so
+    records come through while few are produced. Up to `concurrency`
+    batches are sent at the same time. Records Firehose
+    doesn't accept because it's throttling or failing internally are
+    retried with jittered, exponential backoff until the deadline (a
+    time.time() value); records failing with other errors are not. Each
+    record belongs to an SQS message; close() returns the ids of messages
+    with records that could not be delivered, so they can be retried, and
+    on_delivered (if given) is awaited with the ids of messages as soon as
+    their records are delivered. At most twice `concurrency` batches are
+    kept; put() waits when there are more.
+    """
+
+    def __init__(self, client, stream, deadline, concurrency=4,
+                 max_records=FIREHOSE_MAX_BATCH_RECORDS,
+                 max_bytes=FIREHOSE_MAX_BATCH_BYTES, base_delay=0.1,
+                 max_delay=5, on_delivered=None, linger=None):
+        self.client = client
+        self.stream = stream
+        self.deadline = deadline
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_delivered = on_delivered
+        self.linger = linger
+        self.linger_timer = None
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.slots = asyncio.Semaphore(2 * concurrency)
+        self.batch = []
+        self.batch_bytes = 0
+        self.sending = []
+        self.flushes = []
+        self.undelivered = set()
+        self.n_records = 0
+        self.n_batches = 0
+
+    async def put(self, record, message_id):
+        """Add a record ({'Data': ...}) of a message to the next batch"""
+        size = len(record['Data'])
+        if len(self.batch) == self.max_records or \
+                self.batch_bytes + size > self.max_bytes:
+            await self.send_batch()
+
+        self.batch.append((record, message_id))
+        self.batch_bytes += size
+        self.n_records += 1
+
+        if self.linger is not None and self.linger_timer is None:
+            self.linger_timer = asyncio.get_running_loop().call_later(
+                self.linger, self.flush)
+
+    def flush(self):
+        """Start sending the batch being filled, however small
+
+        If all batches that may be kept are being sent, the batch keeps
+        filling for another `linger` seconds instead.
+        """
+        self.linger_timer = None
+        if self.slots.locked():
+            self.linger_timer = asyncio.get_running_loop().call_later(
+                self.linger, self.flush)
+            return
+
+        self.flushes = [x for x in self.flushes if not x.done()]
+        self.flushes.append(asyncio.ensure_future(self.send_batch()))
+
+    async def send_batch(self):
+        if self.linger_timer is not None:
+            self.linger_timer.cancel()
+            self.linger_timer = None
+
+        # taken before waiting for a slot, so records put meanwhile go
+        # into the next batch
+        batch = self.batch
+        self.batch = []
+        self.batch_bytes = 0
+
+        if len(batch) > 0:
+            await self.slots.acquire()
+            self.sending.append(asyncio.ensure_future(self.send(batch)))
+            self.n_batches += 1
+
+    async def put_record_batch(self, records):
+        """Records Firehose did not accept: those to retry, and the others
+
+        If the call failed, all records are in either of them.
+        """
+        call = partial(self.client.put_record_batch,
+                       DeliveryStreamName=self.stream,
+                       Records=[record for record, _ in records])
+
+        async with self.semaphore:
+            try:
+                # boto3 blocks; send from a thread so fetches continue
+                response = await asyncio.get_running_loop() \
+                    .run_in_executor(None, call)
+            except Exception as e:
+                logger.warning(f"Firehose delivery failed: {str(e)}")
+                if error_code(e) in RETRYABLE_ERRORS:
+                    return records, []
+                return [], records
+
+        if response.get('FailedPutCount', 0) == 0:
+            return [], []
+
+        # the index of each response element is the index of its record
+        retry = []
+        failed = []
+        for index, item in enumerate(response['RequestResponses']):
+            if 'ErrorCode' not in item:
+                continue
+
+            if item['ErrorCode'] in RETRYABLE_ERRORS:
+                retry.append(records[index])
+            else:
+                failed.append(records[index])
+
+            if item['ErrorCode'] != 'ServiceUnavailableException':
+                logger.warning("Firehose delivery failed: " +
+                               f"{item.get('ErrorMessage')} " +
+                               f"({item['ErrorCode']})")
+        return retry, failed
+
+    async def send(self, records):
+        try:
+            await self.send_until_deadline(records)
+        finally:
+            self.slots.release()
+
+    async def send_until_deadline(self, records):
+        attempt = 0
+        while True:
+            retry, failed = await self.put_record_batch(records)
+
+            if len(failed) > 0:
+                self.undelivered.update(message_id
+                                        for _, message_id in failed)
+                print(f"FAILED_KINESIS: {len(failed)} records not " +
+                      "delivered; not retried")
+
+            not_delivered = retry + failed
+            if self.on_delivered is not None and \
+                    len(not_delivered) < len(records):
+                not_delivered_items = set(id(item) for item in not_delivered)
+                # items are (record, message_id) tuples
+                await self.on_delivered([item[1] for item in records
+                                         if id(item) not in
+                                         not_delivered_items])
+
+            records = retry
+            if len(records) == 0:
+                return
+
+            attempt += 1
+            delay = random.uniform(0, min(self.max_delay,
+                                          self.base_delay * 2 ** attempt))
+            if time.time() + delay > self.deadline:
+                self.undelivered.update(message_id
+                                        for _, message_id in records)
+                print(f"FAILED_KINESIS: {len(records)} records not " +
+                      f"delivered after {attempt} attempts")
+                return
+
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        """Send what's left; returns ids of messages not (fully) delivered"""
+        await self.send_batch()
+        # flushed batches may still be waiting for a slot
+        await asyncio.gather(*self.flushes)
+        await asyncio.gather(*self.sending)
+        self.flushes = []
+        self.sending = []
+        return self.undelivered
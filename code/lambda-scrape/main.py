@@ -5,15 +5,58 @@ import os
 import re
 import time
 import random
+import resource
+from functools import partial
 from urllib.parse import urlparse
 from datetime import datetime
 from bs4 import BeautifulSoup
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 import boto3
+from charset import decode_body
+from firehose_writer import FirehoseWriter
+from page_cache import make_page_cache
+from parse_pool import default_workers, make_parse_pool
+from rate_limiter import RateLimited, RateLimiter, make_rate_store, \
+    parse_retry_after
+
+try:
+    # optional: faster html parsing (see html_extractor)
+    from lxml import etree
+except ImportError:
+    etree = None
 
 kinesis_firehose_stream = "scrape-kinesis-firehose"
 
 formats_to_save = os.environ.get("formats_to_save", "txt,links").split(",")
+scrape_concurrency = int(os.environ.get("scrape_concurrency", 10))
+scrape_limit_per_host = int(os.environ.get("scrape_limit_per_host", 10))
+scrape_timeout_total = float(os.environ.get("scrape_timeout_total", 120))
+scrape_timeout_read = float(os.environ.get("scrape_timeout_read", 30))
+scrape_dns_cache_ttl = int(os.environ.get("scrape_dns_cache_ttl", 300))
+scrape_keepalive_timeout = float(os.environ.get("scrape_keepalive_timeout", 30))
+scrape_max_body_size = int(os.environ.get("scrape_max_body_size", 10 * 1024 * 1024))
+scrape_oversize_pages = os.environ.get("scrape_oversize_pages", "truncate")
+scrape_content_types = [x.strip().lower() for x in os.environ.get(
+    "scrape_content_types", "text/html,application/xhtml+xml,text/plain")
+    .split(",") if x.strip()]
+html_extractor = os.environ.get("html_extractor", "soup")
+dedup_links = int(os.environ.get("dedup_links", 0)) == 1
+page_cache_spec = os.environ.get("page_cache", "")
+page_cache_ttl = int(os.environ.get("page_cache_ttl", 30 * 24 * 3600))
+rate_limit_store = os.environ.get("rate_limit_store", "memory")
+rate_limit_initial = float(os.environ.get("rate_limit_initial", 20))
+rate_limit_min = float(os.environ.get("rate_limit_min", 0.5))
+rate_limit_max = float(os.environ.get("rate_limit_max", 100))
+rate_limit_max_wait = float(os.environ.get("rate_limit_max_wait", 10))
+scrape_retry_delay = int(os.environ.get("scrape_retry_delay", 30))
+scrape_retry_max_delay = int(os.environ.get("scrape_retry_max_delay", 900))
+firehose_concurrency = int(os.environ.get("firehose_concurrency", 4))
+firehose_time_margin = float(os.environ.get("firehose_time_margin", 10))
+firehose_linger = float(os.environ.get("firehose_linger", 0.5))
+pipeline_queue_size = int(os.environ.get("pipeline_queue_size", 10))
+pipeline_max_bytes = int(os.environ.get("pipeline_max_bytes", 64 * 1024 * 1024))
+parse_pool_kind = os.environ.get("parse_pool", "off")
+parse_workers = int(os.environ.get("parse_workers", 0)) or default_workers()
 
 logger = logging.getLogger()
 
@@ -23,6 +66,42 @@ else:
     logger.setLevel(logging.ERROR)
 
 
+# Firehose accepts records up to 1,000 KiB; json.dumps escapes all
+# non-ASCII characters, so its length equals the size in bytes
+kinesis_max_record_size = 1000000
+
+
+def json_size(value):
+    """Size of a string's JSON encoding, without the quotes"""
+    return len(json.dumps(value)) - 2
+
+
+def fit_json_string(value, max_size):
+    """Longest prefix of value with a JSON encoding of at most max_size
+
+    Every character takes at least one byte, so only the first max_size
+    characters need to be searched, however long the value is. The prefix
+    is cut at the last whitespace, if any, to keep words whole.
+    """
+    if max_size <= 0:
+        return ""
+
+    low, high = 0, min(len(value), max_size)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if json_size(value[:middle]) <= max_size:
+            low = middle
+        else:
+            high = middle - 1
+
+    if low < len(value) and not value[low].isspace():
+        last_space = max(value.rfind(x, 0, low) for x in " \n\t")
+        if last_space > 0:
+            low = last_space
+
+    return value[:low].rstrip()
+
+
 def make_kinesis_record(job_tag, domain, url, text=False, links=False):
     if not text and not links:
         return None
@@ -37,55 +116,120 @@ def make_kinesis_record(job_tag, domain, url, text=False, links=False):
     record["page_text"] = text if text else ""
     record["page_links"] = links if links else ""
 
-    original_size = 0
+    data = json.dumps(record)
+
+    if len(data) <= kinesis_max_record_size:
+        return {'Data': data + '\n'}
+
+    original_size = len(data)
+    text_size = json_size(record["page_text"])
+    links_size = json_size(record["page_links"])
 
-    while True:
+    # what's left for text and links after the other fields
+    budget = kinesis_max_record_size - (original_size - text_size - links_size)
 
-        size = len(json.dumps(record))
+    # trim the larger of the two first; if both are too large, they each
+    # get half of the budget
+    if text_size <= budget // 2:
+        text_budget = text_size
+        links_budget = budget - text_size
+    elif links_size <= budget // 2:
+        links_budget = links_size
+        text_budget = budget - links_size
+    else:
+        links_budget = budget // 2
+        text_budget = budget - links_budget
+
+    if text_budget < text_size:
+        record["page_text"] = fit_json_string(record["page_text"], text_budget)
 
-        if original_size == 0:
-            original_size = size
+    if links_budget < links_size:
+        record["page_links"] = fit_json_string(record["page_links"],
+                                               links_budget)
 
-        kinesis_max_record_size = 1e6
+    data = json.dumps(record)
 
-        if size <= kinesis_max_record_size:
-            break
+    logger.warning(f"{job_tag},{url}: kinesis message truncated " +
+                   f"from {original_size} to {len(data)} " +
+                   f"(text {text_size} to {json_size(record['page_text'])}, " +
+                   f"links {links_size} to {json_size(record['page_links'])})")
 
-        pre_size = len(str(record["page_text"])+str(record["page_links"]))
+    if len(data) > kinesis_max_record_size:
+        # url and other fields alone are too large
+        logger.warning(f"{job_tag},{url}: kinesis message too large")
+        return None
 
-        if record["page_text"] and record["page_links"]:
-            if len(record["page_text"]) > len(record["page_links"]):
-                record["page_text"] = "\n".join(record["page_text"].split()[:-1])
-            else:
-                record["page_links"] = "\n".join(record["page_links"].split()[:-1])
-        elif record["page_text"]:
-            record["page_text"] = "\n".join(record["page_text"].split()[:-1])
-        elif record["page_links"]:
-            record["page_links"] = "\n".join(record["page_links"].split()[:-1])
+    return {'Data': data + '\n'}
 
-        if pre_size <= len(str(record["page_text"])+str(record["page_links"])):
-            break
 
-    if size != original_size:
-        logger.warning(f"{job_tag},{url}: kinesis message truncated " +
-                     f"from {size} to {original_size}")
+def make_kinesis_reference_record(job_tag, domain, url, duplicate_of):
+    """Record for a page with the same contents as an earlier scraped page"""
+    record = {
+        "domain": domain,
+        "url": url,
+        "job_tag": job_tag,
+        "timestamp": datetime.now().isoformat(),
+        "page_text": "",
+        "page_links": "",
+        "duplicate_of": duplicate_of
+    }
 
     return {'Data': json.dumps(record) + '\n'}
 
 
-def remove_internet_archive_url(url, keep_archived_protocol=False):
-    # remove:
-    # - http(s)
-    # - web.archive.org
-    # - generic bit of the path ('/web/1234567890/')
-    re_ia_link = r'^http(s?):\/\/web.archive.org\/web\/(\d)+\/'
-    # - optional http(s) at the beginning of the archived domain
-    re_archived_protocol = r'(http(s?):\/\/)?'
+def page_cache_key(data):
+    """Cache key of a page: its CDX digest if known, else its Wayback URL"""
+    if data.get('digest'):
+        return f"digest:{data['digest']}"
+
+    return f"url:{data['url']}"
 
-    if keep_archived_protocol:
-        return re.sub(re_ia_link, '', str(url))
 
-    return re.sub(re_ia_link+re_archived_protocol, '', str(url))
+# remove:
+# - http(s)
+# - web.archive.org
+# - generic bit of the path ('/web/1234567890/')
+re_ia_link = re.compile(r'^http(s?):\/\/web.archive.org\/web\/(\d)+\/')
+
+# links that certainly have a netloc: optional scheme, '//', and a netloc
+# urlparse wouldn't alter or reject
+re_netloc = re.compile(r'(?:[A-Za-z][A-Za-z0-9+.-]*:)?//' +
+                       r'[^/?#\[\]\x00-\x20]+(?:[/?#]|$)')
+
+
+def has_netloc(link):
+    """Same as len(urlparse(link).netloc) > 0, without parsing most links"""
+    if "//" in link:
+        if re_netloc.match(link):
+            return True
+    elif not ("\t" in link or "\r" in link or "\n" in link):
+        # urlparse removes these, which might create a '//'
+        return False
+
+    try:
+        return len(urlparse(link).netloc) > 0
+    except ValueError:
+        # invalid IPv6 netloc
+        return False
+
+
+def extract_links(hrefs, dedup=False):
+    """Full links of a page, without the internet archive prefix
+
+    Internet archive links are prepended to the original links; the prefix
+    is stripped from all hrefs in one pass. Only links with a netloc (the
+    domain) are kept, to omit relative, internal links (n.b. seems IA turns
+    *all* links into full links but we'll leave that to the customer).
+    Optionally removes duplicate links, keeping the first occurrence.
+    """
+    strip = re_ia_link.sub
+    links = [link for link in (strip('', str(href)) for href in hrefs)
+             if has_netloc(link)]
+
+    if dedup:
+        links = list(dict.fromkeys(links))
+
+    return links
 
 
 def clean_html(response):
@@ -100,122 +244,672 @@ def clean_html(response):
     return response
 
 
-async def fetch(message, session, output_buffer, processed_messages):
+def extract_with_soup(html, get_text=True, get_links=True):
+    """Page text and hrefs of all <a>-elements, using BeautifulSoup"""
+    text = None
+    hrefs = None
+
+    contents = clean_html(html)
+    soup = BeautifulSoup(contents, "html.parser")
+
+    if get_text:
+        text = soup.get_text("\n", strip=True)
+
+    if get_links:
+        # get each <a>-element's href-attribute
+        hrefs = [link.get("href") for link in soup.findAll("a")]
+
+    return text, hrefs
+
+
+SKIPPED_TAGS = {"svg", "script", "style"}
+
+# markup html.parser and lxml build different trees from: html.parser
+# parses tags inside a textarea, and treats template contents and CDATA
+# sections differently
+re_soup_only = re.compile(r'<(?:textarea|template)\b|<!\[CDATA\[',
+                          re.IGNORECASE)
+
+
+def extract_with_lxml(html, get_text=True, get_links=True):
+    """Page text and hrefs of all <a>-elements, using lxml
+
+    Parses the same cleaned markup as extract_with_soup, and collects text
+    and hrefs in a single walk over the tree, skipping what clean_html
+    left of svg, script and style elements. Text is split, stripped and
+    joined the same way as BeautifulSoup's get_text("\n", strip=True).
+    Pages with markup lxml parses differently (see re_soup_only) are
+    handed to extract_with_soup.
+    """
+    contents = clean_html(html)
+    if re_soup_only.search(contents):
+        return extract_with_soup(html, get_text, get_links)
+
+    texts = []
+    hrefs = []
+
+    parser = etree.HTMLParser(encoding="utf-8", huge_tree=True)
+    root = etree.fromstring(contents.encode("utf-8"), parser)
+
+    if root is not None:
+        walker = etree.iterwalk(root, events=("start", "end", "comment",
+                                              "pi"))
+        for event, element in walker:
+            if event == "start":
+                if element.tag in SKIPPED_TAGS:
+                    walker.skip_subtree()
+                    continue
+                if get_links and element.tag == "a":
+                    hrefs.append(element.get("href"))
+                if get_text and element.text:
+                    texts.append(element.text)
+            elif get_text and element.tail:
+                # text following an element (or comment) belongs to its
+                # parent, and comes after the element's own contents
+                texts.append(element.tail)
+
+    text = None
+    if get_text:
+        text = "\n".join(x for x in (t.strip() for t in texts) if x)
+
+    return text, hrefs if get_links else None
+
+
+HTML_EXTRACTORS = {
+    "soup": extract_with_soup,
+    "lxml": extract_with_lxml,
+}
+
+
+def get_html_extractor(name):
+    """Extractor by name; falls back to BeautifulSoup if lxml is missing"""
+    if name not in HTML_EXTRACTORS:
+        logger.warning(f"Unknown html extractor '{name}'; using 'soup'")
+        name = "soup"
+
+    if name == "lxml" and etree is None:
+        logger.warning("lxml is not installed; using 'soup'")
+        name = "soup"
+
+    return HTML_EXTRACTORS[name]
+
+
+extract_html = get_html_extractor(html_extractor)
+
+
+def read_message(message):
+    """Page of an SQS message, passed on from stage to stage"""
     data = json.loads(message['body'])
-    domain = data['domain']
-    url = data['url']
 
     if 'JobTag' in message['messageAttributes']:
         job_tag = message['messageAttributes']['JobTag']['stringValue']
     else:
         job_tag = ""
 
-    logger.info(f'fetch url "{url}"')
+    return {
+        "message": message,
+        "data": data,
+        "domain": data['domain'],
+        "url": data['url'],
+        "job_tag": job_tag,
+        "status": None,
+        "body": None,
+        "charset": None,
+        "text": False,
+        "links": False,
+        "cached": None,
+        "skipped": None,
+        "parse_error": None
+    }
+
 
+def parse_contents(body, charset=None):
+    """Text and links of a page's contents (bytes)
+
+    charset is the one in the Content-Type header, if any. Either is False
+    if it's not saved, or empty. Runs in a parse pool process, if any, so
+    only takes and returns plain values.
+    """
     content_text = False
     content_links = False
 
-    try:
+    raw_contents = decode_body(body, charset)
+
+    if "txt" in formats_to_save or "links" in formats_to_save:
+        page_text, page_hrefs = \
+            extract_html(raw_contents,
+                         get_text="txt" in formats_to_save,
+                         get_links="links" in formats_to_save)
+
+    if "txt" in formats_to_save:
+        content_text = page_text
+
+    if "links" in formats_to_save:
+        # full links from all <a>-elements
+        doc_links = extract_links(page_hrefs, dedup=dedup_links)
+
+        if len(doc_links) > 0:
+            content_links = "\n".join(doc_links)
 
-        async with session.get(url) as response:
-
-            resp_content = await response.read()
-
-            if response.status == 200:
-
-                try:
-                    # resp.content is a byte array, convert to string
-                    # raw_contents = resp_content.decode("utf-8", "ignore")
-                    try:
-                        raw_contents = resp_content.decode("utf-8", "strict")
-                    except Exception:
-                        raw_contents = resp_content.decode("utf-8", "ignore")
-
-                    if "txt" in formats_to_save or "links" in formats_to_save:
-                        contents = clean_html(raw_contents)
-                        soup = BeautifulSoup(contents, "html.parser")
-
-                    if "txt" in formats_to_save:
-                        content_text = soup.get_text("\n", strip=True)
-                        # if len(content_text) == 0:
-                        #     print(f"[SCRAPE_INFO] {job_tag},{domain}," +
-                        #           f"{data['url']},parsed page body is empty")
-
-                    if "links" in formats_to_save:
-                        # extract all <a>-elements
-                        doc_links = []
-                        for link in soup.findAll("a"):
-                            # get each link's href-attribute
-                            doc_link = link.get("href")
-                            # internet archive links are prepended
-                            # to the original links
-                            doc_link = remove_internet_archive_url(doc_link,
-                                                                   keep_archived_protocol=True)
-                            # parse the link to see whether it has a FQDN
-                            # (to omit the relative, internal links)
-                            parse_link = urlparse(doc_link)
-                            if len(parse_link.netloc) > 0:
-                                # keep only the full links (netloc contains
-                                # the domain) (n.b. seems IA turns *all* links
-                                # into full links but we'll leave that to the
-                                # customer)
-                                doc_links.append(doc_link)
-
-                        if len(doc_links) > 0:
-                            content_links = "\n".join(doc_links)
-                        # else:
-                        #     print(f"[SCRAPE_INFO] {job_tag},{domain}," +
-                        #           f"{data['url']},found no links")
-
-                except Exception as e:
-                    logger.warning(f'Failed to parse "{url}": {str(e)}')
-            else:
-                logger.warning(f'Failed to get "{url}": {response.status}')
-                    
-            # too many requests or server error: do not delete message, try again later
-            if response.status == 429 or response.status >= 500:
-                logger.warning(f"Server returned {response.status}; retrying {url} later.")
-            else:
-                record = make_kinesis_record(job_tag=job_tag, domain=domain,
-                                            url=url, text=content_text,
-                                            links=content_links)
-
-                # record == None if there's no text or links
-                if record:
-                    output_buffer.append(record)
-
-                size_txt = 0 if not content_text else len(content_text)
-                size_links = 0 if not content_links else len(content_links)
-
-                print(f"[SCRAPE_METRIC] {job_tag},{domain},{data['url']}," +
-                    f"{str(size_txt)},{str(size_links)}")
-
-                processed_messages = log_processed_message(processed_messages, message)
+    return content_text, content_links
+
+
+async def parse_page(page):
+    """Extract the text and links of a downloaded page"""
+    try:
+        parse_pool = runtime.parse_pool
+        if parse_pool is not None:
+            page['text'], page['links'] = await parse_pool.run(
+                page['body'], page['charset'])
+        else:
+            page['text'], page['links'] = parse_contents(page['body'],
+                                                         page['charset'])
 
     except Exception as e:
-        logger.warning(f'Failed to fetch "{url}": {str(e)}')
-        print(f"[SCRAPE_METRIC] {job_tag},{domain},{data['url']},0,0")
-        processed_messages = log_processed_message(processed_messages, message)
+        logger.warning(f'Failed to parse "{page["url"]}": {str(e)}')
+        page['parse_error'] = str(e)
 
 
-def log_processed_message(processed_messages,message):
-    processed_messages.append({
-        'Id': message['messageId'],
-        'ReceiptHandle': message['receiptHandle']
-    })
-    return processed_messages
+def skip_reason(response):
+    """Why a page isn't downloaded (by its headers), or None
+
+    Pages are skipped if they have a Content-Type that isn't in
+    scrape_content_types, or, if scrape_oversize_pages is 'skip', a
+    Content-Length over scrape_max_body_size. Pages without these headers
+    are downloaded.
+    """
+    if len(scrape_content_types) > 0 and "Content-Type" in response.headers:
+        # without the parameters (charset)
+        if response.content_type.lower() not in scrape_content_types:
+            return f"content type {response.content_type}"
+
+    if scrape_oversize_pages == "skip" and \
+            response.content_length is not None and \
+            response.content_length > scrape_max_body_size:
+        return f"{response.content_length} bytes"
 
+    return None
 
-async def fetch_all(records, output_buffer, processed_messages):
-    tasks = []
-    fetch.start_time = dict()
-    async with ClientSession() as session:
-        for record in records:
-            task = asyncio.ensure_future(fetch(record, session, output_buffer,
-                                               processed_messages))
-            tasks.append(task)
-        _ = await asyncio.gather(*tasks)
 
+def body_size(response):
+    """Max. number of bytes of a response's contents, as downloaded
+
+    Its Content-Length, if it's known and the contents aren't compressed,
+    up to scrape_max_body_size.
+    """
+    encoding = response.headers.get("Content-Encoding", "identity").lower()
+    if response.content_length is None or encoding != "identity":
+        return scrape_max_body_size
+
+    return min(response.content_length, scrape_max_body_size)
+
+
+def retry_delay(message, retry_after=0):
+    """Seconds before a message that failed is retried
+
+    Doubles with every receive of the message, with jitter so retried
+    messages don't all come back at once, and is at least as long as the
+    archive's Retry-After.
+    """
+    receive_count = int(message.get('attributes', {})
+                        .get('ApproximateReceiveCount', 1))
+    delay = min(scrape_retry_max_delay,
+                scrape_retry_delay * 2 ** (receive_count - 1))
+    delay = random.uniform(delay / 2, delay)
+    return int(min(scrape_retry_max_delay, max(delay, retry_after)))
+
+
+def delay_retries(messages, retry_after):
+    """Set the visibility timeout of each message to its retry delay"""
+    entries = [{
+        'Id': message['messageId'],
+        'ReceiptHandle': message['receiptHandle'],
+        'VisibilityTimeout': retry_delay(
+            message, retry_after.get(message['messageId'], 0))
+    } for message in messages]
+
+    for entries_chunk in chunks(entries, 10):
+        try:
+            response = runtime.sqs_queue.change_message_visibility_batch(
+                Entries=entries_chunk)
+        except Exception as e:
+            # the messages come back after the queue's visibility timeout
+            logger.warning(f"change visibility failed: {str(e)}")
+            continue
+
+        if 'Failed' in response and len(response['Failed']) > 0:
+            logger.warning("change visibility failed:" +
+                           f"{len(response['Failed'])}/{len(entries_chunk)} " +
+                           "messages; " +
+                           f"{list(set([x['Message'] for x in response['Failed']]))}")
+
+
+class RuntimeContext:
+    """Resources kept between invocations of a warm Lambda
+
+    AWS clients, the event loop, the http session (with its open
+    connections to the Internet Archive), the page cache and the rate
+    limiter are created on first use, and reused by later invocations of
+    the same Lambda instance. The parse pool is created at cold start: a
+    process pool forks its workers, which is only safe before any threads
+    (of executors or AWS clients) are started.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._http_session = None
+        self._firehose = None
+        self._sqs_queue = None
+        self._page_cache = None
+        self._rate_limiter = None
+        self._parse_pool = make_parse_pool(parse_pool_kind, parse_contents,
+                                           parse_workers)
+
+    @property
+    def loop(self):
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
+
+    @property
+    def firehose(self):
+        if self._firehose is None:
+            self._firehose = boto3.client("firehose",
+                                          region_name="eu-central-1")
+        return self._firehose
+
+    @property
+    def sqs_queue(self):
+        if self._sqs_queue is None:
+            sqs = boto3.resource("sqs")
+            self._sqs_queue = sqs.Queue(os.environ.get("sqs_fetch_id", None))
+        return self._sqs_queue
+
+    @property
+    def page_cache(self):
+        """Cache of scraped pages, or None if page_cache isn't set"""
+        if self._page_cache is None and page_cache_spec:
+            self._page_cache = make_page_cache(page_cache_spec, page_cache_ttl)
+        return self._page_cache
+
+    @property
+    def rate_limiter(self):
+        """Limiter of requests to the archive, or None if switched off"""
+        if self._rate_limiter is None:
+            store = make_rate_store(rate_limit_store)
+            if store is not None:
+                self._rate_limiter = RateLimiter(store,
+                                                 key="web.archive.org/web",
+                                                 rate=rate_limit_initial,
+                                                 min_rate=rate_limit_min,
+                                                 max_rate=rate_limit_max)
+        return self._rate_limiter
+
+    @property
+    def parse_pool(self):
+        """Pool to parse pages in, or None if parse_pool is 'off'"""
+        return self._parse_pool
+
+    def http_session(self):
+        """Return the http session; must be called from within self.loop"""
+        if self._http_session is None or self._http_session.closed:
+            connector = TCPConnector(limit=scrape_concurrency,
+                                     limit_per_host=scrape_limit_per_host,
+                                     ttl_dns_cache=scrape_dns_cache_ttl,
+                                     keepalive_timeout=scrape_keepalive_timeout)
+            timeout = ClientTimeout(total=scrape_timeout_total,
+                                    sock_read=scrape_timeout_read)
+            self._http_session = ClientSession(connector=connector,
+                                               timeout=timeout)
+        return self._http_session
+
+
+runtime = RuntimeContext()
+
+
+class Pipeline:
+    """Scrapes a batch of messages in stages: fetch, parse, serialise, ship
+    (to Firehose) and ack (delete from the queue)
+
+    Stages run at the same time, connected by bounded queues: a stage that
+    falls behind holds up the ones before it. The contents of pages being
+    downloaded, parsed and serialised take at most pipeline_max_bytes:
+    a download starts reading a page once there's room for it (or once
+    nothing else is held). Messages are deleted as soon as their record
+    is delivered (records are sent within firehose_linger seconds, rather
+    than when the slowest page is done), or right away if there's nothing
+    to deliver. Messages to retry are left alone; their ids end up in
+    retry_after. Scraped pages go into the page cache at the same time, so
+    a page whose record didn't get delivered is never referred to.
+    """
+
+    def __init__(self, messages, session, deadline):
+        self.messages = {x['messageId']: x for x in messages}
+        self.session = session
+        self.parse_queue = asyncio.Queue(pipeline_queue_size)
+        self.serialise_queue = asyncio.Queue(pipeline_queue_size)
+        self.ack_queue = asyncio.Queue(pipeline_queue_size)
+        self.writer = FirehoseWriter(runtime.firehose, kinesis_firehose_stream,
+                                     deadline=deadline,
+                                     concurrency=firehose_concurrency,
+                                     linger=firehose_linger,
+                                     on_delivered=self.ack)
+        self.processed = set()
+        self.retry_after = {}
+        self.undelivered = set()
+        # page cache entries of messages, to put once they're acked
+        self.cache_entries = {}
+        self.buffered_bytes = 0
+        self.max_buffered_bytes = 0
+        self.released = asyncio.Event()
+
+    def hold(self, n_bytes):
+        """Keep track of the size of page contents in the pipeline"""
+        self.buffered_bytes += n_bytes
+        self.max_buffered_bytes = max(self.max_buffered_bytes,
+                                      self.buffered_bytes)
+
+    def release(self, n_bytes):
+        self.buffered_bytes -= n_bytes
+        self.released.set()
+
+    async def reserve(self, n_bytes):
+        """Hold n_bytes once they fit in pipeline_max_bytes"""
+        while self.buffered_bytes > 0 and \
+                self.buffered_bytes + n_bytes > pipeline_max_bytes:
+            self.released.clear()
+            await self.released.wait()
+
+        self.hold(n_bytes)
+        return n_bytes
+
+    async def run(self):
+        await asyncio.gather(self.fetch_all(), self.parse_all(),
+                             self.serialise_all(), self.ack_all())
+
+    async def fetch_all(self):
+        """Fetch stage: download scrape_concurrency pages at a time"""
+        messages = iter(self.messages.values())
+
+        async def fetch_next():
+            for message in messages:
+                await self.fetch(read_message(message))
+
+        await asyncio.gather(*[fetch_next()
+                               for _ in range(scrape_concurrency)])
+        await self.parse_queue.put(None)
+
+    async def fetch(self, page):
+        url = page['url']
+        message_id = page['message']['messageId']
+
+        logger.info(f'fetch url "{url}"')
+
+        page_cache = runtime.page_cache
+        if page_cache is not None:
+            try:
+                cached = await runtime.loop.run_in_executor(
+                    None, page_cache.get, page_cache_key(page['data']))
+            except Exception as e:
+                logger.warning(f'Page cache lookup failed for "{url}": ' +
+                               f'{str(e)}')
+                cached = None
+
+            # the same page under the same job tag is a redelivery of a
+            # message whose record may not have come through: scrape it again
+            if cached is not None and (
+                    cached['url'] != url or
+                    cached.get('job_tag', page['job_tag']) != page['job_tag']):
+                # same contents were scraped before: save a reference instead
+                page['cached'] = cached
+                await self.serialise_queue.put(page)
+                return
+
+        rate_limiter = runtime.rate_limiter
+        next_queue = self.serialise_queue
+
+        try:
+            if rate_limiter is not None:
+                await rate_limiter.acquire(max_wait=rate_limit_max_wait)
+
+            async with self.session.get(url) as response:
+
+                if rate_limiter is not None:
+                    await rate_limiter.on_response(
+                        response.status, response.headers.get("Retry-After"))
+
+                page['status'] = response.status
+
+                # too many requests or server error: do not delete message, try again later
+                if response.status == 429 or response.status >= 500:
+                    logger.warning(f"Server returned {response.status}; retrying {url} later.")
+                    self.retry_after[message_id] = parse_retry_after(
+                        response.headers.get("Retry-After"))
+                    return
+
+                if response.status == 200:
+                    page['skipped'] = skip_reason(response)
+                    if page['skipped'] is None:
+                        reserved = await self.reserve(body_size(response))
+                        try:
+                            page['body'] = await self.read_body(response,
+                                                                url)
+                        finally:
+                            # the body itself is held from here on
+                            self.release(reserved)
+
+                        if page['body'] is None:
+                            page['skipped'] = "more than " + \
+                                f"{scrape_max_body_size} bytes"
+
+                    if page['skipped'] is None:
+                        page['charset'] = response.charset
+                        self.hold(len(page['body']))
+                        next_queue = self.parse_queue
+                    else:
+                        logger.info(f'skipped "{url}": {page["skipped"]}')
+                else:
+                    logger.warning(f'Failed to get "{url}": {response.status}')
+
+        except asyncio.TimeoutError:
+            # slow response: do not delete message, try again later
+            logger.warning(f"Timeout while fetching; retrying {url} later.")
+            return
+
+        except RateLimited as e:
+            # archive asked to wait longer than we're willing to; try again later
+            logger.warning(f"{str(e)}; retrying {url} later.")
+            self.retry_after[message_id] = e.wait
+            return
+
+        except Exception as e:
+            logger.warning(f'Failed to fetch "{url}": {str(e)}')
+            print(f"[SCRAPE_METRIC] {page['job_tag']},{page['domain']}," +
+                  f"{url},0,0,failed")
+            self.processed.add(message_id)
+            await self.ack_queue.put(page['message'])
+            return
+
+        await next_queue.put(page)
+
+    async def read_body(self, response, url):
+        """Contents of a response, up to scrape_max_body_size bytes
+
+        Read in chunks, so a huge page never takes more memory than that;
+        the rest of it is not downloaded. Returns None for a larger page if
+        scrape_oversize_pages is 'skip'.
+        """
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(65536):
+            body += chunk
+
+            if len(body) > scrape_max_body_size:
+                if scrape_oversize_pages == "skip":
+                    return None
+
+                del body[scrape_max_body_size:]
+                logger.warning(f'"{url}" is larger than ' +
+                               f'{scrape_max_body_size} bytes; keeping ' +
+                               'only the first part')
+                break
+
+        return body
+
+    async def parse_all(self):
+        """Parse stage: extract the text and links of downloaded pages
+
+        Pages are parsed one at a time, or, with a parse pool, as many at a
+        time as the pool has workers.
+        """
+        parse_pool = runtime.parse_pool
+        n_parsers = 1 if parse_pool is None else parse_workers
+
+        await asyncio.gather(*[self.parse_next() for _ in range(n_parsers)])
+        await self.serialise_queue.put(None)
+
+    async def parse_next(self):
+        while True:
+            page = await self.parse_queue.get()
+            if page is None:
+                # let the other parsers know too
+                await self.parse_queue.put(None)
+                break
+
+            await parse_page(page)
+
+            self.release(len(page['body']))
+            page['body'] = None
+            page['size'] = len(page['text'] or "") + len(page['links'] or "")
+            self.hold(page['size'])
+
+            await self.serialise_queue.put(page)
+
+    async def serialise_all(self):
+        """Serialise stage: make the records of pages, and ship them"""
+        while True:
+            page = await self.serialise_queue.get()
+            if page is None:
+                break
+
+            await self.serialise(page)
+
+        self.undelivered = await self.writer.close()
+        await self.ack_queue.put(None)
+
+    async def serialise(self, page):
+        job_tag = page['job_tag']
+        domain = page['domain']
+        url = page['url']
+        message = page['message']
+
+        if page['cached'] is not None:
+            record = None
+            if page['cached']['record']:
+                record = make_kinesis_reference_record(
+                    job_tag=job_tag, domain=domain, url=url,
+                    duplicate_of=page['cached']['url'])
+
+            print(f"[SCRAPE_METRIC] {job_tag},{domain},{url},0,0,cached")
+
+        elif page['skipped'] is not None:
+            # not html, or too large: nothing to save
+            record = None
+            print(f"[SCRAPE_METRIC] {job_tag},{domain},{url},0,0,skipped")
+
+        else:
+            content_text = page['text']
+            content_links = page['links']
+
+            record = make_kinesis_record(job_tag=job_tag, domain=domain,
+                                         url=url, text=content_text,
+                                         links=content_links)
+
+            if runtime.page_cache is not None and page['status'] == 200 \
+                    and page['parse_error'] is None:
+                self.cache_entries[message['messageId']] = \
+                    (page_cache_key(page['data']),
+                     {"url": url, "job_tag": job_tag,
+                      "record": record is not None})
+
+            self.release(page.get('size', 0))
+
+            size_txt = 0 if not content_text else len(content_text)
+            size_links = 0 if not content_links else len(content_links)
+
+            print(f"[SCRAPE_METRIC] {job_tag},{domain},{url}," +
+                  f"{str(size_txt)},{str(size_links)},scraped")
+
+        self.processed.add(message['messageId'])
+
+        # record == None if there's no text or links
+        if record:
+            await self.writer.put(record, message['messageId'])
+        else:
+            await self.update_cache(message['messageId'])
+            await self.ack_queue.put(message)
+
+    async def ack(self, message_ids):
+        """Pass messages with delivered records on to the ack stage"""
+        await asyncio.gather(*[self.update_cache(message_id)
+                               for message_id in message_ids])
+        for message_id in message_ids:
+            await self.ack_queue.put(self.messages[message_id])
+
+    async def update_cache(self, message_id):
+        """Put the page of a message that's done into the page cache"""
+        if message_id not in self.cache_entries:
+            return
+
+        key, value = self.cache_entries.pop(message_id)
+        try:
+            await runtime.loop.run_in_executor(
+                None, runtime.page_cache.put, key, value)
+        except Exception as e:
+            logger.warning(f'Page cache update failed for "{value["url"]}"' +
+                           f': {str(e)}')
+
+    async def ack_all(self):
+        """Ack stage: delete messages that are done, 10 at a time"""
+        done = False
+        while not done:
+            batch = [await self.ack_queue.get()]
+            while len(batch) < 10 and not self.ack_queue.empty():
+                batch.append(self.ack_queue.get_nowait())
+
+            if None in batch:
+                done = True
+                batch.remove(None)
+
+            if len(batch) > 0:
+                await self.delete(batch)
+
+    async def delete(self, messages):
+        entries = [{
+            'Id': message['messageId'],
+            'ReceiptHandle': message['receiptHandle']
+        } for message in messages]
+
+        try:
+            response = await runtime.loop.run_in_executor(
+                None, partial(runtime.sqs_queue.delete_messages,
+                              Entries=entries))
+        except Exception as e:
+            # Lambda deletes them once the whole batch is done
+            logger.warning(f"delete failed: {str(e)}")
+            return
+
+        if 'Failed' in response and len(response['Failed']) > 0:
+            logger.warning("delete failed:" +
+                           f"{len(response['Failed'])}/{len(entries)} " +
+                           "messages; " +
+                           f"{list(set([x['Message'] for x in response['Failed']]))}")
+
+
+async def scrape(messages, deadline):
+    pipeline = Pipeline(messages, runtime.http_session(), deadline)
+    await pipeline.run()
+    return pipeline
 
 
 def chunks(lst, n):
@@ -223,60 +917,46 @@ def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
-def handler(event, context):
-    output_buffer = []
-    processed_messages = []
+def firehose_deadline(context):
+    """Time until which undelivered records are retried"""
+    if context is None:
+        # not running on Lambda
+        return time.time() + 60
+
+    return time.time() + context.get_remaining_time_in_millis() / 1000 - \
+        firehose_time_margin
+
 
+def handler(event, context):
+    """Scrape the messages' urls; returns the messages to retry
+
+    Messages are deleted as soon as they're done; Lambda deletes any that
+    are not in the returned batchItemFailures (the event source mapping
+    must have ReportBatchItemFailures switched on). The ones to retry,
+    including those with records Firehose didn't accept, come back after
+    their own, increasing, delay.
+    """
     logger.info(f'scraper lambda received {len(event["Records"])} messages')
-    loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(fetch_all(event['Records'],
-                                   output_buffer=output_buffer,
-                                   processed_messages=processed_messages))
-    loop.run_until_complete(future)
-
-    if len(output_buffer) > 0:
-        client = boto3.client("firehose", region_name="eu-central-1")
-
-        for output_chunk in chunks(output_buffer, 400):
-
-            response = client.put_record_batch(
-                DeliveryStreamName=kinesis_firehose_stream,
-                Records=output_chunk
-            )
-
-            retries = []
-
-            if 'RequestResponses' in response:
-                """For each record, the index of the response element is the same 
-                as the index used in the request array."""
-                for index, item in enumerate(response['RequestResponses']):
-                    if 'ErrorCode' not in item and 'ErrorMessage' not in item:
-                        continue
-                    # logger.error(f"Firehose Delivery: {item['ErrorMessage']} ({item['ErrorCode']})")
-                    if item['ErrorCode'] == 'ServiceUnavailableException' and item['ErrorMessage'] ==  'Slow down.':
-                        # retrying messages that were sent to fast
-                        retries.append(index)
-                    else:
-                        print(f"FAILED_KINESIS: {item}")
-
-            if len(retries) > 0:
-                secs = random.randint(1, 5)
-                print(f"FAILED_KINESIS: retrying {len(retries)} items in {secs}s")
-                time.sleep(secs)
-                response = client.put_record_batch(
-                    DeliveryStreamName=kinesis_firehose_stream,
-                    Records=[output_chunk[x] for x in retries]
-                )
-           
-    if len(processed_messages) > 0:
-        sqs = boto3.resource("sqs")
-        sqs_queue = sqs.Queue(os.environ.get("sqs_fetch_id", None))
-        response = sqs_queue.delete_messages(Entries=processed_messages)
-        if 'Failed' in response and response['Failed'] > 0:
-            logger.warning("delete failed:" +
-                         f"{len(response['Failed'])}/{len(processed_messages)} " +
-                         "messages; " +
-                         f"{list(set([x['Message'] for x in response['Failed']]))}")
+    pipeline = runtime.loop.run_until_complete(
+        scrape(event['Records'], deadline=firehose_deadline(context)))
+
+    processed_ids = pipeline.processed - pipeline.undelivered
+    failed_messages = [x for x in event['Records']
+                       if x['messageId'] not in processed_ids]
+
+    if len(failed_messages) > 0:
+        delay_retries(failed_messages, pipeline.retry_after)
+
+    # peak memory use: of page contents in the pipeline, and of the whole
+    # Lambda instance (ru_maxrss is in kB on Linux)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    print(f"[SCRAPE_MEMORY] {len(event['Records'])}," +
+          f"{pipeline.max_buffered_bytes},{max_rss}")
+
+    return {
+        "batchItemFailures": [{"itemIdentifier": x['messageId']}
+                              for x in failed_messages]
+    }
 
 
 if __name__ == '__main__':
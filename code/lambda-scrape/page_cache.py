@@ -0,0 +1,108 @@
+import json
+import sqlite3
+import threading
+import time
+import boto3
+
+
+class MemoryPageCache:
+    """Page cache kept in memory; lasts as long as the Lambda instance"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.pages = {}
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is None:
+            return None
+
+        value, expires = page
+        if expires < time.time():
+            del self.pages[key]
+            return None
+
+        return value
+
+    def put(self, key, value):
+        self.pages[key] = (value, time.time() + self.ttl)
+
+
+class SqlitePageCache:
+    """Page cache in a local SQLite database, for local runs and tests"""
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY " +
+                        "KEY, value TEXT, expires REAL)")
+        self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM pages WHERE key = ? " +
+                                  "AND expires >= ?",
+                                  (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+                            (key, json.dumps(value), now + self.ttl))
+            # evict expired pages
+            self.db.execute("DELETE FROM pages WHERE expires < ?", (now,))
+            self.db.commit()
+
+
+class DynamoDbPageCache:
+    """Page cache in a DynamoDB table, shared by all Lambda instances
+
+    The table needs a string hash key 'key', and time to live enabled on
+    the attribute 'expires'. As DynamoDB removes expired items with some
+    delay, expiry is also checked when reading.
+    """
+
+    def __init__(self, table, ttl):
+        self.table = table
+        self.ttl = ttl
+        self.client = boto3.client("dynamodb")
+
+    def get(self, key):
+        response = self.client.get_item(TableName=self.table,
+                                        Key={"key": {"S": key}})
+        item = response.get("Item")
+        if item is None or int(item["expires"]["N"]) < time.time():
+            return None
+
+        return json.loads(item["value"]["S"])
+
+    def put(self, key, value):
+        self.client.put_item(TableName=self.table, Item={
+            "key": {"S": key},
+            "value": {"S": json.dumps(value)},
+            "expires": {"N": str(int(time.time() + self.ttl))}
+        })
+
+
+def make_page_cache(spec, ttl):
+    """Page cache from a spec: 'memory', 'sqlite:<path>' or 'dynamodb:<table>'
+
+    Returns None for an empty spec (no caching).
+    """
+    if not spec:
+        return None
+
+    backend, _, location = spec.partition(":")
+
+    if backend == "memory":
+        return MemoryPageCache(ttl)
+
+    if backend == "sqlite":
+        return SqlitePageCache(location, ttl)
+
+    if backend == "dynamodb":
+        return DynamoDbPageCache(location, ttl)
+
+    raise ValueError(f"unknown page cache '{spec}'")
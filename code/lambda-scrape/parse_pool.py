@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+
+def default_workers():
+    """Number of vCPUs; Lambda has more of them with more memory"""
+    return os.cpu_count() or 1
+
+
+class ThreadParsePool:
+    """Runs a function in threads; useful with parsers that release the GIL"""
+
+    def __init__(self, function, n_workers):
+        self.function = function
+        self.executor = ThreadPoolExecutor(n_workers)
+
+    async def run(self, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.function, *args)
+
+
+def serve(connection, function):
+    """Worker process: call function with the arguments received, send back
+    ('ok', result) or ('error', message)"""
+    while True:
+        try:
+            args = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            connection.send(("ok", function(*args)))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {str(e)}"))
+
+
+class ProcessParsePool:
+    """Runs a function in worker processes, so it doesn't block the loop
+
+    Workers are connected by pipes: Lambda has no /dev/shm, which the
+    queues of multiprocessing (and so ProcessPoolExecutor) need. Workers
+    are forked, so the function doesn't need to be picklable; its
+    arguments and results do.
+    """
+
+    def __init__(self, function, n_workers):
+        self.function = function
+        self.context = multiprocessing.get_context("fork")
+        self.idle = queue.Queue()
+        self.executor = ThreadPoolExecutor(n_workers)
+
+        for _ in range(n_workers):
+            self.idle.put(self.start_worker())
+
+    def start_worker(self):
+        connection, worker_connection = self.context.Pipe()
+        process = self.context.Process(target=serve,
+                                       args=(worker_connection,
+                                             self.function),
+                                       daemon=True)
+        process.start()
+        worker_connection.close()
+        return connection, process
+
+    def call(self, *args):
+        connection, process = self.idle.get()
+
+        try:
+            connection.send(args)
+            status, result = connection.recv()
+        except (EOFError, OSError):
+            # worker died (e.g. out of memory); replace it
+            logger.warning("parse worker stopped; starting a new one")
+            connection.close()
+            process.join(timeout=1)
+            self.idle.put(self.start_worker())
+            raise RuntimeError("parse worker stopped")
+
+        self.idle.put((connection, process))
+
+        if status == "error":
+            raise RuntimeError(result)
+
+        return result
+
+    async def run(self, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.call, *args)
+
+
+PARSE_POOLS = {
+    "thread": ThreadParsePool,
+    "process": ProcessParsePool,
+}
+
+
+def make_parse_pool(kind, function, n_workers=None):
+    """Pool of kind 'thread' or 'process', or None for 'off' (parse inline)"""
+    if not kind or kind == "off":
+        return None
+
+    if kind not in PARSE_POOLS:
+        raise ValueError(f"unknown parse pool '{kind}'")
+
+    return PARSE_POOLS[kind](function, n_workers or default_workers())
@@ -0,0 +1,208 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+import boto3
+
+# responses that mean the archive wants us to slow down
+THROTTLED_STATUSES = {429, 503}
+
+
+class RateLimited(Exception):
+    """Requests are blocked for longer than the caller wants to wait"""
+
+    def __init__(self, wait):
+        super().__init__(f"rate limited for {wait:.0f}s")
+        self.wait = wait
+
+
+class MemoryRateStore:
+    """Rate limiter state kept in memory, shared by limiters in one process"""
+
+    def __init__(self):
+        self.states = {}
+
+    def load(self, key):
+        return self.states.get(key)
+
+    def save(self, key, throttled, rate, blocked_until):
+        self.states[key] = (throttled, rate, blocked_until)
+
+
+class DynamoDbRateStore:
+    """Rate limiter state in a DynamoDB table, shared by all Lambda instances
+
+    The table needs a string hash key 'key'.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.client = boto3.client("dynamodb")
+
+    def load(self, key):
+        response = self.client.get_item(TableName=self.table,
+                                        Key={"key": {"S": key}},
+                                        ConsistentRead=True)
+        item = response.get("Item")
+        if item is None:
+            return None
+
+        return float(item.get("throttled", {"N": "0"})["N"]), \
+            float(item["rate"]["N"]), float(item["blocked_until"]["N"])
+
+    def save(self, key, throttled, rate, blocked_until):
+        self.client.put_item(TableName=self.table, Item={
+            "key": {"S": key},
+            "throttled": {"N": repr(throttled)},
+            "rate": {"N": repr(rate)},
+            "blocked_until": {"N": repr(blocked_until)}
+        })
+
+
+def make_rate_store(spec):
+    """Rate limiter store from a spec: 'memory' or 'dynamodb:<table>'
+
+    Returns None for an empty spec or 'off' (no rate limiting).
+    """
+    if not spec or spec == "off":
+        return None
+
+    backend, _, location = spec.partition(":")
+
+    if backend == "memory":
+        return MemoryRateStore()
+
+    if backend == "dynamodb":
+        return DynamoDbRateStore(location)
+
+    raise ValueError(f"unknown rate limiter store '{spec}'")
+
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait according to a Retry-After header, or 0"""
+    if not value:
+        return 0
+
+    now = time.time() if now is None else now
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - now)
+    except (TypeError, ValueError):
+        return 0
+
+
+class RateLimiter:
+    """Token bucket with an adaptive (AIMD) rate, in requests per second
+
+    The rate goes up by `increase` per second of successful requests, and
+    is multiplied by `decrease` when the server throttles (at most once
+    per second, as the responses to all requests in flight tend to be
+    throttled at once). A Retry-After header blocks all requests until
+    it has passed.
+
+    The rate is per instance. When an instance is throttled, it records
+    the time (and its lowered rate, for reference) and the blocking time in
+    a store, so all instances that share it slow down together: each
+    lowers its own rate once for every throttle newer than the last one it
+    knows of. The store is read at most every `sync_interval` seconds, and
+    written right away when throttled.
+    """
+
+    def __init__(self, store, key, rate=20, min_rate=0.5, max_rate=100,
+                 increase=1, decrease=0.5, sync_interval=1):
+        self.store = store
+        self.key = key
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.sync_interval = sync_interval
+        self.blocked_until = 0
+        self.tokens = 1
+        self.refilled = time.time()
+        self.synced = 0
+        # time of the latest throttle, of this or another instance, the
+        # rate was lowered for; earlier ones were before the rate was set
+        self.throttled = time.time()
+        self.last_decrease = 0
+
+    async def run_store(self, method, *args):
+        # the store may be a remote table; don't block the event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, method, *args)
+
+    async def sync(self, now):
+        if now - self.synced < self.sync_interval:
+            return
+
+        self.synced = now
+        state = await self.run_store(self.store.load, self.key)
+        if state is None:
+            return
+
+        shared_throttled, _, shared_blocked_until = state
+        self.blocked_until = max(self.blocked_until, shared_blocked_until)
+
+        if shared_throttled > self.throttled:
+            # another instance was throttled since the last sync
+            self.throttled = shared_throttled
+            self.decrease_rate(shared_throttled)
+
+    def decrease_rate(self, throttled):
+        """Lower the rate for a throttle, if not lowered in the second before"""
+        if throttled - self.last_decrease >= 1:
+            self.last_decrease = throttled
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    async def acquire(self, max_wait=None):
+        """Wait until a request may be sent
+
+        Raises RateLimited if requests are blocked (by a Retry-After) for
+        more than max_wait seconds.
+        """
+        while True:
+            now = time.time()
+            await self.sync(now)
+
+            if now < self.blocked_until:
+                wait = self.blocked_until - now
+                if max_wait is not None and wait > max_wait:
+                    raise RateLimited(wait)
+                await asyncio.sleep(wait)
+                continue
+
+            self.tokens = min(1, self.tokens +
+                              (now - self.refilled) * self.rate)
+            self.refilled = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def on_response(self, status, retry_after=None):
+        """Adjust the rate to the status and Retry-After of a response"""
+        now = time.time()
+
+        if status not in THROTTLED_STATUSES:
+            if status < 400:
+                self.rate = min(self.max_rate,
+                                self.rate + self.increase / self.rate)
+            return
+
+        wait = parse_retry_after(retry_after, now)
+        if wait > 0:
+            self.blocked_until = max(self.blocked_until, now + wait)
+
+        self.throttled = now
+        self.decrease_rate(now)
+
+        # let the other instances know right away
+        await self.run_store(self.store.save, self.key, self.throttled,
+                             self.rate, self.blocked_until)
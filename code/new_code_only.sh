@@ -41,13 +41,15 @@ else
 
 fi
 
-# Create zip files
+# Create zip files (code in lambda-shared is added to both)
 mkdir -p zips
 
 rm -f ./zips/${LAMBDA_NAME}-cdx.zip
 cd lambda-cdx; zip -r ../zips/${LAMBDA_NAME}-cdx.zip *; cd ..
+cd lambda-shared; zip -r ../zips/${LAMBDA_NAME}-cdx.zip *; cd ..
 rm -f ./zips/${LAMBDA_NAME}-scrape.zip
 cd lambda-scrape; zip -r ../zips/${LAMBDA_NAME}-scrape.zip *; cd ..
+cd lambda-shared; zip -r ../zips/${LAMBDA_NAME}-scrape.zip *; cd ..
 
 echo "Done zipping"
 
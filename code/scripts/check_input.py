@@ -1,100 +1,230 @@
-from urllib.parse import urlparse
-import argparse, re, validators, collections, os, csv
-import pandas as pd
+import argparse, re, validators, collections, os, csv, multiprocessing
 from datetime import datetime
 
+def is_valid_url(url):
+    # in worker processes; validators.url returns a failure object for invalid URLs
+    return bool(validators.url(url))
+
 class InputChecker:
 
     infile = None
     csv_header_urls = 'Website'
     csv_header_years = 'Year'
+    # rows are read and checked this many at a time, so memory use doesn't
+    # grow with the size of the file (only the findings are kept)
+    chunk_size = 100000
+    # 'pandas' checks years a chunk at a time; 'csv' doesn't import pandas,
+    # which takes a while
+    readers = ['pandas', 'csv']
+    reader = 'pandas'
+    n_urls = 0
     valid_urls = []
     invalid_urls = []
-    without_schema = []
-    netlocs = []
+    netloc_counter = collections.Counter()
+    no_schema_counter = collections.Counter()
     netloc_doubles = []
     no_schema_doubles = []
     bad_years = []
+    # Tim Berners-Lee invented the World Wide Web while working at CERN in 1989
+    first_year = 1989
+    # http(s)://, www. and www2. (etc.) in front of a URL
+    re_prefix = re.compile(r'^(https?://)?(www\d?\.)?', re.IGNORECASE)
+    re_netloc = re.compile(r'^([^/?#]*)')
+    # URLs validators.url accepts: http(s), a host name and at most a path; it
+    # only checks the others
+    re_simple_url = re.compile(r"https?://(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}" +
+                               r"(?:/[a-z0-9/\-._~!$&'()*+,;=:@%]*)?", re.IGNORECASE)
+    simple_url_max_length = 200
+    # validators.url is run in worker processes for at least this many URLs
+    pool_min_urls = 1000
+    pool = None
 
     def setInfile(self,infile):
         self.infile = infile
 
-    def readInfile(self):
-        self.urls = pd.read_csv(self.infile, dtype=str)
+    def setReader(self,reader):
+        if reader not in self.readers:
+            raise ValueError(f"Unknown reader '{reader}' ({', '.join(self.readers)})")
+        self.reader = reader
 
-        if not self.csv_header_urls in self.urls.columns:
-            raise ValueError(f"Header '{self.csv_header_urls}' is missing from infile.")
+    def readHeader(self):
+        with open(self.infile, newline='', encoding='utf-8-sig') as f:
+            header = next(csv.reader(f), [])
 
-        print(f"Got {len(self.urls):,d} URLs")
+        if not self.csv_header_urls in header:
+            raise ValueError(f"Header '{self.csv_header_urls}' is missing from infile.")
 
-        self.includes_year = self.csv_header_years in self.urls.columns
+        self.includes_year = self.csv_header_years in header
 
         print(f"Data has {'' if self.includes_year else 'no'} year column")
 
-    def validateURLs(self):
-        print("Validating URLs")
+    def readChunks(self):
+        """(urls, years) of chunk_size rows at a time; lists, or Series with
+        the 'pandas' reader. years is None without a year column."""
+        cols = [self.csv_header_urls] + ([self.csv_header_years] if self.includes_year else [])
 
-        for index, row in self.urls.iterrows():
-            url = row[self.csv_header_urls].strip()
+        if self.reader == 'pandas':
+            import pandas as pd
 
-            if not validators.url(url):
-                self.invalid_urls.append(url)
-            else:
-                self.valid_urls.append(url)
+            for chunk in pd.read_csv(self.infile, usecols=cols, dtype=str, keep_default_na=False,
+                                     chunksize=self.chunk_size):
+                yield chunk[self.csv_header_urls].str.strip(), \
+                    chunk[self.csv_header_years].str.strip() if self.includes_year else None
+            return
+
+        with open(self.infile, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) == self.chunk_size:
+                    yield self.columns(rows)
+                    rows = []
 
-    def validateYears(self):
+            if len(rows) > 0:
+                yield self.columns(rows)
+
+    def columns(self,rows):
+        urls = [(row[self.csv_header_urls] or '').strip() for row in rows]
         if not self.includes_year:
-            return
+            return urls, None
+        return urls, [(row[self.csv_header_years] or '').strip() for row in rows]
+
+    def checkInfile(self):
+        """Validates URLs and years, and counts doubles, in one pass"""
+        self.readHeader()
+        print("Validating URLs and years, finding doubles")
+
+        try:
+            for urls, years in self.readChunks():
+                self.n_urls += len(urls)
+                self.validateURLs(urls)
+                if years is not None:
+                    self.validateYears(urls, years)
+                self.findDoubles()
+
+                print(f"{self.n_urls:>10,d} URLs checked")
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+
+        self.countDoubles()
+        print(f"Got {self.n_urls:,d} URLs")
+
+    def validateURLs(self,urls):
+        """Simple URLs are valid and URLs without a scheme (no ':') aren't; only
+        the others are checked by validators.url"""
+        if self.reader == 'pandas':
+            simple = ((urls.str.len() <= self.simple_url_max_length) &
+                      urls.str.fullmatch(self.re_simple_url)).tolist()
+            no_scheme = (~urls.str.contains(':', regex=False)).tolist()
+        else:
+            simple = [len(url) <= self.simple_url_max_length and self.re_simple_url.fullmatch(url) is not None
+                      for url in urls]
+            no_scheme = [':' not in url for url in urls]
+
+        valid = iter(self.validateStrict([url for url, is_simple, is_schemeless in zip(urls, simple, no_scheme)
+                                          if not (is_simple or is_schemeless)]))
+
+        for url, is_simple, is_schemeless in zip(urls, simple, no_scheme):
+            if is_simple or (not is_schemeless and next(valid)):
+                self.valid_urls.append(url)
+            else:
+                self.invalid_urls.append(url)
+
+    def validateStrict(self,urls):
+        if len(urls) < self.pool_min_urls:
+            return [is_valid_url(url) for url in urls]
 
-        print("Validating years")
+        if self.pool is None:
+            self.pool = multiprocessing.Pool()
 
-        for index, row in self.urls.iterrows():
+        return self.pool.map(is_valid_url, urls, chunksize=max(1, len(urls) // (4 * os.cpu_count())))
 
-            url = row[self.csv_header_urls].strip()
-            year = str(row[self.csv_header_years])
+    def validateYears(self,urls,years):
+        if self.reader == 'pandas':
+            problems = self.yearProblems(years)
+            bad = problems.notna()
+            for url, year, problem in zip(urls[bad], years[bad], problems[bad]):
+                self.bad_years.append([url,year,problem])
+            return
 
+        for url, year in zip(urls, years):
             if len(year)==0:
                 self.bad_years.append([url,year,"empty year"])
             elif not year.isdigit():
                 self.bad_years.append([url,year,"not a valid year"])
-            elif int(year) < 1989:
-                # Tim Berners-Lee invented the World Wide Web while working at CERN in 1989
-                self.bad_years.append([url,year,"too long ago (<1989)"])
+            elif int(year) < self.first_year:
+                self.bad_years.append([url,year,f"too long ago (<{self.first_year})"])
             elif int(year) > int(datetime.now().year):
                 self.bad_years.append([url,year,"future date"])
 
+    def yearProblems(self,years):
+        """The problem with each year of a Series (as validateYears), or NaN"""
+        import pandas as pd
+
+        digits = years.str.fullmatch(r'\d+')
+        values = pd.to_numeric(years.where(digits), errors='coerce')
+
+        # the first problem of a year is reported, as in validateYears
+        problems = years.where(digits & ~digits)
+        for bad, problem in reversed([
+            (years.str.len()==0, "empty year"),
+            (~digits, "not a valid year"),
+            (values < self.first_year, f"too long ago (<{self.first_year})"),
+            (values > int(datetime.now().year), "future date"),
+        ]):
+            problems = problems.mask(bad, problem)
+
+        return problems
+
+    def normaliseURLs(self,urls):
+        """Netloc and schemeless form (without http(s)://www(2).) of a Series of
+        URLs; the schemeless form is NaN for URLs that are just a domain"""
+        import pandas as pd
+
+        cleaned = urls.str.replace(self.re_prefix, '', regex=True)
+        netlocs = cleaned.str.extract(self.re_netloc, expand=False).str.lower()
+        schemeless = cleaned.where(cleaned.str.lower().str.strip("/") != netlocs)
+
+        return pd.DataFrame({'url': urls, 'netloc': netlocs, 'schemeless': schemeless})
+
     def findDoubles(self):
-        print("Finding doubles")
+        """Counts the domains and schemeless forms of the valid URLs of a chunk"""
+        if self.reader == 'pandas':
+            import pandas as pd
+
+            normalised = self.normaliseURLs(pd.Series(self.valid_urls, dtype=str))
+            no_netloc = normalised.netloc.str.len()==0
+
+            for url in normalised.url[no_netloc]:
+                print(f"{url}: no netloc!?")
+
+            self.netloc_counter.update(normalised.netloc[~no_netloc].value_counts().to_dict())
+            self.no_schema_counter.update(normalised.schemeless.value_counts().to_dict())
+            self.valid_urls = []
+            return
+
         for url in self.valid_urls:
             # remove http(s)://www(2).
-            cleaned = re.sub('(http(s)?:\/\/)?(www((\d){1})?\.)?','',url,re.IGNORECASE)
-            bits = urlparse(f"https://{cleaned}")
+            cleaned = self.re_prefix.sub('',url)
+            netloc = self.re_netloc.match(cleaned).group(1).lower()
 
-            if len(bits.netloc)==0:
+            if len(netloc)==0:
                 print(f"{url}: no netloc!?")
             else:
-                self.netlocs.append(bits.netloc.lower())
-
-            if cleaned.lower().strip("/") != bits.netloc.lower():
-                self.without_schema.append(cleaned)
+                self.netloc_counter[netloc] += 1
 
-            # if not len(bits.path)==0 and not bits.path=="/":
-            #     print(f"has path: {url}")
-            #
-            # if not len(bits.params)==0:
-            #     print(f"has params: {url}")
-            #
-            # if not len(bits.query)==0:
-            #     print(f"has query: {url}")
-            #
-            # if not len(bits.fragment)==0:
-            #     print(f"has fragment: {url}")
+            if cleaned.lower().strip("/") != netloc:
+                self.no_schema_counter[cleaned] += 1
 
+        self.valid_urls = []
 
-        netloc_counter = collections.Counter(self.netlocs)
+    def countDoubles(self):
+        netloc_counter = self.netloc_counter
         self.netloc_doubles = [(x,netloc_counter[x]) for x in netloc_counter if netloc_counter[x]>1]
 
-        no_schema_counter = collections.Counter(self.without_schema)
+        no_schema_counter = self.no_schema_counter
         self.no_schema_doubles = [(x,no_schema_counter[x]) for x in no_schema_counter if no_schema_counter[x]>1]
 
     def report(self):
@@ -139,6 +269,7 @@ def main():
 
     parser = argparse.ArgumentParser(description='Fill SQS queue with URLs for which CDX records should be fetched')
     parser.add_argument("--infile", "-f", help=f"Path to CSV-file with URLs (should be in column with header '{ic.csv_header_urls}')",required=True)
+    parser.add_argument("--reader", choices=ic.readers, default=ic.reader, help=f"Read the infile in chunks with pandas, or with the csv module, which doesn't need pandas (default: {ic.reader})")
     args = parser.parse_args()
 
     if args.infile == None:
@@ -146,10 +277,8 @@ def main():
         exit()
 
     ic.setInfile(args.infile)
-    ic.readInfile()
-    ic.validateURLs()
-    ic.validateYears()
-    ic.findDoubles()
+    ic.setReader(args.reader)
+    ic.checkInfile()
     ic.report()
     ic.write_files()
 
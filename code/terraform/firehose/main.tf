@@ -191,5 +191,10 @@ resource "aws_glue_catalog_table" "glue_catalog_table" {
       type = "string"
     }
 
+    columns {
+      name = "duplicate_of"
+      type = "string"
+    }
+
   }
 }
@@ -50,7 +50,7 @@ resource "aws_lambda_function" "lambda" {
 
   runtime     = "python3.8"
   timeout     = var.timeout
-  memory_size = "256"
+  memory_size = var.memory_size
 
   environment {
     variables = var.env_vars
@@ -28,3 +28,9 @@ variable "timeout" {
   type        = number
   default     = 180
 }
+
+variable "memory_size" {
+  description = "memory of the lambda function in MB; the number of vCPUs goes up with it"
+  type        = number
+  default     = 256
+}
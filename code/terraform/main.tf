@@ -24,9 +24,11 @@ data "aws_iam_policy_document" "cdx_policy" {
     actions = [
       "sqs:SendMessage",
       "sqs:GetQueueAttributes",
+      "sqs:ChangeMessageVisibility",
     ]
     resources = [
       module.sqs_fetch.sqs_arn,
+      module.sqs_cdx.sqs_arn,
     ]
   }
   statement {
@@ -44,7 +46,8 @@ data "aws_iam_policy_document" "cdx_policy" {
     actions = [
       "s3:GetObject",
       "s3:ListBucket",
-      "s3:PutObject"
+      "s3:PutObject",
+      "s3:DeleteObject"
     ]
 
     resources = [
@@ -67,7 +70,19 @@ data "aws_iam_policy_document" "cdx_policy" {
     resources = [ "*" ]
   }
 
-
+  dynamic "statement" {
+    for_each = aws_dynamodb_table.rate_limit
+    content {
+      sid = "5"
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+      ]
+      resources = [
+        statement.value.arn,
+      ]
+    }
+  }
 }
 
 
@@ -80,6 +95,7 @@ data "aws_iam_policy_document" "scrape_policy" {
       "sqs:DeleteMessage",
       "sqs:ReceiveMessage",
       "sqs:GetQueueAttributes",
+      "sqs:ChangeMessageVisibility",
     ]
     resources = [
       "${module.sqs_fetch.sqs_arn}",
@@ -127,6 +143,34 @@ data "aws_iam_policy_document" "scrape_policy" {
 
     resources = [ "*" ]
   }
+
+  dynamic "statement" {
+    for_each = aws_dynamodb_table.page_cache
+    content {
+      sid = "6"
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+      ]
+      resources = [
+        statement.value.arn,
+      ]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = aws_dynamodb_table.rate_limit
+    content {
+      sid = "7"
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+      ]
+      resources = [
+        statement.value.arn,
+      ]
+    }
+  }
 }
 
 ################################
@@ -155,8 +199,25 @@ module "lambda_cdx" {
     cdx_logging_level          = var.cdx_logging_level
     payload_from_year          = var.ia_payload_year_from
     payload_to_year            = var.ia_payload_year_to
+    payload_collapse           = var.ia_payload_collapse
     url_limit_per_domain       = var.url_limit_per_domain
     match_exact_url            = var.match_exact_url
+    cdx_page_size              = var.cdx_page_size
+    cdx_max_attempts           = var.cdx_max_attempts
+    cdx_mimetypes              = var.cdx_mimetypes
+    cdx_shard_min_pages        = var.cdx_shard_min_pages
+    cdx_pages_per_shard        = var.cdx_pages_per_shard
+    cdx_merge_delay            = var.cdx_merge_delay
+    cdx_merge_max_waits        = var.cdx_merge_max_waits
+    cdx_visibility_timeout     = var.cdx_visibility_timeout
+    cdx_deadline_margin        = var.cdx_deadline_margin
+    result_bucket              = aws_s3_bucket.result_bucket.id
+    cdx_min_length             = var.cdx_min_length
+    rate_limit_store           = var.rate_limit_store == "dynamodb" ? "dynamodb:${var.lambda_name}-rate-limit" : var.rate_limit_store
+    rate_limit_initial         = var.rate_limit_initial
+    rate_limit_min             = var.rate_limit_min
+    rate_limit_max             = var.rate_limit_max
+    rate_limit_max_wait        = var.rate_limit_max_wait
   }
 }
 
@@ -164,6 +225,7 @@ module "lambda_scrape" {
   source          = "./lambda"
   lambda_function = "${var.lambda_name}-scrape"
   code_bucket     = var.code_bucket
+  memory_size     = var.scrape_memory_size
 
   policy = {
     json = data.aws_iam_policy_document.scrape_policy.json
@@ -174,6 +236,69 @@ module "lambda_scrape" {
     sqs_fetch_arn             = module.sqs_fetch.sqs_arn
     scraper_logging_level     = var.scraper_logging_level
     formats_to_save           = var.formats_to_save
+    scrape_concurrency        = var.scrape_concurrency
+    scrape_limit_per_host     = var.scrape_limit_per_host
+    scrape_timeout_total      = var.scrape_timeout_total
+    scrape_timeout_read       = var.scrape_timeout_read
+    scrape_max_body_size      = var.scrape_max_body_size
+    scrape_oversize_pages     = var.scrape_oversize_pages
+    scrape_content_types      = var.scrape_content_types
+    html_extractor            = var.html_extractor
+    dedup_links               = var.dedup_links
+    page_cache                = var.page_cache == "dynamodb" ? "dynamodb:${var.lambda_name}-page-cache" : var.page_cache
+    page_cache_ttl            = var.page_cache_ttl
+    scrape_retry_delay        = var.scrape_retry_delay
+    scrape_retry_max_delay    = var.scrape_retry_max_delay
+    firehose_concurrency      = var.firehose_concurrency
+    firehose_linger           = var.firehose_linger
+    pipeline_queue_size       = var.pipeline_queue_size
+    pipeline_max_bytes        = var.pipeline_max_bytes
+    parse_pool                = var.parse_pool
+    parse_workers             = var.parse_workers
+    rate_limit_store          = var.rate_limit_store == "dynamodb" ? "dynamodb:${var.lambda_name}-rate-limit" : var.rate_limit_store
+    rate_limit_initial         = var.rate_limit_initial
+    rate_limit_min            = var.rate_limit_min
+    rate_limit_max            = var.rate_limit_max
+    rate_limit_max_wait       = var.rate_limit_max_wait
+  }
+}
+
+#################################
+###    PAGE CACHE    ###
+#################################
+
+# only created if the scrape function uses the dynamodb page cache
+resource "aws_dynamodb_table" "page_cache" {
+  count        = var.page_cache == "dynamodb" ? 1 : 0
+  name         = "${var.lambda_name}-page-cache"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "key"
+
+  attribute {
+    name = "key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires"
+    enabled        = true
+  }
+}
+
+#################################
+###    RATE LIMITER    ###
+#################################
+
+# only created if the functions share their rate limits through dynamodb
+resource "aws_dynamodb_table" "rate_limit" {
+  count        = var.rate_limit_store == "dynamodb" ? 1 : 0
+  name         = "${var.lambda_name}-rate-limit"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "key"
+
+  attribute {
+    name = "key"
+    type = "S"
   }
 }
 
@@ -222,8 +347,10 @@ resource "aws_lambda_permission" "allows_fetch_sqs_to_trigger_scraper_lambda" {
 }
 
 resource "aws_lambda_event_source_mapping" "trigger_scraper" {
-  batch_size = 10 # set the amount of messages send to the lambda
-  # maximum_batching_window_in_seconds  = 30
+  batch_size                         = var.scrape_batch_size # set the amount of messages send to the lambda
+  maximum_batching_window_in_seconds = var.scrape_batching_window
+  # the scrape function returns the messages to retry; Lambda deletes the others
+  function_response_types = ["ReportBatchItemFailures"]
   event_source_arn = module.sqs_fetch.sqs_arn
   enabled          = true
   function_name    = module.lambda_scrape.lambda_arn
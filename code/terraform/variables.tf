@@ -100,6 +100,12 @@ variable "ia_payload_year_to" {
   default     = "2022"
 }
 
+variable "ia_payload_collapse" {
+  description = "captures the Internet Archive collapses into one: comma separated CDX fields, optionally with the number of characters to compare ('timestamp:4' is one capture per URL per year, 'timestamp:6' per month, 'digest' one of a run of identical captures), or 'none'; can be set per domain with fill_sqs_queue.py --collapse"
+  type        = string
+  default     = "timestamp:4"
+}
+
 variable "match_exact_url" {
   description = "match only the exact URL provided (ignores presence or absence of 'www.')"
   type        = string
@@ -112,12 +118,254 @@ variable "formats_to_save" {
   default     = "txt,links"
 }
 
+variable "scrape_concurrency" {
+  description = "max. number of pages the scrape function downloads at the same time"
+  type        = string
+  default     = "10"
+}
+
+variable "scrape_limit_per_host" {
+  description = "max. number of simultaneous connections per host of the scrape function"
+  type        = string
+  default     = "10"
+}
+
+variable "scrape_timeout_total" {
+  description = "max. number of seconds a single page download may take (including connecting)"
+  type        = string
+  default     = "120"
+}
+
+variable "scrape_timeout_read" {
+  description = "max. number of seconds to wait for data while reading a page"
+  type        = string
+  default     = "30"
+}
+
+variable "scrape_max_body_size" {
+  description = "max. number of bytes of a page the scrape function downloads; the rest of a larger page is left out"
+  type        = string
+  default     = "10485760"
+}
+
+variable "scrape_oversize_pages" {
+  description = "what the scrape function does with pages larger than scrape_max_body_size: 'truncate' (keep the first part) or 'skip' (by their Content-Length, before downloading them, if known)"
+  type        = string
+  default     = "truncate"
+  validation {
+    condition     = contains(["truncate", "skip"], var.scrape_oversize_pages)
+    error_message = "Allowed values are: 'truncate' or 'skip'."
+  }
+}
+
+variable "scrape_content_types" {
+  description = "comma separated content types of pages the scrape function downloads; others are skipped before downloading. Pages without a Content-Type are always downloaded; '' downloads all pages"
+  type        = string
+  default     = "text/html,application/xhtml+xml,text/plain"
+}
+
+variable "html_extractor" {
+  description = "library used to extract text and links from pages: 'soup' (BeautifulSoup) or 'lxml' (faster; falls back to 'soup' if lxml isn't installed)"
+  type        = string
+  default     = "soup"
+  validation {
+    condition     = var.html_extractor == "soup" || var.html_extractor == "lxml"
+    error_message = "Allowed values are: 'soup' or 'lxml'."
+  }
+}
+
+variable "dedup_links" {
+  description = "save each link only once per page (1), or every occurrence (0)"
+  type        = string
+  default     = "0"
+}
+
+variable "page_cache" {
+  description = "cache of scraped pages, to save a reference instead of scraping the same contents again: '' (off), 'memory' (per Lambda instance) or 'dynamodb' (shared, creates a table)"
+  type        = string
+  default     = ""
+  validation {
+    condition     = contains(["", "memory", "dynamodb"], var.page_cache)
+    error_message = "Allowed values are: '', 'memory' or 'dynamodb'."
+  }
+}
+
+variable "page_cache_ttl" {
+  description = "number of seconds a scraped page is kept in the page cache"
+  type        = string
+  default     = "2592000"
+}
+
+variable "scrape_batch_size" {
+  description = "max. number of messages (URLs) the scrape function receives per invocation; above 10, scrape_batching_window must be at least 1"
+  type        = number
+  default     = 10
+}
+
+variable "scrape_batching_window" {
+  description = "max. number of seconds to wait to gather a full batch of messages for the scrape function"
+  type        = number
+  default     = 0
+}
+
+variable "scrape_retry_delay" {
+  description = "number of seconds before a URL is retried after the archive returned 429 or a server error, or timed out; doubles with every retry"
+  type        = string
+  default     = "30"
+}
+
+variable "scrape_retry_max_delay" {
+  description = "max. number of seconds before a URL is retried"
+  type        = string
+  default     = "900"
+}
+
+variable "firehose_concurrency" {
+  description = "max. number of batches of records the scrape function sends to Firehose at the same time"
+  type        = string
+  default     = "4"
+}
+
+variable "firehose_linger" {
+  description = "max. number of seconds a record of the scrape function waits for more records to fill its batch before it's sent to Firehose"
+  type        = string
+  default     = "0.5"
+}
+
+variable "pipeline_queue_size" {
+  description = "max. number of pages waiting between two steps (download, parse, save) of the scrape function"
+  type        = string
+  default     = "10"
+}
+
+variable "pipeline_max_bytes" {
+  description = "max. number of bytes of page contents the scrape function holds at the same time (being downloaded, parsed or saved); limits the memory used. Batches of records being sent to Firehose take up to (2 x firehose_concurrency + 1) x 4 MiB on top of this"
+  type        = string
+  default     = "67108864"
+}
+
+variable "parse_pool" {
+  description = "where the scrape function parses pages: 'off' (in between downloads), 'thread' (threads; for html_extractor 'lxml') or 'process' (worker processes)"
+  type        = string
+  default     = "off"
+  validation {
+    condition     = contains(["off", "thread", "process"], var.parse_pool)
+    error_message = "Allowed values are: 'off', 'thread' or 'process'."
+  }
+}
+
+variable "parse_workers" {
+  description = "number of threads or processes of the parse pool; 0 for the number of vCPUs"
+  type        = string
+  default     = "0"
+}
+
+variable "scrape_memory_size" {
+  description = "memory of the scrape function in MB; more memory comes with more vCPUs (2 from 1770 MB), for the parse pool"
+  type        = number
+  default     = 256
+}
+
+variable "rate_limit_store" {
+  description = "where the adaptive rate limit of requests to the Internet Archive is kept: 'memory' (per Lambda instance), 'dynamodb' (shared by all instances, creates a table) or 'off'"
+  type        = string
+  default     = "memory"
+  validation {
+    condition     = contains(["memory", "dynamodb", "off"], var.rate_limit_store)
+    error_message = "Allowed values are: 'memory', 'dynamodb' or 'off'."
+  }
+}
+
+variable "rate_limit_initial" {
+  description = "initial max. number of requests per second to the Internet Archive, per Lambda instance; lowered when the archive returns 429, raised while it doesn't"
+  type        = string
+  default     = "20"
+}
+
+variable "rate_limit_min" {
+  description = "lowest max. number of requests per second the rate limiter goes down to"
+  type        = string
+  default     = "0.5"
+}
+
+variable "rate_limit_max" {
+  description = "highest max. number of requests per second the rate limiter goes up to"
+  type        = string
+  default     = "100"
+}
+
+variable "rate_limit_max_wait" {
+  description = "max. number of seconds to wait when the archive asks to (Retry-After); if longer, the URL or domain is retried later"
+  type        = string
+  default     = "10"
+}
+
 variable "url_limit_per_domain" {
   description = "max. number of URLs to fetch from a single domain"
   type        = number
   default     = 1000
 }
 
+variable "cdx_page_size" {
+  description = "max. number of CDX records requested per page; a domain's records are retrieved and filtered one page at a time"
+  type        = string
+  default     = "5000"
+}
+
+variable "cdx_max_attempts" {
+  description = "max. number of times a domain is put back on the CDX queue to resume after a failed page"
+  type        = string
+  default     = "3"
+}
+
+variable "cdx_shard_min_pages" {
+  description = "domains with more pages in the CDX index than this (each page holds many thousands of captures) are split into shards, retrieved by several CDX function invocations at the same time; 0 to not split domains"
+  type        = string
+  default     = "0"
+}
+
+variable "cdx_pages_per_shard" {
+  description = "number of pages of the CDX index per shard of a large domain"
+  type        = string
+  default     = "1"
+}
+
+variable "cdx_merge_delay" {
+  description = "number of seconds before the URLs of the shards of a domain are combined, and between checks for shards that are not done yet (max. 900)"
+  type        = string
+  default     = "60"
+}
+
+variable "cdx_merge_max_waits" {
+  description = "max. number of times the combining of the shards of a domain waits for shards that are not done yet; then it combines the shards that are done"
+  type        = string
+  default     = "30"
+}
+
+variable "cdx_visibility_timeout" {
+  description = "number of seconds the CDX messages a function invocation works on are hidden from other invocations; extended while they're being worked on"
+  type        = string
+  default     = "180"
+}
+
+variable "cdx_deadline_margin" {
+  description = "number of seconds before its timeout the CDX function stops retrieving captures, to send URLs and put domains that are not complete back on the CDX queue"
+  type        = string
+  default     = "60"
+}
+
+variable "cdx_mimetypes" {
+  description = "comma separated mimetypes of captures the CDX function retrieves (filtered by the CDX server), e.g. 'text/html,application/xhtml+xml'; '' for all"
+  type        = string
+  default     = ""
+}
+
+variable "cdx_min_length" {
+  description = "captures smaller than this number of bytes (as archived, compressed) are the last to be kept when a domain has more URLs than its cap; 0 to treat all the same"
+  type        = string
+  default     = "0"
+}
+
 variable "sqs_message_author" {
   description = "author of messages in SQS queue"
   type        = string
@@ -94,10 +94,13 @@ class InternetArchivePageGetter:
                     if response.status != 200:
                         self.logger.error(f"API returned http-status {response.status} for {domain}")
                     else:
+                        # read once: a second read() returns nothing
+                        body = response.read()
+                        charset = response.headers.get_content_charset()
                         try:
-                            raw_contents = response.read().decode("utf-8", "strict")
-                        except Exception:
-                            raw_contents = response.read().decode("utf-8", "ignore")
+                            raw_contents = body.decode(charset or "utf-8", "strict")
+                        except (LookupError, UnicodeDecodeError):
+                            raw_contents = body.decode("cp1252", "replace")
 
                         if "txt" in self.formats_to_save or "links" in self.formats_to_save:
                             contents = clean_html(raw_contents)
@@ -1,6 +1,6 @@
 import argparse
 import hashlib
-import itertools
+import heapq
 import json
 import logging
 import re
@@ -18,6 +18,19 @@ BLACKLIST_EXTENSIONS = [
     "robots.txt", "/wp-json", "/feed$",
 ]
 
+def select_shortest_urls(urls, url_cap):
+    """Keep the url_cap records with the shortest URLs
+
+    Same selection and order as sorting all records by URL length and
+    slicing off the first url_cap (ties keep their original order), but
+    uses a bounded heap: O(n log k) time and O(k) extra memory.
+
+    A copy of select_shortest_urls of the CDX lambda with cdx_min_length
+    off; code/benchmarks/url_cap_selection.py checks both select the same.
+    """
+    return dict(heapq.nsmallest(url_cap, urls.items(),
+                                key=lambda x: len(x[1][0])))
+
 class ValidDomain(NamedTuple):
     line: str
     tld: str
@@ -80,27 +93,33 @@ class InternetArchiveUrlHarvester:
     @staticmethod
     def filter_urls(records):
 
-        blacklist = [re.compile(ext + r"(\/|\?|$)", re.IGNORECASE) for ext
-                        in BLACKLIST_EXTENSIONS]
+        # all extensions in a single pattern, so each url is searched once
+        blacklist = re.compile("(?:" + "|".join(BLACKLIST_EXTENSIONS) +
+                               r")(\/|\?|$)", re.IGNORECASE)
+        re_scheme = re.compile(r'http(s)?:\/\/(www\.)?', re.IGNORECASE)
+
+        # keep one capture per digest in a single pass, without sorting
+        # all records: the newest capture wins, and of captures with the
+        # same timestamp the first one (digest => [seq, timestamp, url])
+        captures = {}
+        for seq, (_, timestamp, dgst, original) in enumerate(records):
+            kept = captures.get(dgst)
+            if kept is not None and timestamp <= kept[1]:
+                continue
 
-        # Restore original domain in CDX url
-        rec_list = [[re.sub(r'http(s)?:\/\/(www\.)?', '', original,
-                    flags=re.IGNORECASE), time, dgst] for url, time, dgst,
-                    original in records]
+            # Restore original domain in CDX url
+            url = re_scheme.sub('', original)
 
-        # sort on timestamp in reversed order => make sure the oldest pages
-        # are to be found in the end. With identical digests, the oldest
-        # version will be picked in the rec_filtered dictionary
-        rec_list = sorted(rec_list, key=lambda item: item[1], reverse=True)
+            # filter out unwanted urls
+            if not blacklist.search(url):
+                captures[dgst] = [seq, timestamp, url]
 
-        # filter out unwanted urls and identical pages
-        rec_filtered = {}
-        for [url, time, dgst] in rec_list:
-            if dgst not in rec_filtered.keys() and \
-            not any([bool(r.search(url)) for r in blacklist]):
-                rec_filtered[dgst] = [url, time]
+        # newest first; identical timestamps in the order they came in
+        ordered = sorted(captures.items(), key=lambda x: x[1][0])
+        ordered.sort(key=lambda x: x[1][1], reverse=True)
 
-        return rec_filtered
+        return {dgst: [url, timestamp]
+                for dgst, (_, timestamp, url) in ordered}
 
     def save_records(self, records):
         if self.output_file.is_file():
@@ -180,11 +199,9 @@ class InternetArchiveUrlHarvester:
         if len(filtered_urls)==0 or snapshot_limit is None:
             return filtered_urls
 
-        # if more URLs are returned than the limit, sort the URLs by their
-        # length ascendingly, so we retain the shortest ones, then slice it
+        # if more URLs are returned than the limit, retain the shortest ones
         if snapshot_limit > 0 and len(filtered_urls) > snapshot_limit:
-            sorted_by_size = dict(sorted(filtered_urls.items(), key=lambda x: len(x[1][0])))
-            filtered_urls = dict(itertools.islice(sorted_by_size.items(), snapshot_limit))
+            filtered_urls = select_shortest_urls(filtered_urls, snapshot_limit)
 
         return filtered_urls
 